@@ -1,29 +1,19 @@
 from __future__ import annotations
 
-from typing import Callable
-
-make_config: Callable
-make_logger: Callable
-
-try:
-    raise ImportError("C version disabled for now")
-    from .clolog import (
-        make_config,
-        make_logger,
-    )
-except (ImportError, OSError) as err:
-    print(err)
-    print("fallback to Python implementation")
-    from .pylolog import (
-        Config,
-        Record,
-        Level,
-        init,
-        make_config,
-        make_logger,
-        get_config,
-        get_logger,
-    )
+# pylolog uses its compiled hot path (lolog._speedups) when that has been
+# built, and pure Python otherwise. The C library (for C programs) has its
+# own ctypes binding, in lolog.clolog.
+from .pylolog import (
+    Cached,
+    Config,
+    Record,
+    Level,
+    init,
+    make_config,
+    make_logger,
+    get_config,
+    get_logger,
+)
 
 NOTSET = Level.NOTSET
 DEBUG = Level.DEBUG
@@ -34,6 +24,7 @@ CRITICAL = Level.CRITICAL
 SILENT = Level.SILENT
 
 __all__ = [
+    'Cached',
     'Config',
     'Record',
     'Level',
@@ -0,0 +1,399 @@
+"""compact binary log format, and a renderer for it
+
+Writing records in binary is much cheaper than formatting them as text,
+and makes smaller files, which is handy for high-volume debug capture:
+
+    cfg = lolog.make_config()
+    cfg.set_default_level(lolog.DEBUG)
+    cfg.add_stage(lolog.binlog.BinaryOutput(open("debug.lolog", "wb")))
+
+Render the file to the usual text formats later with:
+
+    python -m lolog.binlog [--format simple|json] debug.lolog
+
+A binary log is a sequence of frames. Each frame is a 4-byte length
+(counting the frame type but not the length itself), a 1-byte frame
+type, and a body:
+
+    H   header: MAGIC, then a version byte; starts a new string table
+    S   string: 2-byte id, then UTF-8 text; adds to the string table
+    R   record: 8-byte float time, 1-byte level, then name, message,
+        4-byte item count, and that many (key, value) items
+
+Logger names, messages and keys are string references: a 2-byte id into
+the string table, or NO_ID followed by a long string (once the table is
+full). Values are a 1-byte type followed by:
+
+    n, t, f     nothing (None, True, False)
+    i           4-byte signed int
+    q           8-byte signed int
+    d           8-byte float
+    s           short string: 1-byte length, then UTF-8 text
+    l           long string: 4-byte length, then UTF-8 text
+    I           long string: decimal form of an int too big for 'q'
+    j           long string: JSON form of a list, tuple or dict
+
+Values of any other type are written as their str(), like the simple
+formatter does. All numbers are little-endian.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import struct
+import sys
+import threading
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from .pylolog import (
+    Config,
+    FORMATTER,
+    Level,
+    LogMapLayer,
+    Record,
+    TIME_FORMAT,
+    _fork_handlers,
+    _json_encoder,
+)
+
+
+MAGIC = b'LOLOGBIN'
+VERSION = 1
+
+# string reference to a long string, rather than the string table
+NO_ID = 0xffff
+
+_frame = struct.Struct('<IB')
+_u8 = struct.Struct('<B')
+_u16 = struct.Struct('<H')
+_u32 = struct.Struct('<I')
+_i32 = struct.Struct('<i')
+_i64 = struct.Struct('<q')
+_f64 = struct.Struct('<d')
+_record_head = struct.Struct('<dB')
+
+_no_id = _u16.pack(NO_ID)
+_min_i32 = -2 ** 31
+_max_i32 = 2 ** 31 - 1
+
+# type and length prefix for every length of short string
+_short = [b's' + bytes([size]) for size in range(256)]
+
+
+def _long(text: str) -> bytes:
+    data = text.encode('utf-8', 'surrogateescape')
+    return _u32.pack(len(data)) + data
+
+
+def _encode_str(value: str) -> bytes:
+    data = value.encode('utf-8', 'surrogateescape')
+    if len(data) < 256:
+        return _short[len(data)] + data
+    return b'l' + _u32.pack(len(data)) + data
+
+
+def _encode_value(value: Any) -> bytes:
+    kind = type(value)
+    if kind is str:
+        return _encode_str(value)
+    if kind is int:
+        if _min_i32 <= value <= _max_i32:
+            return b'i' + _i32.pack(value)
+        try:
+            return b'q' + _i64.pack(value)
+        except struct.error:
+            return b'I' + _long(str(value))
+    if kind is float:
+        return b'd' + _f64.pack(value)
+    if value is None:
+        return b'n'
+    if value is True:
+        return b't'
+    if value is False:
+        return b'f'
+    if isinstance(value, (list, tuple, dict)):
+        try:
+            return b'j' + _long(_json_encoder.encode(value))
+        except (TypeError, ValueError):
+            pass
+    return _encode_str(str(value))
+
+
+class _StringTable:
+    """string table for one binary stream"""
+
+    def __init__(self, max_strings: int):
+        self.max_strings = min(max_strings, NO_ID)
+
+        # string -> encoded reference
+        self.refs: Dict[str, bytes] = {}
+
+        # frames to write before the next record: the header, then new
+        # strings
+        header = MAGIC + bytes([VERSION])
+        self.frames = [_frame.pack(len(header) + 1, ord('H')), header]
+
+    def ref(self, text: str) -> bytes:
+        refs = self.refs
+        try:
+            return refs[text]
+        except KeyError:
+            pass
+        if len(refs) >= self.max_strings:
+            return _no_id + _long(text)
+
+        id_ = _u16.pack(len(refs))
+        data = text.encode('utf-8', 'surrogateescape')
+        self.frames += [_frame.pack(len(data) + 3, ord('S')), id_, data]
+        refs[text] = id_
+        return id_
+
+    def format_item(self, key: str, value: Any) -> bytes:
+        return self.ref(key) + _encode_value(value)
+
+
+class BinaryOutput:
+    """Pipeline stage that writes records to a binary stream.
+
+    Unlike the text formats, this stage both formats and writes records
+    (so it goes at the end of the pipeline, with no output stage after
+    it): string ids are shared between records, so records must be
+    written in the same order they are encoded.
+
+    The stream defaults to config.stream, which must then be binary.
+    """
+
+    def __init__(self, stream: Optional[BinaryIO] = None,
+                 max_strings: int = 65536):
+        self.stream = stream
+        self.max_strings = max_strings
+
+        # reentrant, in case a callable value logs something
+        self.mutex = threading.RLock()
+        self.table = _StringTable(max_strings)
+        _fork_handlers.add(self)
+
+    def _after_fork(self) -> None:
+        # a child process writing to its own stream needs its own string
+        # table (processes cannot share one binary stream)
+        self.mutex = threading.RLock()
+        self.table = _StringTable(self.max_strings)
+
+    def reset(self) -> None:
+        """Start a new string table, e.g. after rotating the stream.
+
+        The next record written starts with a new header.
+        """
+        with self.mutex:
+            self.table = _StringTable(self.max_strings)
+
+    def flush(self) -> None:
+        stream = self.stream
+        if stream is not None:
+            stream.flush()
+
+    def __call__(self, config: Config, record: Record) -> Optional[Record]:
+        stream: Any = self.stream or config.stream
+        if stream is None:
+            raise RuntimeError(
+                'lolog pipeline error: '
+                'cannot output log record when config.stream is not set')
+
+        with self.mutex:
+            table = self.table
+            ref = table.ref
+            format_item = table.format_item
+            body: List[Any] = [
+                _record_head.pack(record.time, record.level),
+                ref(record.name),
+                ref(record.message),
+                b'',
+            ]
+            append = body.append
+            count = 0
+            for layer in record.get_layers():
+                if not layer:
+                    continue
+                count += len(layer)
+                if isinstance(layer, LogMapLayer):
+                    # cached under self, so that a new string table
+                    # replaces the fragments that refer to the old one
+                    fragments = layer.get_fragments(format_item, b'', self)
+                    for fragment in fragments:
+                        if isinstance(fragment, tuple):
+                            value = record.evaluate(fragment[1])
+                            append(format_item(fragment[0], value))
+                        else:
+                            append(fragment)
+                else:
+                    # format_item(), inlined for the common types
+                    refs = table.refs
+                    for (key, value) in layer:
+                        if callable(value):
+                            value = record.evaluate(value)
+                        kind = type(value)
+                        if kind is str:
+                            data = value.encode('utf-8', 'surrogateescape')
+                            if len(data) < 256:
+                                append((refs.get(key) or ref(key))
+                                       + _short[len(data)] + data)
+                                continue
+                        elif kind is int and _min_i32 <= value <= _max_i32:
+                            append((refs.get(key) or ref(key))
+                                   + b'i' + _i32.pack(value))
+                            continue
+                        append(format_item(key, value))
+            body[3] = _u32.pack(count)
+
+            data = b''.join(body)
+            head = _frame.pack(len(data) + 1, ord('R'))
+            frames = table.frames
+            if frames:
+                stream.write(b''.join(frames) + head + data)
+                # (only now: if the write fails, the next record carries
+                # these definitions instead)
+                table.frames = []
+            else:
+                stream.write(head + data)
+        return None
+
+
+class FormatError(ValueError):
+    pass
+
+
+def read_records(stream: BinaryIO) -> Iterator[Record]:
+    """Decode the records in a binary log, one at a time.
+
+    A truncated frame at the end of the stream (e.g. from a process
+    that was killed while writing) is ignored.
+    """
+    strings: Optional[Dict[int, str]] = None
+    while True:
+        head = stream.read(_frame.size)
+        if len(head) < _frame.size:
+            return
+        (length, kind) = _frame.unpack(head)
+        if strings is None and kind != ord('H'):
+            raise FormatError('not a lolog binary log')
+        body = stream.read(length - 1)
+        if len(body) < length - 1:
+            return
+
+        if kind == ord('H'):
+            if len(body) <= len(MAGIC) or not body.startswith(MAGIC):
+                raise FormatError('not a lolog binary log')
+            if body[len(MAGIC)] > VERSION:
+                raise FormatError(
+                    'unsupported binary log version: {}'
+                    .format(body[len(MAGIC)]))
+            strings = {}
+            continue
+
+        assert strings is not None
+        if kind == ord('S'):
+            (id_,) = _u16.unpack_from(body)
+            strings[id_] = body[2:].decode('utf-8', 'surrogateescape')
+        elif kind == ord('R'):
+            yield _decode_record(body, strings)
+        # other frame types are from a newer version: skip them
+
+
+def _decode_record(body: bytes, strings: Dict[int, str]) -> Record:
+    (time_, level) = _record_head.unpack_from(body)
+    pos = _record_head.size
+
+    def string() -> str:
+        nonlocal pos
+        (value,) = _u16.unpack_from(body, pos)
+        pos += 2
+        if value != NO_ID:
+            try:
+                return strings[value]
+            except KeyError:
+                raise FormatError('undefined string id: {}'.format(value))
+        return text(_u32)
+
+    def text(length: struct.Struct) -> str:
+        nonlocal pos
+        (size,) = length.unpack_from(body, pos)
+        pos += length.size + size
+        return body[pos - size:pos].decode('utf-8', 'surrogateescape')
+
+    name = string()
+    message = string()
+    (count,) = _u32.unpack_from(body, pos)
+    pos += 4
+
+    log_map: List[Tuple[str, Any]] = []
+    for idx in range(count):
+        key = string()
+        kind = body[pos]
+        pos += 1
+        value: Any
+        if kind == ord('s'):
+            value = text(_u8)
+        elif kind == ord('i'):
+            (value,) = _i32.unpack_from(body, pos)
+            pos += 4
+        elif kind == ord('d'):
+            (value,) = _f64.unpack_from(body, pos)
+            pos += 8
+        elif kind == ord('n'):
+            value = None
+        elif kind == ord('t'):
+            value = True
+        elif kind == ord('f'):
+            value = False
+        elif kind == ord('q'):
+            (value,) = _i64.unpack_from(body, pos)
+            pos += 8
+        elif kind == ord('l'):
+            value = text(_u32)
+        elif kind == ord('I'):
+            value = int(text(_u32))
+        elif kind == ord('j'):
+            value = json.loads(text(_u32))
+        else:
+            raise FormatError('unknown value type: {!r}'.format(chr(kind)))
+        log_map.append((key, value))
+
+    return Record(time_, name, Level(level), message, log_map)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog='python -m lolog.binlog',
+        description='Render binary lolog files as text.')
+    parser.add_argument('--format', choices=list(FORMATTER), default='simple',
+                        help='output format (default: simple)')
+    parser.add_argument('--time-format', choices=list(TIME_FORMAT),
+                        default='local',
+                        help='timestamp format (default: local)')
+    parser.add_argument('files', nargs='*', metavar='FILE',
+                        help='binary log files (default: standard input)')
+    args = parser.parse_args(argv)
+
+    config = Config()
+    config.configure(format=args.format, stream=sys.stdout)
+    config.set_time_format(args.time_format)
+
+    for path in args.files or ['-']:
+        try:
+            if path == '-':
+                render(config, sys.stdin.buffer)
+            else:
+                with open(path, 'rb') as infile:
+                    render(config, infile)
+        except (OSError, FormatError) as err:
+            parser.exit(1, '{}: {}\n'.format(path, err))
+
+
+def render(config: Config, stream: BinaryIO) -> None:
+    for record in read_records(stream):
+        config.run_pipeline(record)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,70 @@
+"""ctypes binding for the lolog C library (liblolog.so)
+
+The library is looked for in $LOLOG_LIBRARY, then next to this package
+(where `make liblolog.so` leaves it in a source checkout), then wherever
+the dynamic linker finds "lolog". Importing this module raises OSError if
+it cannot be found.
+"""
+
 import ctypes
+import ctypes.util
+import os
+from typing import Dict
+
+
+def _find_library() -> str:
+    path = os.environ.get('LOLOG_LIBRARY')
+    if path:
+        return path
+    here = os.path.dirname(os.path.abspath(__file__))
+    for path in [os.path.join(here, 'liblolog.so'),
+                 os.path.join(os.path.dirname(here), 'liblolog.so')]:
+        if os.path.exists(path):
+            return path
+    path = ctypes.util.find_library('lolog')
+    if path is None:
+        raise OSError(
+            'cannot find the lolog C library: '
+            'build it with "make liblolog.so", or set LOLOG_LIBRARY')
+    return path
+
+
+lolog = ctypes.CDLL(_find_library())
+libc = ctypes.CDLL(None)
+
+# pointers are returned as integers (or None), never truncated to int
+lolog.lol_make_config.argtypes = [ctypes.c_int, ctypes.c_void_p]
+lolog.lol_make_config.restype = ctypes.c_void_p
+lolog.lol_free_config.argtypes = [ctypes.c_void_p]
+lolog.lol_free_config.restype = None
+lolog.lol_make_logger.argtypes = [ctypes.c_char_p]
+lolog.lol_make_logger.restype = ctypes.c_void_p
+lolog.lol_free_logger.argtypes = [ctypes.c_void_p]
+lolog.lol_free_logger.restype = None
+
+# the C library keeps the name pointers it is given, so keep the strings
+# alive as long as their loggers
+_names: Dict[int, bytes] = {}
+
+
+def make_config(default_level: int) -> int:
+    # the value of libc's stdout (a FILE *), not the address of the variable
+    stdout = ctypes.c_void_p.in_dll(libc, 'stdout')
+    config: int = lolog.lol_make_config(default_level, stdout)
+    return config
+
 
-lolog = ctypes.cdll.LoadLibrary("./liblolog.so")
-libc = ctypes.cdll.LoadLibrary("libc.so.6")
-libc.stdout
+def free_config(config: int) -> None:
+    lolog.lol_free_config(config)
 
 
-def make_config(default_level: int):
-    return lolog.lol_make_config(default_level, libc.stdout)
+def make_logger(name: str) -> int:
+    data = name.encode('ascii')
+    logger: int = lolog.lol_make_logger(data)
+    _names[logger] = data
+    return logger
 
 
-def make_logger(name: str):
-    return lolog.lol_make_logger(name.encode("ascii"))
+def free_logger(logger: int) -> None:
+    lolog.lol_free_logger(logger)
+    _names.pop(logger, None)
@@ -1,18 +1,153 @@
 """intercept calls to the standard logging module"""
 
 import logging
-from typing import Any, Dict, Type
+import sys
+import traceback
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, List, Tuple, Type
 
-from .pylolog import Config, Level
+from .pylolog import Config, Level, Logger
+
+
+# stdlib level number -> lolog level, for the standard numbers and those
+# in between (e.g. 25 is INFO)
+_from_stdlib = [
+    Level.DEBUG if levelno < logging.INFO else
+    Level.INFO if levelno < logging.WARNING else
+    Level.WARNING if levelno < logging.ERROR else
+    Level.ERROR if levelno < logging.CRITICAL else
+    Level.CRITICAL
+    for levelno in range(logging.CRITICAL + 1)]
+
+
+def from_stdlib_level(levelno: int) -> Level:
+    if levelno > logging.CRITICAL:
+        return Level.CRITICAL
+    return _from_stdlib[max(levelno, 0)]
+
+
+_to_stdlib = {
+    Level.NOTSET: logging.NOTSET,
+    Level.DEBUG: logging.DEBUG,
+    Level.INFO: logging.INFO,
+    Level.WARNING: logging.WARNING,
+    Level.ERROR: logging.ERROR,
+    Level.CRITICAL: logging.CRITICAL,
+    Level.SILENT: logging.CRITICAL + 1,
+}
+
+
+def _emit(logger: Logger,
+          level: Level,
+          msg: Any,
+          args: Tuple[Any, ...],
+          kwargs: Dict[str, Any]) -> None:
+    # caller has already checked the level
+    message = str(msg)
+    items: List[Tuple[str, Any]] = []
+    if args:
+        # the same special case as logging.LogRecord
+        if len(args) == 1 and isinstance(args[0], Mapping) and args[0]:
+            args = args[0]          # type: ignore
+        try:
+            message = message % args
+        except (TypeError, ValueError, KeyError):
+            # leave the message alone, and log the args separately
+            items = [('arg%d' % (idx + 1), arg) for (idx, arg) in enumerate(args)]
+
+    exc_info = kwargs.pop('exc_info', None)
+    if exc_info:
+        if isinstance(exc_info, BaseException):
+            exc_info = (type(exc_info), exc_info, exc_info.__traceback__)
+        elif not isinstance(exc_info, tuple):
+            exc_info = sys.exc_info()
+        if exc_info[0] is not None:
+            items.append(('exception',
+                          ''.join(traceback.format_exception(*exc_info))))
+    if kwargs.pop('stack_info', False):
+        items.append(('stack', ''.join(traceback.format_stack()[:-2])))
+    kwargs.pop('stacklevel', None)
+    extra = kwargs.pop('extra', None)
+    if extra:
+        items += extra.items()
+    items += kwargs.items()
+    logger._log(level, message, items)
 
 
 class Interceptor:
+    """Route calls to stdlib loggers through lolog.
+
+    intercept() replaces the logging methods of logger_cls (normally
+    logging.Logger) so that records go to the lolog logger with the same
+    name, and isEnabledFor() and getEffectiveLevel() report lolog's
+    levels, so that guards like `if log.isEnabledFor(DEBUG)` agree with
+    lolog configuration. Filtered calls return before looking at their
+    arguments, and messages are only %-formatted for records that are
+    emitted.
+    """
+
     def __init__(self, cfg: Config, logger_cls: Type):
         self.cfg = cfg
         self.logger_cls = logger_cls
         self.save: Dict[str, Any] = {}
 
     def intercept(self):
+        cfg = self.cfg
+
+        def get_logger(stdlib_logger: logging.Logger) -> Logger:
+            # the lolog logger, cached on the stdlib logger
+            logger = cfg.get_logger(stdlib_logger.name)
+            stdlib_logger._lolog_logger = logger       # type: ignore
+            return logger
+
+        def make_method(level: Level) -> Callable:
+            def method(self, msg, *args, **kwargs):
+                try:
+                    logger = self._lolog_logger
+                except AttributeError:
+                    logger = get_logger(self)
+                if logger.generation != cfg.generation:
+                    logger._update_level()
+                if level < logger.level:
+                    return
+                _emit(logger, level, msg, args, kwargs)
+
+            method.__name__ = level.name.lower()
+            return method
+
+        def log(self, levelno, msg, *args, **kwargs):
+            try:
+                logger = self._lolog_logger
+            except AttributeError:
+                logger = get_logger(self)
+            level = from_stdlib_level(levelno)
+            if level < logger.get_level():
+                return
+            _emit(logger, level, msg, args, kwargs)
+
+        def exception(self, msg, *args, exc_info=True, **kwargs):
+            self.error(msg, *args, exc_info=exc_info, **kwargs)
+
+        def isEnabledFor(self, levelno):
+            try:
+                logger = self._lolog_logger
+            except AttributeError:
+                logger = get_logger(self)
+            return from_stdlib_level(levelno) >= logger.get_level()
+
+        def getEffectiveLevel(self):
+            try:
+                logger = self._lolog_logger
+            except AttributeError:
+                logger = get_logger(self)
+            return _to_stdlib[logger.get_level()]
+
+        methods = {
+            'log': log,
+            'exception': exception,
+            'isEnabledFor': isEnabledFor,
+            'getEffectiveLevel': getEffectiveLevel,
+        }
         for level in [
                 Level.DEBUG,
                 Level.INFO,
@@ -20,21 +155,23 @@ class Interceptor:
                 Level.ERROR,
                 Level.CRITICAL,
         ]:
-            name = level.name
-            lower_name = name.lower()
-            locals = {'cfg': self.cfg, 'Level': level}
-            func_text = """
-def {lower_name}(self, msg, *args, **kwargs):
-    items = [("arg%d" % (i + 1), arg) for (i, arg) in enumerate(args)]
-    items += kwargs.items()
-    cfg.get_logger(self.name)._log(Level.{name}, msg, items)
-""".format(name=name, lower_name=lower_name)
+            methods[level.name.lower()] = make_method(level)
+        methods['fatal'] = methods['critical']
 
-            exec(func_text, locals, locals)
-            self.save[lower_name] = getattr(logging.Logger, lower_name)
-            setattr(logging.Logger, lower_name, locals[lower_name])
+        for (name, method) in methods.items():
+            self.save[name] = self.logger_cls.__dict__.get(name)
+            setattr(self.logger_cls, name, method)
 
     def undo(self):
         for (name, method) in self.save.items():
-            setattr(logging.Logger, name, method)
+            if method is None:
+                delattr(self.logger_cls, name)
+            else:
+                setattr(self.logger_cls, name, method)
         self.save.clear()
+
+        # forget cached lolog loggers, in case we intercept again with a
+        # different config
+        manager = logging.Logger.manager
+        for stdlib_logger in [manager.root, *manager.loggerDict.values()]:
+            stdlib_logger.__dict__.pop('_lolog_logger', None)
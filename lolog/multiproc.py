@@ -0,0 +1,191 @@
+"""collect log records from forked worker processes in the parent
+
+Intended for pre-fork servers, where many worker processes would
+otherwise all format log records and write them to the same stream:
+
+    cfg = lolog.init(format="json", stream=sys.stdout)
+    collector = lolog.multiproc.Collector(cfg)
+    collector.start()
+    ...fork workers...
+
+In every process forked after start(), the pipeline gets a new first stage
+that sends each record (time, name, level, message, and log map, with
+callable values already called) to the parent over a Unix datagram
+socket, and then drops it. A thread in the parent runs its own pipeline
+on the records it receives, so formatting and output happen in just one
+place, and lines from different workers never interleave.
+
+If a record is too big to send, the worker runs the rest of its own
+pipeline on that record instead. Sending never blocks: if the parent is
+not keeping up, the worker emits its own records for the next backoff
+seconds before it tries to forward again. If the collector has gone away
+completely, workers stop forwarding and go back to formatting and
+writing their own logs.
+"""
+
+import atexit
+import os
+import pickle
+import socket
+import threading
+import time
+from typing import Optional
+
+from .pylolog import Config, Level, Record, _fork_handlers
+
+
+# types that can be sent as-is; anything else is sent as str(value) if
+# pickling it fails
+_plain_types = (str, int, float, bool, type(None))
+
+
+class Collector:
+    def __init__(self,
+                 config: Config,
+                 max_size: int = 65536,
+                 backoff: float = 1.0):
+        self.config = config
+        self.max_size = max_size
+        self.backoff = backoff
+
+        # the parent process: the one that called start()
+        self.pid: Optional[int] = None
+        self.recv_sock: Optional[socket.socket] = None
+        self.send_sock: Optional[socket.socket] = None
+        self.thread: Optional[threading.Thread] = None
+
+        # number of records received that could not be emitted
+        self.errors = 0
+
+    def start(self) -> None:
+        """Start collecting records from processes forked after this."""
+        if self.thread is not None:
+            raise RuntimeError('lolog collector already started')
+        (self.recv_sock, self.send_sock) = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.pid = os.getpid()
+        self.thread = threading.Thread(
+            target=self._run, name='lolog-collector', daemon=True)
+        self.thread.start()
+        _fork_handlers.add(self)
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """Emit every record received so far, and stop collecting.
+
+        Workers that log after this go back to emitting records
+        themselves.
+        """
+        thread = self.thread
+        if thread is None or self.pid != os.getpid():
+            return
+        assert self.send_sock is not None and self.recv_sock is not None
+
+        # an empty datagram tells the collector thread to quit, after
+        # everything already queued
+        self.send_sock.send(b'')
+        thread.join()
+        self.thread = None
+        self.recv_sock.close()
+        self.send_sock.close()
+
+    def _after_fork(self) -> None:
+        # in the child process: become a worker, unless this process is
+        # already a worker (in which case the forwarding stage inherited
+        # from our parent is fine as it is)
+        if self.thread is None or self.pid is None:
+            return
+        assert self.send_sock is not None and self.recv_sock is not None
+        self.thread = None
+        self.pid = None
+
+        # close our copy of the receiving end, so that sends fail as soon
+        # as the parent's copy is closed
+        self.recv_sock.close()
+        self.config.insert_stage(0, ForwardStage(self, self.send_sock))
+
+    def _run(self) -> None:
+        assert self.recv_sock is not None
+        config = self.config
+        recv = self.recv_sock.recv
+        max_size = self.max_size
+        while True:
+            data = recv(max_size)
+            if not data:
+                return
+            try:
+                (time_, name, level, message, log_map) = pickle.loads(data)
+                config.run_pipeline(
+                    Record(time_, name, Level(level), message, log_map))
+            except Exception:
+                self.errors += 1
+
+
+class ForwardStage:
+    """Pipeline stage that sends records to a Collector in the parent.
+
+    Records that are sent are dropped; any others continue through the
+    rest of the local pipeline.
+    """
+
+    def __init__(self, collector: Collector, sock: socket.socket):
+        self.collector = collector
+        self.sock = sock
+        self.max_size = collector.max_size
+        self.backoff = collector.backoff
+
+        # number of records emitted locally because they could not be sent
+        self.local = 0
+
+        # while the collector is not keeping up: when to try again
+        self.retry_at = 0.0
+
+    def __call__(self, config: Config, record: Record) -> Optional[Record]:
+        if self.retry_at:
+            if time.monotonic() < self.retry_at:
+                self.local += 1
+                return record
+            self.retry_at = 0.0
+
+        data = self.encode(record)
+        if len(data) > self.max_size:
+            self.local += 1
+            return record
+
+        # (the socket itself stays blocking: its file description is
+        # shared with the parent, which needs a blocking send in stop())
+        try:
+            self.sock.send(data, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            # the collector is alive but not keeping up: don't wait for
+            # it, and leave it alone for a while
+            self.local += 1
+            self.retry_at = time.monotonic() + self.backoff
+            return record
+        except OSError:
+            # the collector is gone: stop forwarding for good
+            self.local += 1
+            self.detach(config)
+            return record
+        return None
+
+    def encode(self, record: Record) -> bytes:
+        log_map = [(key, record.evaluate(value) if callable(value) else value)
+                   for (key, value) in record.log_map]
+        header = (record.time, record.name, int(record.level), record.message)
+        try:
+            return pickle.dumps((*header, log_map), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            pass
+
+        # some value cannot be pickled: send it as a string, which is what
+        # the simple formatter would have done with it anyway
+        log_map = [
+            (key, value if isinstance(value, _plain_types) else str(value))
+            for (key, value) in log_map]
+        return pickle.dumps((*header, log_map), pickle.HIGHEST_PROTOCOL)
+
+    def detach(self, config: Config) -> None:
+        if self in config.pipeline:
+            config.pipeline.remove(self)
+        self.sock.close()
@@ -2,16 +2,27 @@
 
 from __future__ import annotations
 
+import atexit
+import collections
+import contextlib
 import contextvars
 import enum
 import fnmatch
+import importlib
+import itertools
 import json
+import math
+import mmap
+import os
 import re
+import struct
 import sys
 import threading
 import time
 import typing as ty
-from typing import ClassVar, Optional, Any, Callable, Iterable, Dict, List, Tuple, TextIO
+import weakref
+from json.encoder import encode_basestring_ascii
+from typing import ClassVar, Optional, Any, Callable, Dict, List, Tuple, TextIO
 
 
 class Level(enum.IntEnum):
@@ -27,12 +38,323 @@ class Level(enum.IntEnum):
 StageType = Callable[["Config", "Record"], Optional["Record"]]
 LogMap = List[Tuple[str, Any]]
 
+# formatted log map: runs of already-formatted static items (str), and
+# dynamic items (key, callable) that must be formatted for each record
+Fragments = List[ty.Union[str, Tuple[str, Callable[[], Any]]]]
 
-# list of (key, value) tuples -- but a different list per thread/task/
-# greenlet/whatever concurrency abstraction is at play, as long as it works
-# with contextvars!
-_local_log_map: contextvars.ContextVar[LogMap]
-_local_log_map = contextvars.ContextVar('local_log_map')
+
+_T = ty.TypeVar('_T')
+_WatchedListT = ty.TypeVar('_WatchedListT', bound='_WatchedList[Any]')
+
+
+class _WatchedList(List[_T]):
+    """A list that calls self._changed() after every modification."""
+
+    __slots__ = ()
+
+    def _changed(self) -> None:
+        raise NotImplementedError
+
+    def append(self, item: _T) -> None:
+        super().append(item)
+        self._changed()
+
+    def extend(self, items: ty.Iterable[_T]) -> None:
+        super().extend(items)
+        self._changed()
+
+    def insert(self, index: ty.SupportsIndex, item: _T) -> None:
+        super().insert(index, item)
+        self._changed()
+
+    def __setitem__(self, index: Any, value: Any) -> None:
+        super().__setitem__(index, value)
+        self._changed()
+
+    def __delitem__(self, index: Any) -> None:
+        super().__delitem__(index)
+        self._changed()
+
+    def __iadd__(                                           # type: ignore
+            self: _WatchedListT, items: Any) -> _WatchedListT:
+        super().__iadd__(items)
+        self._changed()
+        return self
+
+    def __imul__(self: _WatchedListT,
+                 count: ty.SupportsIndex) -> _WatchedListT:
+        super().__imul__(count)
+        self._changed()
+        return self
+
+    def pop(self, index: ty.SupportsIndex = -1) -> _T:
+        item = super().pop(index)
+        self._changed()
+        return item
+
+    def remove(self, item: _T) -> None:
+        super().remove(item)
+        self._changed()
+
+    def clear(self) -> None:
+        super().clear()
+        self._changed()
+
+    def sort(self, *args: Any, **kwargs: Any) -> None:
+        super().sort(*args, **kwargs)
+        self._changed()
+
+    def reverse(self) -> None:
+        super().reverse()
+        self._changed()
+
+
+class LogMapLayer(_WatchedList[Tuple[str, Any]]):
+    """A log map that caches its own formatted form.
+
+    Used for log map values that (almost) never change: the global and
+    per-logger log maps. Each formatter formats a layer just once, until
+    the layer is next modified. Callable values are still called (once,
+    see Record.evaluate()) and formatted for every record.
+
+    Config and Logger do not modify their layers in place: add_value()
+    replaces the layer with an extended copy, so that records keep the
+    values that were current when they were created.
+
+    Note that non-callable values are formatted just once, so they should
+    not be mutable objects that change over time. Use a callable for that.
+    """
+
+    __slots__ = ('_cache',)
+
+    def __init__(self, *args: Any):
+        super().__init__(*args)
+
+        # formatter's format_item function -> Fragments, or owner ->
+        # (format_item, Fragments), plus None -> list of keys
+        self._cache: Dict[Any, Any] = {}
+
+    def _changed(self) -> None:
+        # replace rather than clear: a formatter that is concurrently
+        # building fragments from the old contents caches them in the
+        # old dict, which nobody will look at again
+        self._cache = {}
+
+    def get_fragments(self,
+                      format_item: Callable[[str, Any], Any],
+                      empty: Any = '',
+                      owner: Any = None) -> Fragments:
+        """Return this layer formatted by format_item(key, value).
+
+        Runs of static items are joined with empty.join(): pass b'' for
+        a format_item that returns bytes.
+
+        Fragments are cached under format_item, or under owner if given:
+        then only the fragments of the latest format_item are kept, for
+        callers whose format_item changes over time (e.g. a bound method
+        of a state object that gets replaced).
+        """
+        cache = self._cache
+        if owner is None:
+            try:
+                return ty.cast(Fragments, cache[format_item])
+            except KeyError:
+                pass
+        else:
+            entry = cache.get(owner)
+            if entry is not None and entry[0] == format_item:
+                return ty.cast(Fragments, entry[1])
+
+        fragments: Fragments = []
+        run: List[Any] = []
+        for (key, value) in self:
+            if callable(value):
+                if run:
+                    fragments.append(empty.join(run))
+                    run = []
+                fragments.append((key, value))
+            else:
+                run.append(format_item(key, value))
+        if run:
+            fragments.append(empty.join(run))
+
+        if owner is None:
+            cache[format_item] = fragments
+        else:
+            cache[owner] = (format_item, fragments)
+        return fragments
+
+    def get_keys(self) -> List[str]:
+        cache = self._cache
+        try:
+            return ty.cast(List[str], cache[None])
+        except KeyError:
+            keys = cache[None] = [key for (key, value) in self]
+            return keys
+
+
+# characters that make a logger pattern more than a plain name
+_glob_chars = re.compile(r'[*?[]')
+
+
+class _TrieNode:
+    __slots__ = ('children', 'exact', 'more')
+
+    def __init__(self) -> None:
+        self.children: Dict[str, _TrieNode] = {}
+
+        # (index, level) of the first pattern that matches exactly the
+        # name components leading to this node, and of the first that
+        # matches them followed by more components
+        self.exact: Optional[Tuple[int, Level]] = None
+        self.more: Optional[Tuple[int, Level]] = None
+
+
+def _trie_node(trie: _TrieNode, parts: List[str]) -> _TrieNode:
+    node = trie
+    for part in parts:
+        child = node.children.get(part)
+        if child is None:
+            child = node.children[part] = _TrieNode()
+        node = child
+    return node
+
+
+def _trie_match(trie: _TrieNode,
+                parts: List[str],
+                best: Optional[Tuple[int, Level]]) -> Optional[Tuple[int, Level]]:
+    # return the earliest of best and the patterns in trie that match parts
+    node = trie
+    for part in parts:
+        if node.more is not None and (best is None or node.more < best):
+            best = node.more
+        child = node.children.get(part)
+        if child is None:
+            return best
+        node = child
+    if node.exact is not None and (best is None or node.exact < best):
+        best = node.exact
+    return best
+
+
+class PatternMatcher:
+    """Find the first of many fnmatch patterns that matches a logger name.
+
+    Plain names and "prefix.*" patterns go in a trie of dotted name
+    components, "*.suffix" patterns in a trie of the components in
+    reverse, and all other patterns are combined into one regex. So the
+    cost of match() depends on the length of the name and on the number
+    of other patterns, but not on the number of names, prefixes or
+    suffixes. As with a linear search, the pattern added first wins.
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.prefixes = _TrieNode()
+        self.suffixes = _TrieNode()
+
+        # (index, level) of the first "*" pattern
+        self.any: Optional[Tuple[int, Level]] = None
+
+        # (index, level) of other patterns, and the combined regex for
+        # them, compiled on first use
+        self.globs: List[Tuple[int, Level]] = []
+        self.glob_sources: List[str] = []
+        self.regex: Optional[re.Pattern] = None
+
+    def add(self, pattern: str, level: Level) -> None:
+        entry = (self.count, level)
+        self.count += 1
+        if pattern == '*':
+            if self.any is None:
+                self.any = entry
+        elif not _glob_chars.search(pattern):
+            node = _trie_node(self.prefixes, pattern.split('.'))
+            if node.exact is None:
+                node.exact = entry
+        elif pattern.endswith('.*') and not _glob_chars.search(pattern[:-2]):
+            node = _trie_node(self.prefixes, pattern[:-2].split('.'))
+            if node.more is None:
+                node.more = entry
+        elif pattern.startswith('*.') and not _glob_chars.search(pattern[2:]):
+            node = _trie_node(self.suffixes, pattern[2:].split('.')[::-1])
+            if node.more is None:
+                node.more = entry
+        else:
+            # a named group per pattern, so that lastgroup tells which one
+            # matched (fnmatch.translate() may add groups of its own)
+            self.glob_sources.append('(?P<p{}>{})'.format(
+                len(self.globs), fnmatch.translate(pattern)))
+            self.globs.append(entry)
+            self.regex = None
+
+    def match(self, name: str) -> Optional[Level]:
+        """Return the level for the first pattern that matches name."""
+        if not self.count:
+            return None
+        parts = name.split('.')
+        best = _trie_match(self.prefixes, parts, self.any)
+        best = _trie_match(self.suffixes, parts[::-1], best)
+
+        if self.globs:
+            regex = self.regex
+            if regex is None:
+                regex = self.regex = re.compile('|'.join(self.glob_sources))
+
+            # alternatives are tried in order, so this is the first glob
+            # that matches
+            match = regex.match(name)
+            if match:
+                assert match.lastgroup is not None
+                entry = self.globs[int(match.lastgroup[1:])]
+                if best is None or entry < best:
+                    best = entry
+
+        return None if best is None else best[1]
+
+
+# local log map: a tuple of layers, one per bind() (innermost last) --
+# but a different tuple per thread/task/greenlet/whatever concurrency
+# abstraction is at play, as long as it works with contextvars!
+#
+# Neither the tuple nor its layers are ever modified, only replaced, so a
+# task that copied its context from another can never see the other's
+# changes, and each layer caches its formatted form for as long as it is
+# bound.
+LocalLayers = Tuple[LogMapLayer, ...]
+_local_log_map: contextvars.ContextVar[LocalLayers]
+_local_log_map = contextvars.ContextVar('local_log_map', default=())
+
+
+# objects with an _after_fork() method, to call in the child process after
+# os.fork(): locks and threads do not survive fork, so anything that uses
+# them has to start over
+_fork_handlers: weakref.WeakSet[ty.Any] = weakref.WeakSet()
+
+
+def _after_fork() -> None:
+    # the forking thread's local log map belongs to whatever it was doing
+    # in the parent (e.g. handling a request), not to the child
+    _local_log_map.set(())
+    for obj in list(_fork_handlers):
+        obj._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class Pipeline(_WatchedList[StageType]):
+    """The stages of a Config: changing them recompiles its pipeline."""
+
+    __slots__ = ('_config',)
+
+    def __init__(self, config: Config, stages: ty.Iterable[StageType] = ()):
+        super().__init__(stages)
+        self._config = config
+
+    def _changed(self) -> None:
+        self._config.compile_pipeline()
 
 
 class Config:
@@ -40,33 +362,69 @@ class Config:
     _instance: ClassVar[Optional[Config]] = None
 
     mutex: threading.Lock
-    log_map: LogMap
+    log_map: LogMapLayer
     default_level: Level
     logger_level: Dict[str, Level]
-    logger_patterns: List[Tuple[re.Pattern, Level]]
+    pattern_matcher: PatternMatcher
     stream: Optional[TextIO]
-    pipeline: List[StageType]
+    _pipeline: Pipeline
     logger: Dict[str, Logger]
     time: Callable[[], float]
 
+    # generated from pipeline by compile_pipeline()
+    run_pipeline: Callable[[Record], None]
+    pipeline_source: str
+
+    # true if no stage can keep a record once run_pipeline() returns, so
+    # loggers may reuse it (the built-in formatters and outputs keep
+    # formatted text, not records)
+    recycle_records: bool
+
+    # counters updated by run_pipeline(), if enabled by set_stats()
+    pipeline_stats: Optional[PipelineStats]
+
+    # bumped whenever level configuration changes, so loggers know when
+    # their cached effective level is stale
+    generation: int
+
+    # if true, loggers replace their disabled log methods with a no-op
+    rebind_methods: bool
+
     def __init__(self):
         self.mutex = threading.Lock()
-        self.log_map = []
+        self.log_map = LogMapLayer()
         self.default_level = Level.NOTSET
         self.logger_level = {}
-        self.logger_patterns = []
+        self.pattern_matcher = PatternMatcher()
         self.stream = None
-        self.pipeline = []
+        self._pipeline = Pipeline(self)
         self.logger = {}
         self.time = time.time
+        self.generation = 0
+        self.rebind_methods = False
+        self.pipeline_stats = None
+        self.compile_pipeline()
+
+        # (second, tzname, formatted second) for format_time_local(), and
+        # (second, formatted second) for format_time_utc(): each replaced
+        # as a whole, so that threads never see a torn update
+        self._local_time_cache: Tuple[Optional[int], Any, str] = (None, None, '')
+        self._utc_time_cache: Tuple[Optional[int], str] = (None, '')
+
+        _fork_handlers.add(self)
+
+    def _after_fork(self) -> None:
+        # some other thread might have held the lock when we forked
+        self.mutex = threading.Lock()
 
     def configure(
             self,
             level: Level = Level.DEBUG,
             format: ty.Union[str, StageType] = "simple",
             stream: TextIO = sys.stderr,
+            output: ty.Union[str, StageType] = "stream",
     ) -> None:
-        self.default_level = level
+        self.set_default_level(level)
 
         # setup the pipeline
         if isinstance(format, str):
@@ -80,55 +438,116 @@ class Config:
 
         if stream is not None:
             self.stream = stream
-            self.add_stage(output_stream)
+            if isinstance(output, str):
+                if output not in OUTPUT:
+                    raise ValueError('unsupported output: {!r}'.format(output))
+                self.add_stage(OUTPUT[output]())
+            elif callable(output):
+                self.add_stage(output)
+            else:
+                raise TypeError('unsupported output: must be str or callable')
 
     def set_default_level(self, level: Level) -> None:
-        self.default_level = level
+        with self.mutex:
+            self.default_level = level
+            self._levels_changed()
 
     def add_value(self, key: str, value: Any) -> None:
-        self.log_map.append((key, value))
+        # copy-on-write: existing records keep the layer they were
+        # created with
+        with self.mutex:
+            self.log_map = LogMapLayer([*self.log_map, (key, value)])
 
     def add_local_value(self, key: str, value: Any) -> None:
+        # copy-on-write of the innermost layer, which is dropped with it at
+        # the end of the enclosing bind() (if any)
+        local = _local_log_map.get()
+        if local:
+            layer = LogMapLayer([*local[-1], (key, value)])
+            _local_log_map.set((*local[:-1], layer))
+        else:
+            _local_log_map.set((LogMapLayer([(key, value)]),))
+
+    @contextlib.contextmanager
+    def bind(self, **kwargs: Any) -> ty.Iterator[None]:
+        """Add local values for the duration of a with block.
+
+        The values are added for the current thread or task only (and
+        tasks that it creates), and removed on exit, along with any local
+        values added inside the block.
+        """
+        local = _local_log_map.get()
+        _local_log_map.set((*local, LogMapLayer(kwargs.items())))
         try:
-            local = _local_log_map.get()
-        except LookupError:
-            local = []
+            yield
+        finally:
             _local_log_map.set(local)
-        local.append((key, value))
 
-    def get_log_map(self) -> LogMap:
+    def get_log_map(self) -> LogMapLayer:
         return self.log_map
 
+    def get_local_layers(self) -> LocalLayers:
+        return _local_log_map.get()
+
     def get_local_log_map(self) -> LogMap:
-        try:
-            return _local_log_map.get()
-        except LookupError:
-            return []
+        return [item for layer in _local_log_map.get() for item in layer]
 
     def clear_local_log_map(self) -> None:
-        _local_log_map.set([])
+        _local_log_map.set(())
 
     def set_logger_level(self, name: str, level: Level) -> None:
-        self.logger_level[name] = level
+        with self.mutex:
+            self.logger_level[name] = level
+            self._levels_changed()
 
     def set_logger_pattern_level(self, pattern: str, level: Level) -> None:
-        regex = re.compile(fnmatch.translate(pattern))
-        self.logger_patterns.append((regex, level))
+        with self.mutex:
+            self.pattern_matcher.add(pattern, level)
+            self._levels_changed()
+
+    def set_rebind_methods(self, enabled: bool) -> None:
+        """Enable or disable method rebinding on all loggers.
+
+        When enabled, each logger replaces the methods for disabled levels
+        (e.g. log.debug() when its level is INFO) with a shared no-op, so
+        that filtered-out calls never reach Logger._log(). Loggers are
+        rebound every time level configuration changes.
+        """
+        with self.mutex:
+            self.rebind_methods = enabled
+            self.generation += 1
+            self._update_loggers()
+
+    def _levels_changed(self) -> None:
+        # caller must hold self.mutex
+        self.generation += 1
+        if self.rebind_methods:
+            # a rebound method never reaches _log(), so it will never
+            # notice that its cached level is stale: update eagerly
+            self._update_loggers()
+
+    def _update_loggers(self) -> None:
+        # caller must hold self.mutex
+        for logger in self.logger.values():
+            logger._resolve_level()
 
     def get_logger_level(self, name: str) -> Level:
         if name in self.logger_level:
             # this logger has been explicitly configured
             return self.logger_level[name]
 
-        # search for a matching pattern
-        for (regex, level) in self.logger_patterns:
-            if regex.match(name):
-                return level
-        else:
-            # fallback to default
-            return self.default_level
+        # search for a matching pattern, or fallback to default
+        level = self.pattern_matcher.match(name)
+        return self.default_level if level is None else level
+
+    @property
+    def pipeline(self) -> Pipeline:
+        return self._pipeline
 
-        return self.logger_level.get(name, self.default_level)
+    @pipeline.setter
+    def pipeline(self, stages: ty.Iterable[StageType]) -> None:
+        self._pipeline = Pipeline(self, stages)
+        self.compile_pipeline()
 
     def insert_stage(self, before_idx: int, stage: StageType) -> None:
         self.pipeline.insert(before_idx, stage)
@@ -136,45 +555,374 @@ class Config:
     def add_stage(self, stage: StageType) -> None:
         self.pipeline.append(stage)
 
+    def compile_pipeline(self) -> None:
+        """Generate run_pipeline() from the current list of stages.
+
+        run_pipeline(record) calls each stage in turn, stopping when a
+        stage returns None -- but skips that check after built-in stages
+        that never drop records, and inlines output_stream(). If stats
+        are enabled, it also updates the counters reported by stats().
+
+        Any change to the pipeline list, or assigning a new list to
+        pipeline, calls this automatically.
+        The generated source is kept in pipeline_source, for debugging.
+        """
+        namespace: Dict[str, Any] = {'config': self}
+        body = []
+        pstats = self.pipeline_stats
+        if pstats is not None:
+            pstats.records = 0
+            pstats.stages = []
+            namespace.update(
+                pstats=pstats,
+                sample_every=pstats.sample_every,
+                perf_counter=time.perf_counter)
+            body.append('    pstats.records += 1\n'
+                        '    sample = not pstats.records % sample_every\n')
+
+        recycle = True
+        for (idx, stage) in enumerate(self.pipeline):
+            name = 'stage{}'.format(idx)
+            inline = stage is output_stream
+            output = inline or isinstance(stage, _OUTPUT_STAGES)
+            drops = not (output or stage in _FORMATTER_STAGES)
+            recycle = recycle and not drops
+            if inline:
+                call = _OUTPUT_STREAM_SOURCE
+            else:
+                namespace[name] = stage
+                call = '    {}{}(config, record)\n'.format(
+                    'record = ' if drops else '', name)
+
+            if pstats is None:
+                body.append(call)
+                if drops:
+                    body.append('    if record is None:\n'
+                                '        return\n')
+                continue
+
+            stats = 'stats{}'.format(idx)
+            namespace[stats] = StageStats(stage, output)
+            pstats.stages.append(namespace[stats])
+            body.append('    {}.calls += 1\n'.format(stats))
+            if output:
+                body.append('    {}.bytes += sum(map(len, record.outbuf))\n'
+                            .format(stats))
+            body.append('    if sample:\n'
+                        '        start = perf_counter()\n')
+            body.append(call)
+            body.append('    if sample:\n'
+                        '        {}.add_sample(perf_counter() - start)\n'
+                        .format(stats))
+            if drops:
+                body.append('    if record is None:\n'
+                            '        {}.dropped += 1\n'
+                            '        return\n'.format(stats))
+
+        # bind everything as default arguments, so they are fast locals
+        source = 'def run_pipeline(record, {}):\n{}'.format(
+            ', '.join('{0}={0}'.format(name) for name in namespace),
+            ''.join(body) or '    pass\n')
+        exec(source, namespace)
+        self.run_pipeline = namespace['run_pipeline']
+        self.pipeline_source = source
+        self.recycle_records = recycle
+
+    def set_stats(self, enabled: bool, sample_every: int = 100) -> None:
+        """Enable or disable pipeline instrumentation.
+
+        When enabled, the pipeline counts calls and dropped records for
+        each stage, and bytes written by output stages. It times every
+        sample_every'th record through every stage (the time of an output
+        stage is its write latency), and uses those samples to estimate
+        total time and percentiles. Counters are reset whenever the
+        pipeline is recompiled. See stats().
+
+        Counters are not protected by a lock, so with many threads, they
+        may be slightly low. When disabled, there is no overhead at all.
+        """
+        if enabled:
+            self.pipeline_stats = PipelineStats(sample_every)
+        else:
+            self.pipeline_stats = None
+        self.compile_pipeline()
+
+    def stats(self) -> Optional[Dict[str, Any]]:
+        """Return a snapshot of pipeline statistics, or None if disabled.
+
+        The snapshot is a dict like:
+
+          {'records': 1000,
+           'sample_every': 100,
+           'stages': [
+             {'stage': 'format_simple',
+              'calls': 1000,
+              'dropped': 0,
+              'time_total': 0.0042,
+              'time_p50': 4.1e-06,
+              'time_p90': 4.9e-06,
+              'time_p99': 8.3e-06,
+              'time_max': 8.3e-06},
+             {'stage': 'output_stream',
+              'calls': 1000,
+              'bytes': 67000,
+              ...},
+           ]}
+
+        Times are in seconds, and bytes are really characters.
+        """
+        pstats = self.pipeline_stats
+        if pstats is None:
+            return None
+        return pstats.snapshot()
+
     def get_logger(self, name: str) -> Logger:
         with self.mutex:
             if name not in self.logger:
-                self.logger[name] = Logger(self, name)
+                logger = self.logger[name] = Logger(self, name)
+                if self.rebind_methods:
+                    logger._resolve_level()
             return self.logger[name]
 
-    def format_time(self, time_: float) -> str:
-        return (time.strftime('%FT%T', time.localtime(time_)) +
-                '{:06f}'.format(time_ % 1)[1:])
+    def set_time_format(self, time_format: str) -> None:
+        """Select how format_time() renders timestamps.
+
+        time_format is one of:
 
+          * "local": local time, ISO 8601 without zone (the default)
+          * "utc": UTC, ISO 8601 with a "Z" suffix
+          * "epoch_ns": integer nanoseconds since the POSIX epoch
+        """
+        if time_format not in TIME_FORMAT:
+            raise ValueError('unsupported time format: {!r}'.format(time_format))
+        self.format_time = getattr(self, TIME_FORMAT[time_format])   # type: ignore
+
+    def format_time_local(self, time_: float) -> str:
+        # localtime() and strftime() are expensive, so only call them once
+        # per second. The cache is keyed on time.tzname too, which is
+        # replaced every time time.tzset() is called.
+        seconds = math.floor(time_)
+        tzname = time.tzname
+        (cached_seconds, cached_tzname, prefix) = self._local_time_cache
+        if seconds != cached_seconds or tzname is not cached_tzname:
+            prefix = time.strftime('%FT%T', time.localtime(seconds))
+            self._local_time_cache = (seconds, tzname, prefix)
+        return prefix + ('%f' % (time_ % 1))[1:]
+
+    def format_time_utc(self, time_: float) -> str:
+        seconds = math.floor(time_)
+        (cached_seconds, prefix) = self._utc_time_cache
+        if seconds != cached_seconds:
+            prefix = time.strftime('%FT%T', time.gmtime(seconds))
+            self._utc_time_cache = (seconds, prefix)
+        return prefix + ('%f' % (time_ % 1))[1:] + 'Z'
+
+    def format_time_epoch_ns(self, time_: float) -> str:
+        # a float only has microsecond precision for current timestamps:
+        # don't pretend otherwise
+        return str(round(time_ * 1_000_000) * 1000)
+
+    format_time = format_time_local
+
+
+Layers = Tuple[ty.Collection[Tuple[str, Any]], ...]
+
+
+class Record:
+    """One log message on its way through the pipeline.
+
+    Stages should treat records as immutable, and use replace() to derive
+    a modified copy: attributes can be assigned, but other stages (e.g.
+    a queue consumer) may already hold the same record. The exception is
+    log_map, which a stage may modify in place (see get_layers()).
+
+    Record used to be a NamedTuple, and still supports the tuple API:
+    indexing, unpacking (time, name, level, message, log_map, outbuf,
+    layers), _fields and _replace().
+
+    Loggers create records from layers of log map (global, one per
+    local bind(), per-logger, and per-message), which are only merged
+    into a single log_map list if something asks for it. So a record that
+    is dropped early in the pipeline costs very little, and formatters can
+    reuse the cached formatted form of static layers (see LogMapLayer).
+    """
+
+    __slots__ = ('time', 'name', 'level', 'message', 'outbuf', 'layers',
+                 '_log_map', '_values')
+
+    _fields = ('time', 'name', 'level', 'message', 'log_map', 'outbuf')
+
+    # the NamedTuple fields: layers is just another form of log_map, so
+    # it is not compared or shown by repr()
+    _tuple_fields = _fields + ('layers',)
 
-class Record(ty.NamedTuple):
     time: float
     name: str
     level: Level
     message: str
-    log_map: LogMap
     outbuf: List[str]
+    layers: Optional[Layers]
+    _log_map: Optional[LogMap]
+    _values: Optional[Dict[int, Any]]
+
+    def __init__(self,
+                 time: float,
+                 name: str,
+                 level: Level,
+                 message: str,
+                 log_map: Optional[LogMap] = None,
+                 outbuf: Optional[List[str]] = None,
+                 layers: Optional[Layers] = None):
+        self.time = time
+        self.name = name
+        self.level = level
+        self.message = message
+        self.outbuf = [] if outbuf is None else outbuf
+        self.layers = layers
+        if log_map is None and layers is None:
+            log_map = []
+        self._log_map = log_map
+        self._values = None
+
+    def __repr__(self) -> str:
+        return '{}({})'.format(
+            self.__class__.__name__,
+            ', '.join('{}={!r}'.format(field, getattr(self, field))
+                      for field in self._fields))
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Record):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field)
+                   for field in self._fields)
+
+    __hash__ = None     # type: ignore
+
+    def __len__(self) -> int:
+        return len(self._tuple_fields)
+
+    def __iter__(self) -> ty.Iterator[Any]:
+        return (getattr(self, field) for field in self._tuple_fields)
+
+    def __getitem__(self, index: Any) -> Any:
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        return getattr(self, self._tuple_fields[index])
+
+    @property
+    def log_map(self) -> LogMap:
+        log_map = self._log_map
+        if log_map is None:
+            assert self.layers is not None
+            log_map = self._log_map = [
+                item for layer in self.layers for item in layer]
+        return log_map
+
+    def get_layers(self) -> Layers:
+        """Return the log map as a sequence of layers, without merging.
+
+        If log_map has already been merged, it is the only layer: a stage
+        that looked at it might also have modified it.
+        """
+        log_map = self._log_map
+        if log_map is None:
+            assert self.layers is not None
+            return self.layers
+        return (log_map,)
+
+    def evaluate(self, func: Callable[[], Any]) -> Any:
+        """Return the value of a callable log map value for this record.
+
+        func is only called once per record, however many formatters ask
+        for it, so they all see the same value.
+        """
+        values = self._values
+        if values is None:
+            values = self._values = {}
+        try:
+            return values[id(func)]
+        except KeyError:
+            value = values[id(func)] = func()
+            return value
 
     def get_items(self) -> LogMap:
         items = [
             ('name', self.name),
             ('level', self.level.name),
         ]
-        for (key, value) in self.log_map:
-            if callable(value):
-                value = value()
-            items.append((key, value))
+        for layer in self.get_layers():
+            for (key, value) in layer:
+                if callable(value):
+                    value = self.evaluate(value)
+                items.append((key, value))
         return items
 
     def replace(self, **kwargs: Any) -> Record:
-        return self._replace(**kwargs)
+        if 'log_map' not in kwargs:
+            kwargs['log_map'] = self._log_map
+            kwargs.setdefault('layers', self.layers)
+        for field in ('time', 'name', 'level', 'message', 'outbuf'):
+            if field not in kwargs:
+                kwargs[field] = getattr(self, field)
+        return Record(**kwargs)
+
+    _replace = replace
+
+    def _asdict(self) -> Dict[str, Any]:
+        return dict(zip(self._tuple_fields, self))
+
+
+class Cached:
+    """Callable log map value that is expensive to compute.
+
+    Every callable value is only called once per record (see
+    Record.evaluate()), but with a ttl, the value is also reused for
+    records in the next ttl seconds, so that e.g. reading memory usage
+    from a file costs one read per ttl, not one per line:
+
+        cfg.add_value('mem', Cached(read_memory_usage, ttl=5.0))
+
+    Use ttl=math.inf for values that never change once computed.
+    """
+
+    __slots__ = ('func', 'ttl', '_cache')
+
+    def __init__(self, func: Callable[[], Any], ttl: Optional[float] = None):
+        self.func = func
+        self.ttl = ttl
+
+        # (value, monotonic expiry time), replaced as a whole so that
+        # threads never see a value with the wrong expiry time; threads
+        # that find it expired at the same time may both call func
+        self._cache: Optional[Tuple[Any, float]] = None
+
+    def __call__(self) -> Any:
+        ttl = self.ttl
+        if ttl is None:
+            return self.func()
+        now = time.monotonic()
+        cache = self._cache
+        if cache is not None and now < cache[1]:
+            return cache[0]
+        value = self.func()
+        self._cache = (value, now + ttl)
+        return value
+
+    def clear(self) -> None:
+        """Forget the cached value, so the next record computes it again."""
+        self._cache = None
 
 
 class Logger:
     def __init__(self, config: Config, name: str):
         self.config = config
         self.name = name
-        self.log_map: LogMap = []
+        self.log_map = LogMapLayer()
+
+        # effective level, resolved from config and cached until
+        # config.generation changes
+        self.level = Level.NOTSET
+        self.generation = -1
 
     def __str__(self):
         return '{}'.format(self.name)
@@ -189,8 +937,42 @@ class Logger:
     def add_local_value(self, key: str, value: Any) -> None:
         self.config.add_local_value(key, value)
 
+    def bind(self, **kwargs: Any) -> ty.ContextManager[None]:
+        return self.config.bind(**kwargs)
+
     def add_value(self, key: str, value: Any) -> None:
-        self.log_map.append((key, value))
+        # copy-on-write, like Config.add_value()
+        with self.config.mutex:
+            self.log_map = LogMapLayer([*self.log_map, (key, value)])
+
+    def get_level(self) -> Level:
+        config = self.config
+        if self.generation != config.generation:
+            self._update_level()
+        return self.level
+
+    def _update_level(self) -> None:
+        # only happens when level configuration has changed, so taking the
+        # lock is cheap overall -- and it keeps us from racing with
+        # Config._update_loggers() when rebinding methods
+        with self.config.mutex:
+            self._resolve_level()
+
+    def _resolve_level(self) -> None:
+        # caller must hold config.mutex
+        config = self.config
+        generation = config.generation
+        self.level = level = config.get_logger_level(self.name)
+        self.generation = generation
+
+        # instance attributes shadow the real methods defined by the class,
+        # so deleting them restores normal behaviour
+        rebind = config.rebind_methods
+        for (method_level, name) in _LEVEL_METHODS:
+            if rebind and method_level < level:
+                self.__dict__[name] = _disabled_method
+            else:
+                self.__dict__.pop(name, None)
 
     def debug(self, message: str, **kwargs: Any) -> None:
         self._log(Level.DEBUG, message, kwargs.items())
@@ -207,31 +989,77 @@ class Logger:
     def critical(self, message: str, **kwargs: Any) -> None:
         self._log(Level.CRITICAL, message, kwargs.items())
 
-    def _log(self, level: Level, message: str, items: Iterable[Tuple[str, Any]]) -> None:
+    def _log(self,
+             level: Level,
+             message: str,
+             items: ty.Collection[Tuple[str, Any]]) -> None:
         config = self.config
 
-        if level < config.get_logger_level(self.name):
+        if self.generation != config.generation:
+            self._update_level()
+        if level < self.level:
             return
 
-        log_map = [
-            *config.get_log_map(),
-            *config.get_local_log_map(),
-            *self.log_map,
-            *items,
-        ]
-        record: Optional[Record]
-        record = Record(
-            time=config.time(),
-            name=self.name,
-            level=level,
-            message=message,
-            log_map=log_map,
-            outbuf=[])
-
-        for stage in config.pipeline:
-            record = stage(config, record)
-            if record is None:
-                break
+        # config.get_log_map() and config.get_local_layers(), inlined
+        # (unpacking local layers takes a temporary list: skip it when
+        # there are none)
+        local = _local_log_map.get()
+        if local:
+            layers: Layers = (config.log_map, *local, self.log_map, items)
+        else:
+            layers = (config.log_map, self.log_map, items)
+
+        # reuse the last record this thread logged, if nothing kept it
+        state = _emit_state
+        record = state.record
+        if record is None:
+            record = Record(
+                time=config.time(),
+                name=self.name,
+                level=level,
+                message=message,
+                outbuf=[],
+                layers=layers)
+        else:
+            state.record = None
+            record.time = config.time()
+            record.name = self.name
+            record.level = level
+            record.message = message
+            record.layers = layers
+        config.run_pipeline(record)
+
+        # (unless a nested call, from a callable value that logs, already
+        # left a spare record)
+        if config.recycle_records and state.record is None:
+            # let go of everything that might keep values alive
+            record.outbuf.clear()
+            record.message = ''
+            record.layers = record._log_map = record._values = None
+            state.record = record
+
+
+class _EmitState(threading.local):
+    # a record that Logger._log() can reuse: see Config.recycle_records
+    record: Optional[Record] = None
+
+
+_emit_state = _EmitState()
+
+
+_LEVEL_METHODS = [
+    (Level.DEBUG, 'debug'),
+    (Level.INFO, 'info'),
+    (Level.WARNING, 'warning'),
+    (Level.ERROR, 'error'),
+    (Level.CRITICAL, 'critical'),
+]
+
+
+def _disabled_method(message: str, **kwargs: Any) -> None:
+    # shared stand-in for log methods disabled by the current level
+    # configuration: see Config.set_rebind_methods()
+    pass
 
 
 def init(level: Level = Level.DEBUG,
@@ -257,11 +1085,28 @@ def get_logger(name):
     return get_config().get_logger(name)
 
 
+def _format_simple_item(key: str, value: Any) -> str:
+    return ' {}={}'.format(key, value)
+
+
 def format_simple(config: Config, record: Record) -> Optional[Record]:
     append = record.outbuf.append
-    append('{} {}'.format(config.format_time(record.time), record.message))
-    for (key, value) in record.get_items():
-        append(' {}={}'.format(key, value))
+    append('{} {} name={} level={}'.format(
+        config.format_time(record.time), record.message,
+        record.name, record.level.name))
+    for layer in record.get_layers():
+        if isinstance(layer, LogMapLayer):
+            for fragment in layer.get_fragments(_format_simple_item):
+                if isinstance(fragment, str):
+                    append(fragment)
+                else:
+                    append(_format_simple_item(
+                        fragment[0], record.evaluate(fragment[1])))
+        else:
+            for (key, value) in layer:
+                if callable(value):
+                    value = record.evaluate(value)
+                append(' {}={}'.format(key, value))
     append('\n')
     return record
 
@@ -279,17 +1124,160 @@ class JSONEncoder(json.JSONEncoder):
 _json_encoder = JSONEncoder()
 
 
+def _make_json_encode() -> Callable[[Dict[Any, Any]], str]:
+    # JSONEncoder.encode() builds a new C encoder object on every call:
+    # build ours just once, with the same settings as _json_encoder. Skip
+    # circular reference checks: the C encoder's recursion limit will
+    # catch those.
+    c_make_encoder = getattr(json.encoder, 'c_make_encoder', None)
+    if c_make_encoder is None:
+        return _json_encoder.encode
+
+    encoder = _json_encoder
+    c_encode = c_make_encoder(
+        None,
+        encoder.default,
+        encode_basestring_ascii,
+        encoder.indent,
+        encoder.key_separator,
+        encoder.item_separator,
+        encoder.sort_keys,
+        encoder.skipkeys,
+        encoder.allow_nan)
+
+    def encode(data: Dict[Any, Any]) -> str:
+        return ''.join(c_encode(data, 0))
+
+    return encode
+
+
+_json_encode = _make_json_encode()
+
+
+def _format_json_item(key: str, value: Any) -> str:
+    return ', ' + _json_encode({key: value})[1:-1]
+
+
+_json_builtin_keys = frozenset(['time', 'message', 'name', 'level'])
+
+
+def _format_json_layers(layers: ty.Iterable[ty.Collection[Tuple[str, Any]]],
+                        append: Callable[[str], None],
+                        evaluate: Callable[[Callable[[], Any]], Any]) -> bool:
+    # Formatted layers can only be pasted together if no key is repeated:
+    # otherwise, the later value must replace the earlier one in place,
+    # just like it would in a dict. So check every key before formatting
+    # anything (which might call callable values), and return False if
+    # any are repeated, leaving the caller to start over with a dict.
+    seen = set(_json_builtin_keys)
+    count = len(seen)
+    todo: List[ty.Union[LogMapLayer, Dict[str, Any]]] = []
+    for layer in layers:
+        keys: ty.Collection[str]
+        if type(layer) is LogMapLayer:
+            keys = layer.get_keys()
+            todo.append(layer)
+        elif layer:
+            keys = data = dict(layer)
+            todo.append(data)
+        else:
+            continue
+        seen.update(keys)
+        count += len(keys)
+    if len(seen) != count:
+        return False
+
+    for item in todo:
+        if isinstance(item, LogMapLayer):
+            for fragment in item.get_fragments(_format_json_item):
+                if isinstance(fragment, str):
+                    append(fragment)
+                else:
+                    append(_format_json_item(fragment[0],
+                                             evaluate(fragment[1])))
+        else:
+            for (key, value) in item.items():
+                if callable(value):
+                    item[key] = evaluate(value)
+            append(', ' + _json_encode(item)[1:-1])
+    return True
+
+
+def _json_str(value: Any) -> str:
+    if type(value) is str:
+        return encode_basestring_ascii(value)
+    return _json_encode(value)
+
+
 def format_json(config: Config, record: Record) -> Optional[Record]:
-    items = record.get_items()
+    parts = [
+        '{"time": ', _json_str(config.format_time(record.time)),
+        ', "message": ', _json_str(record.message),
+        ', "name": ', _json_str(record.name),
+        ', "level": ', _json_str(record.level.name),
+    ]
+    if _format_json_layers(record.get_layers(), parts.append,
+                           record.evaluate):
+        parts.append('}\n')
+        record.outbuf.append(''.join(parts))
+        return record
+    return _format_json_dict(config, record)
+
+
+def _format_json_dict(config: Config, record: Record) -> Record:
+    # some key is repeated: build a dict directly from log_map, where str,
+    # int, float, bool, and None values are all encoded in C and only
+    # unusual objects reach JSONEncoder.default()
     data = {
         'time': config.format_time(record.time),
         'message': record.message,
+        'name': record.name,
+        'level': record.level.name,
     }
-    data.update(items)
-    record.outbuf.append(_json_encoder.encode(data) + '\n')
+    for (key, value) in record.log_map:
+        if callable(value):
+            value = record.evaluate(value)
+        data[key] = value
+    record.outbuf.append(_json_encode(data) + '\n')
     return record
 
 
+def _load_speedups() -> Any:
+    if os.environ.get('LOLOG_PURE_PYTHON'):
+        return None
+    try:
+        return importlib.import_module('lolog._speedups')
+    except ImportError:
+        return None
+
+
+# Compiled versions of Logger._log(), the Logger level methods,
+# format_simple() and format_json() (see src/speedups.c), if the extension
+# was built: they do exactly the same as the Python versions, which remain
+# as the fallback. Set LOLOG_PURE_PYTHON=1 in the environment to use the
+# Python versions.
+_speedups = _load_speedups()
+_py_logger_log = Logger._log
+_py_format_simple = format_simple
+_py_format_json = format_json
+if _speedups is not None:
+    _speedups.setup(
+        Record=Record,
+        LogMapLayer=LogMapLayer,
+        local_log_map=_local_log_map,
+        format_simple_item=_format_simple_item,
+        format_json_item=_format_json_item,
+        format_json_dict=_format_json_dict,
+        json_encode=_json_encode,
+        encode_basestring_ascii=encode_basestring_ascii,
+        json_builtin_keys=_json_builtin_keys)
+    Logger._log = _speedups.LogMethod(None)         # type: ignore
+    for (_level, _name) in _LEVEL_METHODS:
+        setattr(Logger, _name, _speedups.LogMethod(_level))
+    format_simple = _speedups.format_simple
+    format_json = _speedups.format_json
+
+
 FORMATTER = {
     'simple': format_simple,
     'json': format_json,
@@ -310,6 +1298,1081 @@ def output_stream(config: Config, record: Record) -> Optional[Record]:
     return record
 
 
+# output_stream(), inlined by Config.compile_pipeline()
+_OUTPUT_STREAM_SOURCE = '''\
+    if not record.outbuf:
+        raise RuntimeError(
+            'lolog pipeline error: '
+            'cannot output log record that has not been formatted')
+    if config.stream is None:
+        raise RuntimeError(
+            'lolog pipeline error: '
+            'cannot output log record when config.stream is not set')
+    config.stream.write(''.join(record.outbuf))
+'''
+
+
+class StageStats:
+    """Counters for one pipeline stage: see Config.set_stats()."""
+
+    # number of recent timing samples kept for percentiles
+    max_samples = 1000
+
+    def __init__(self, stage: StageType, output: bool):
+        self.name = getattr(stage, '__name__', type(stage).__name__)
+        self.output = output
+        self.calls = 0
+        self.dropped = 0
+        self.bytes = 0
+        self.samples: ty.Deque[float] = collections.deque(maxlen=self.max_samples)
+        self.sampled_calls = 0
+        self.sampled_time = 0.0
+
+    def add_sample(self, elapsed: float) -> None:
+        self.samples.append(elapsed)
+        self.sampled_calls += 1
+        self.sampled_time += elapsed
+
+    def snapshot(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {
+            'stage': self.name,
+            'calls': self.calls,
+            'dropped': self.dropped,
+        }
+        if self.output:
+            result['bytes'] = self.bytes
+        samples = sorted(self.samples)
+        if samples:
+            mean = self.sampled_time / self.sampled_calls
+            result['time_total'] = mean * self.calls
+            for pct in (50, 90, 99):
+                idx = min(len(samples) - 1, len(samples) * pct // 100)
+                result['time_p{}'.format(pct)] = samples[idx]
+            result['time_max'] = samples[-1]
+        return result
+
+
+class PipelineStats:
+    """Counters for a whole pipeline: see Config.set_stats()."""
+
+    def __init__(self, sample_every: int):
+        self.sample_every = sample_every
+        self.records = 0
+        self.stages: List[StageStats] = []
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'records': self.records,
+            'sample_every': self.sample_every,
+            'stages': [stats.snapshot() for stats in self.stages],
+        }
+
+
+class QueueOutput:
+    """Output stage that hands formatted records to a background thread.
+
+    The calling thread only has to join outbuf and append it to a bounded
+    queue; a dedicated writer thread drains the queue to config.stream.
+    When the queue is full, overflow decides what happens:
+
+      * "block": wait for the writer thread to catch up
+      * "drop-newest": discard the record being logged
+      * "drop-oldest": discard the oldest queued record to make room
+
+    Discarded records are counted in the dropped attribute. The queue is
+    flushed and the writer thread stopped at interpreter exit, after which
+    records are written synchronously.
+    """
+
+    OVERFLOW = ('block', 'drop-newest', 'drop-oldest')
+
+    def __init__(self, maxsize: int = 10000, overflow: str = 'block'):
+        if overflow not in self.OVERFLOW:
+            raise ValueError('unsupported overflow policy: {!r}'.format(overflow))
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.queue: ty.Deque[Tuple[TextIO, str]] = collections.deque()
+        self.cond = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+        self.closed = False
+
+        # number of records queued but not yet written
+        self.pending = 0
+
+        # number of records discarded due to overflow
+        self.dropped = 0
+
+        # number of records lost to exceptions from stream.write()
+        self.errors = 0
+
+        atexit.register(self.close)
+        _fork_handlers.add(self)
+
+    def _after_fork(self) -> None:
+        # the writer thread is gone, and the parent will write whatever
+        # was queued
+        self.cond = threading.Condition()
+        self.thread = None
+        self.queue.clear()
+        self.pending = 0
+
+    def __call__(self, config: Config, record: Record) -> Optional[Record]:
+        if not record.outbuf:
+            raise RuntimeError(
+                'lolog pipeline error: '
+                'cannot output log record that has not been formatted')
+        stream = config.stream
+        if stream is None:
+            raise RuntimeError(
+                'lolog pipeline error: '
+                'cannot output log record when config.stream is not set')
+
+        text = ''.join(record.outbuf)
+        with self.cond:
+            if self.closed:
+                stream.write(text)
+                return record
+            if self.thread is None:
+                self._start()
+
+            queue = self.queue
+            if len(queue) >= self.maxsize:
+                if self.overflow == 'drop-newest':
+                    self.dropped += 1
+                    return record
+                elif self.overflow == 'drop-oldest':
+                    queue.popleft()
+                    self.pending -= 1
+                    self.dropped += 1
+                else:
+                    while len(queue) >= self.maxsize and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        stream.write(text)
+                        return record
+
+            queue.append((stream, text))
+            self.pending += 1
+            self.cond.notify_all()
+        return record
+
+    def flush(self) -> None:
+        """Wait until every queued record has been written."""
+        with self.cond:
+            while self.pending and self.thread is not None:
+                self.cond.wait()
+
+    def close(self) -> None:
+        """Flush the queue and stop the writer thread."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def _start(self) -> None:
+        # caller must hold self.cond
+        self.thread = threading.Thread(
+            target=self._run, name='lolog-writer', daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        cond = self.cond
+        queue = self.queue
+        while True:
+            with cond:
+                while not queue and not self.closed:
+                    cond.wait()
+                if not queue:
+                    self.thread = None
+                    cond.notify_all()
+                    return
+                batch = list(queue)
+                queue.clear()
+                cond.notify_all()
+
+            errors = 0
+            for (stream, text) in batch:
+                try:
+                    stream.write(text)
+                except Exception:
+                    errors += 1
+
+            with cond:
+                self.pending -= len(batch)
+                self.errors += errors
+                cond.notify_all()
+
+
+class BufferedOutput:
+    """Output stage that batches formatted records into fewer writes.
+
+    Records are collected in a buffer, which is written to config.stream
+    in one write() call (followed by flush()) as soon as any of these
+    happens:
+
+      * the buffer holds max_size characters or more
+      * the oldest buffered record is max_delay seconds old
+      * a record at flush_level or higher arrives (ERROR by default)
+      * the interpreter exits
+
+    The max_delay timer runs in a background thread, which is only
+    started once something is buffered.
+    """
+
+    def __init__(self,
+                 max_size: int = 65536,
+                 max_delay: float = 0.1,
+                 flush_level: Level = Level.ERROR):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.flush_level = flush_level
+        self.buffer: List[str] = []
+        self.size = 0
+        self.stream: Optional[TextIO] = None
+        self.deadline: Optional[float] = None
+        self.cond = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+        self.closed = False
+        atexit.register(self.close)
+        _fork_handlers.add(self)
+
+    def _after_fork(self) -> None:
+        # the timer thread is gone, and the parent will write whatever
+        # was buffered
+        self.cond = threading.Condition()
+        self.thread = None
+        self.buffer.clear()
+        self.size = 0
+        self.deadline = None
+
+    def __call__(self, config: Config, record: Record) -> Optional[Record]:
+        if not record.outbuf:
+            raise RuntimeError(
+                'lolog pipeline error: '
+                'cannot output log record that has not been formatted')
+        stream = config.stream
+        if stream is None:
+            raise RuntimeError(
+                'lolog pipeline error: '
+                'cannot output log record when config.stream is not set')
+
+        text = ''.join(record.outbuf)
+        with self.cond:
+            if stream is not self.stream:
+                self._flush()
+                self.stream = stream
+            self.buffer.append(text)
+            self.size += len(text)
+            if (self.size >= self.max_size or
+                    record.level >= self.flush_level or
+                    self.closed):
+                self._flush()
+            elif self.deadline is None:
+                # first record in an empty buffer starts the clock
+                self.deadline = time.monotonic() + self.max_delay
+                if self.thread is None:
+                    self._start()
+                self.cond.notify()
+        return record
+
+    def flush(self) -> None:
+        """Write out everything buffered so far."""
+        with self.cond:
+            self._flush()
+
+    def close(self) -> None:
+        """Flush the buffer and stop the timer thread.
+
+        Any records that arrive after this are written immediately.
+        """
+        with self.cond:
+            self._flush()
+            self.closed = True
+            self.cond.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def _flush(self) -> None:
+        # caller must hold self.cond
+        self.deadline = None
+        if not self.buffer:
+            return
+        assert self.stream is not None
+        text = ''.join(self.buffer)
+        self.buffer.clear()
+        self.size = 0
+        self.stream.write(text)
+        self.stream.flush()
+
+    def _start(self) -> None:
+        # caller must hold self.cond
+        self.thread = threading.Thread(
+            target=self._run, name='lolog-flusher', daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        cond = self.cond
+        with cond:
+            while not self.closed:
+                if self.deadline is None:
+                    cond.wait()
+                    continue
+                remaining = self.deadline - time.monotonic()
+                if remaining > 0:
+                    cond.wait(remaining)
+                else:
+                    try:
+                        self._flush()
+                    except Exception:
+                        # nowhere to report this: carry on so that we
+                        # will try again with the next record
+                        pass
+            self.thread = None
+
+
+class AsyncOutput:
+    """Output stage for asyncio programs that never blocks the event loop.
+
+    Records logged in the event loop thread are written straight to the
+    stream's file descriptor, switched to non-blocking mode. Whatever it
+    will not take right away (e.g. because a pipe or terminal is slow to
+    read) is kept in memory, and written by a writer callback registered
+    with the loop once the descriptor is writable again. So logging costs
+    a coroutine at most one write() system call, and never waits.
+
+    At most max_size bytes are kept in memory. When a record does not
+    fit, overflow decides what happens:
+
+      * "drop-newest": discard the record being logged
+      * "drop-oldest": discard the oldest buffered records to make room
+
+    Discarded records are counted in the dropped attribute.
+
+    The stage attaches to the running loop and config.stream the first
+    time it is called from a coroutine. Until then, and for records that
+    go to other streams, it writes like output_stream(); so it does for
+    streams without a file descriptor, such as io.StringIO. Records from
+    other threads are buffered and written by the loop.
+
+    The descriptor stays non-blocking until aclose() (or interpreter
+    exit), for every user of it: other writes to the same stream, like
+    print(), may fail with BlockingIOError while it is full.
+    """
+
+    OVERFLOW = ('drop-newest', 'drop-oldest')
+
+    # os.writev() takes at most this many buffers
+    MAX_WRITE_BUFFERS = 1024
+
+    def __init__(self, max_size: int = 1 << 20, overflow: str = 'drop-newest'):
+        if overflow not in self.OVERFLOW:
+            raise ValueError('unsupported overflow policy: {!r}'.format(overflow))
+        self.max_size = max_size
+        self.overflow = overflow
+
+        # encoded records not yet written, and their total size; if
+        # partial is true, buffer[0] is the rest of a partly written
+        # record, which must not be dropped
+        self.buffer: ty.Deque[bytes] = collections.deque()
+        self.size = 0
+        self.partial = False
+
+        # the loop and stream we are attached to, and the stream's file
+        # descriptor (-1 if it does not have one)
+        self.loop: Any = None
+        self.stream: Optional[TextIO] = None
+        self.fd = -1
+        self.encoding = 'utf-8'
+        self.was_blocking = True
+
+        # true while the writer callback is registered (or about to be)
+        self.writing = False
+
+        # futures for flush() calls waiting for the buffer to empty
+        self.waiters: List[Any] = []
+
+        # records arrive from other threads too
+        self.mutex = threading.Lock()
+        self.closed = False
+
+        # number of records discarded due to overflow
+        self.dropped = 0
+
+        # number of write errors (each loses everything buffered)
+        self.errors = 0
+
+        atexit.register(self.close)
+        _fork_handlers.add(self)
+
+    def _after_fork(self) -> None:
+        # the loop belongs to the parent, which will write whatever was
+        # buffered
+        self.mutex = threading.Lock()
+        self.buffer.clear()
+        self.size = 0
+        self.partial = False
+        self.loop = None
+        self.stream = None
+        self.fd = -1
+        self.writing = False
+        self.waiters = []
+
+    def __call__(self, config: Config, record: Record) -> Optional[Record]:
+        if not record.outbuf:
+            raise RuntimeError(
+                'lolog pipeline error: '
+                'cannot output log record that has not been formatted')
+        stream = config.stream
+        if stream is None:
+            raise RuntimeError(
+                'lolog pipeline error: '
+                'cannot output log record when config.stream is not set')
+
+        text = ''.join(record.outbuf)
+        # if asyncio has not even been imported, no loop can be running
+        aio = sys.modules.get('asyncio')
+        running = aio._get_running_loop() if aio is not None else None
+
+        with self.mutex:
+            loop: Any = self.loop
+            if loop is not None and loop.is_closed():
+                # e.g. asyncio.run() has returned: perhaps another loop
+                # is running now
+                self._detach()
+                loop = None
+            if loop is None and running is not None and not self.closed:
+                self._attach(running, stream)
+                loop = self.loop
+            if loop is None or stream is not self.stream:
+                stream.write(text)
+                return record
+
+            data = text.encode(self.encoding, 'backslashreplace')
+            in_loop = running is loop
+            if in_loop and not self.buffer:
+                self._write(data)
+            else:
+                self._append(data)
+            if self.buffer and not self.writing:
+                self.writing = True
+                if in_loop:
+                    loop.add_writer(self.fd, self._on_writable)
+                else:
+                    try:
+                        loop.call_soon_threadsafe(self._start_writing)
+                    except RuntimeError:
+                        # the loop closed since we checked: close() will
+                        # write the buffer at exit, if nothing else does
+                        self.writing = False
+        return record
+
+    async def flush(self) -> None:
+        """Wait until everything buffered has been written.
+
+        Must be awaited in the loop the stage is attached to.
+        """
+        with self.mutex:
+            if not self.buffer or self.loop is None:
+                return
+            waiter = self.loop.create_future()
+            self.waiters.append(waiter)
+        await waiter
+
+    async def aclose(self) -> None:
+        """Flush the buffer, and restore the file descriptor's mode.
+
+        Any records that arrive after this are written like
+        output_stream() does.
+        """
+        await self.flush()
+        self.close()
+
+    def close(self) -> None:
+        """Write out anything still buffered (blocking), and detach.
+
+        Called at interpreter exit, when the loop may be long gone.
+        """
+        with self.mutex:
+            self.closed = True
+            self._detach()
+
+    def _attach(self, loop: Any, stream: TextIO) -> None:
+        # caller must hold self.mutex
+        self.stream = stream
+        try:
+            fd = stream.fileno()
+        except (AttributeError, OSError, ValueError):
+            # not a real file: nothing to block on
+            return
+        stream.flush()
+        self.fd = fd
+        self.encoding = getattr(stream, 'encoding', None) or 'utf-8'
+        self.was_blocking = os.get_blocking(fd)
+        os.set_blocking(fd, False)
+        self.loop = loop
+
+    def _detach(self) -> None:
+        # caller must hold self.mutex
+        loop = self.loop
+        if loop is None:
+            self.stream = None
+            return
+        if self.writing and not loop.is_closed():
+            try:
+                loop.remove_writer(self.fd)
+            except Exception:
+                pass
+        self.writing = False
+        try:
+            os.set_blocking(self.fd, self.was_blocking)
+            for data in self.buffer:
+                os.write(self.fd, data)
+        except OSError:
+            self.errors += 1
+        self.buffer.clear()
+        self.size = 0
+        self.partial = False
+        self.loop = None
+        self.stream = None
+        self.fd = -1
+        self._wake_waiters()
+
+    def _write(self, data: bytes) -> None:
+        # caller must hold self.mutex, in the loop thread, with nothing
+        # buffered
+        try:
+            written = os.write(self.fd, data)
+        except BlockingIOError:
+            written = 0
+        except OSError:
+            self.errors += 1
+            return
+        if written == len(data):
+            return
+        if written:
+            self.buffer.append(data[written:])
+            self.size += len(data) - written
+            self.partial = True
+        else:
+            self._append(data)
+
+    def _append(self, data: bytes) -> None:
+        # caller must hold self.mutex
+        buffer = self.buffer
+        if self.size + len(data) > self.max_size:
+            if self.overflow == 'drop-newest' or len(data) > self.max_size:
+                self.dropped += 1
+                return
+            keep = buffer.popleft() if self.partial else None
+            while buffer and self.size + len(data) > self.max_size:
+                self.size -= len(buffer.popleft())
+                self.dropped += 1
+            if keep is not None:
+                buffer.appendleft(keep)
+            if self.size + len(data) > self.max_size:
+                self.dropped += 1
+                return
+        buffer.append(data)
+        self.size += len(data)
+
+    def _start_writing(self) -> None:
+        # in the loop thread, for records that arrived from other threads
+        with self.mutex:
+            loop = self.loop
+            if loop is None or not self.writing:
+                return
+            if self.buffer:
+                loop.add_writer(self.fd, self._on_writable)
+            else:
+                self.writing = False
+
+    def _on_writable(self) -> None:
+        with self.mutex:
+            buffer = self.buffer
+            if buffer:
+                chunks = list(itertools.islice(buffer, self.MAX_WRITE_BUFFERS))
+                try:
+                    written = os.writev(self.fd, chunks)
+                except BlockingIOError:
+                    return
+                except OSError:
+                    # e.g. the reader has gone away: nowhere to put this
+                    self.errors += 1
+                    written = self.size
+                    chunks = list(buffer)
+
+                # discard whatever was written, keeping record boundaries
+                self.size -= written
+                for chunk in chunks:
+                    if written < len(chunk):
+                        if written:
+                            buffer[0] = chunk[written:]
+                            self.partial = True
+                        break
+                    buffer.popleft()
+                    written -= len(chunk)
+                    self.partial = False
+
+            if not buffer:
+                self.loop.remove_writer(self.fd)
+                self.writing = False
+                self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        # caller must hold self.mutex
+        for waiter in self.waiters:
+            try:
+                waiter.get_loop().call_soon_threadsafe(
+                    _set_future_result, waiter)
+            except RuntimeError:
+                # the loop is closed: nobody is waiting any more
+                pass
+        self.waiters = []
+
+
+def _set_future_result(future: Any) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class _RateState:
+    __slots__ = ('seen', 'tokens', 'time', 'suppressed')
+
+    def __init__(self, tokens: float, time_: float):
+        self.seen = 0
+        self.tokens = tokens
+        self.time = time_
+        self.suppressed = 0
+
+
+class RateLimit:
+    """Filter stage that limits how often the same thing is logged.
+
+    Records are grouped by (logger name, message, level). Within each
+    group, only every sample-th record is considered (by default, all of
+    them), and those get through at no more than rate records per second
+    on average, in bursts of up to burst records; set rate to None for
+    sampling only. The next record of a group that gets through carries
+    the number of records suppressed since the last one, as
+    suppressed=N.
+
+    Insert it ahead of the formatter, so that suppressed records cost as
+    little as possible:
+
+        cfg.insert_stage(0, RateLimit(rate=1.0, burst=10))
+
+    State is kept for the max_keys most recently seen groups only.
+    """
+
+    def __init__(self,
+                 rate: Optional[float] = 1.0,
+                 burst: float = 10,
+                 sample: int = 1,
+                 max_keys: int = 10000):
+        if sample < 1:
+            raise ValueError('sample must be at least 1')
+        self.rate = rate
+        self.burst = burst
+        self.sample = sample
+        self.max_keys = max_keys
+        self.keys: collections.OrderedDict[
+            Tuple[str, str, Level], _RateState] = collections.OrderedDict()
+        self.mutex = threading.Lock()
+
+        # total number of records suppressed
+        self.suppressed = 0
+        _fork_handlers.add(self)
+
+    def _after_fork(self) -> None:
+        self.mutex = threading.Lock()
+
+    def __call__(self, config: Config, record: Record) -> Optional[Record]:
+        key = (record.name, record.message, record.level)
+        with self.mutex:
+            keys = self.keys
+            state = keys.get(key)
+            if state is None:
+                state = keys[key] = _RateState(self.burst, record.time)
+                if len(keys) > self.max_keys:
+                    keys.popitem(last=False)
+            else:
+                keys.move_to_end(key)
+
+            passed = state.seen % self.sample == 0
+            state.seen += 1
+            if passed and self.rate is not None:
+                # refill the bucket for the time since the last record
+                # (the clock might have gone backwards)
+                elapsed = max(0.0, record.time - state.time)
+                tokens = min(self.burst, state.tokens + elapsed * self.rate)
+                state.time = record.time
+                passed = tokens >= 1
+                state.tokens = tokens - 1 if passed else tokens
+
+            if not passed:
+                state.suppressed += 1
+                self.suppressed += 1
+                return None
+            suppressed = state.suppressed
+            state.suppressed = 0
+
+        if suppressed:
+            return record.replace(
+                log_map=None,
+                layers=(*record.get_layers(), [('suppressed', suppressed)]))
+        return record
+
+
+class _Run:
+    __slots__ = ('key', 'level', 'message', 'count', 'time', 'deadline')
+
+    def __init__(self, key: int, record: Record):
+        self.key = key
+        self.level = record.level
+        self.message = record.message
+        self.count = 0
+        self.time = record.time
+        self.deadline: Optional[float] = None
+
+
+class Collapse:
+    """Filter stage that collapses runs of repeated records.
+
+    When a logger emits the same record (same level, message and log
+    map, or just the same level and message with match_log_map=False)
+    several times in a row, only the first one gets through. The rest are
+    counted, and reported in a summary record with the same name, level
+    and message, plus repeated=N, which goes through the stages after
+    this one as soon as the logger emits something else, or at most
+    window seconds after the first repeat.
+
+    Records are compared by hash, and only the hash is kept, not the
+    records or their values.
+    """
+
+    def __init__(self, window: float = 10.0, match_log_map: bool = True):
+        self.window = window
+        self.match_log_map = match_log_map
+
+        # logger name -> current run
+        self.runs: Dict[str, _Run] = {}
+        self.config: Optional[Config] = None
+        self.cond = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+        self.closed = False
+        atexit.register(self.close)
+        _fork_handlers.add(self)
+
+    def _after_fork(self) -> None:
+        self.cond = threading.Condition()
+        self.thread = None
+        self.runs = {}
+
+    def __call__(self, config: Config, record: Record) -> Optional[Record]:
+        key = self._fingerprint(record)
+        with self.cond:
+            self.config = config
+            run = self.runs.get(record.name)
+            if run is not None and run.key == key:
+                run.count += 1
+                run.time = record.time
+                if run.deadline is None:
+                    run.deadline = time.monotonic() + self.window
+                    if self.thread is None and not self.closed:
+                        self._start()
+                    self.cond.notify()
+                return None
+
+            self.runs[record.name] = _Run(key, record)
+        if run is not None and run.count:
+            self._emit(config, self._summary(record.name, run))
+        return record
+
+    def flush(self) -> None:
+        """Emit summaries for all runs of repeats so far."""
+        with self.cond:
+            (config, summaries) = self._take_summaries(None)
+        self._emit_all(config, summaries)
+
+    def close(self) -> None:
+        """Emit all summaries and stop the timer thread."""
+        with self.cond:
+            (config, summaries) = self._take_summaries(None)
+            self.closed = True
+            self.cond.notify()
+            thread = self.thread
+        self._emit_all(config, summaries)
+        if thread is not None:
+            thread.join()
+
+    def _fingerprint(self, record: Record) -> int:
+        if not self.match_log_map:
+            return hash((record.level, record.message))
+        items = tuple(item for layer in record.get_layers() for item in layer)
+        try:
+            return hash((record.level, record.message, items))
+        except TypeError:
+            # unhashable values, e.g. lists
+            return hash((record.level, record.message, repr(items)))
+
+    def _take_summaries(
+            self, now: Optional[float]) -> Tuple[Optional[Config], List[Record]]:
+        # summaries for runs past their deadline (or all of them if now is
+        # None), which the caller emits once it has released self.cond;
+        # caller must hold self.cond
+        summaries = []
+        for (name, run) in self.runs.items():
+            if run.deadline is None:
+                continue
+            if now is None or run.deadline <= now:
+                summaries.append(self._summary(name, run))
+                run.count = 0
+                run.deadline = None
+        return (self.config, summaries)
+
+    def _summary(self, name: str, run: _Run) -> Record:
+        return Record(
+            run.time, name, run.level, run.message, [('repeated', run.count)])
+
+    def _emit_all(self,
+                  config: Optional[Config],
+                  records: List[Record]) -> None:
+        if config is not None:
+            for record in records:
+                self._emit(config, record)
+
+    def _emit(self, config: Config, record: Optional[Record]) -> None:
+        # run record through the stages after this one
+        try:
+            stages = config.pipeline[config.pipeline.index(self) + 1:]
+        except ValueError:
+            return
+        for stage in stages:
+            if record is None:
+                break
+            record = stage(config, record)
+
+    def _start(self) -> None:
+        # caller must hold self.cond
+        self.thread = threading.Thread(
+            target=self._run, name='lolog-collapse', daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        cond = self.cond
+        with cond:
+            while not self.closed:
+                deadlines = [run.deadline for run in self.runs.values()
+                             if run.deadline is not None]
+                if not deadlines:
+                    cond.wait()
+                    continue
+                now = time.monotonic()
+                if min(deadlines) > now:
+                    cond.wait(min(deadlines) - now)
+                    continue
+
+                # emit without the lock, so that the stages after this one
+                # (which may block on writes) don't hold up every thread
+                # that logs
+                (config, summaries) = self._take_summaries(now)
+                cond.release()
+                try:
+                    self._emit_all(config, summaries)
+                except Exception:
+                    # nowhere to report this
+                    pass
+                finally:
+                    cond.acquire()
+            self.thread = None
+
+
+# segment file header: magic, version, flags, end of committed data,
+# sequence number (the rest up to SEGMENT_HEADER_SIZE is reserved)
+SEGMENT_MAGIC = b'LOLOGSEG'
+SEGMENT_HEADER_SIZE = 64
+SEGMENT_CLOSED = 1
+_segment_header = struct.Struct('<8sIIQQ')
+_segment_flags = struct.Struct('<I')
+_segment_end = struct.Struct('<Q')
+_SEGMENT_FLAGS_POS = 12
+_SEGMENT_END_POS = 16
+
+
+class MmapOutput:
+    """Output stage that writes records into memory-mapped log segments.
+
+    Records are copied straight into a preallocated file, mapped into
+    memory, which skips the encoding and buffering layers of a TextIO
+    stream and makes no system calls at all until the file is full.
+    Segment files are named path.000001, path.000002, and so on; when one
+    fills up (segment_size bytes, including the header), writing carries
+    on in the next one. With max_segments set, the oldest segments are
+    deleted to keep at most that many.
+
+    Each segment starts with a small header that records where the
+    committed data ends, updated after every record: data up to there is
+    complete even if the process crashes. Use read_segment() to read it.
+
+    A process forked from one that uses MmapOutput writes a series of its
+    own, named path.PID.000001 and so on.
+
+    MmapOutput also has a write() method, so that it can be the stream
+    for stages that write bytes, such as lolog.binlog.BinaryOutput.
+    """
+
+    def __init__(self,
+                 path: str,
+                 segment_size: int = 16 * 1024 * 1024,
+                 max_segments: Optional[int] = None):
+        if segment_size <= SEGMENT_HEADER_SIZE:
+            raise ValueError(
+                'segment_size must be larger than {}'
+                .format(SEGMENT_HEADER_SIZE))
+        # the path given, and the one this process writes to
+        self.base_path = path
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.mutex = threading.Lock()
+        self.map: Optional[mmap.mmap] = None
+        self.offset = 0
+        self.capacity = 0
+        self.seq = max((seq for (seq, _) in _segment_paths(path)), default=0)
+        atexit.register(self.close)
+        _fork_handlers.add(self)
+
+    def _after_fork(self) -> None:
+        # the parent keeps writing to its segment: start a series of our
+        # own (without touching the parent's mapping)
+        self.mutex = threading.Lock()
+        self.map = None
+        self.path = '{}.{}'.format(self.base_path, os.getpid())
+        self.seq = 0
+
+    def __call__(self, config: Config, record: Record) -> Optional[Record]:
+        if not record.outbuf:
+            raise RuntimeError(
+                'lolog pipeline error: '
+                'cannot output log record that has not been formatted')
+        self.write(''.join(record.outbuf).encode('utf-8', 'surrogateescape'))
+        return record
+
+    def write(self, data: bytes) -> int:
+        size = len(data)
+        with self.mutex:
+            mm = self.map
+            if mm is None or self.offset + size > self.capacity:
+                self._next_segment(size)
+                mm = self.map
+                assert mm is not None
+            mm.write(data)
+            self.offset += size
+            _segment_end.pack_into(mm, _SEGMENT_END_POS, self.offset)
+        return size
+
+    def flush(self) -> None:
+        """Write the current segment to disk (not needed to survive a
+        crash of this process, only of the whole system)."""
+        with self.mutex:
+            if self.map is not None:
+                self.map.flush()
+
+    def close(self) -> None:
+        """Close the current segment. Any later record starts a new one."""
+        with self.mutex:
+            self._close_segment()
+
+    def _next_segment(self, size: int) -> None:
+        # caller must hold self.mutex
+        self._close_segment()
+        self.seq += 1
+        path = '{}.{:06d}'.format(self.path, self.seq)
+
+        # a record too big for a segment gets a bigger one
+        length = max(self.segment_size, SEGMENT_HEADER_SIZE + size)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                # really allocate the space, so that a full disk fails
+                # here rather than crashing us on a page fault later
+                os.posix_fallocate(fd, 0, length)
+            else:
+                os.ftruncate(fd, length)
+            mm = mmap.mmap(fd, length)
+        finally:
+            os.close(fd)
+        _segment_header.pack_into(
+            mm, 0, SEGMENT_MAGIC, 1, 0, SEGMENT_HEADER_SIZE, self.seq)
+        mm.seek(SEGMENT_HEADER_SIZE)
+        self.map = mm
+        self.offset = SEGMENT_HEADER_SIZE
+        self.capacity = length
+
+        if self.max_segments is not None:
+            for (seq, old_path) in _segment_paths(self.path):
+                if seq <= self.seq - self.max_segments:
+                    os.unlink(old_path)
+
+    def _close_segment(self) -> None:
+        # caller must hold self.mutex
+        mm = self.map
+        if mm is None:
+            return
+        self.map = None
+        _segment_flags.pack_into(mm, _SEGMENT_FLAGS_POS, SEGMENT_CLOSED)
+        mm.close()
+
+        # give back the unused preallocated space
+        os.truncate('{}.{:06d}'.format(self.path, self.seq), self.offset)
+
+
+def _segment_paths(path: str) -> List[Tuple[int, str]]:
+    # (sequence number, path) of the existing segments for path, in order
+    (dirname, basename) = os.path.split(path)
+    pattern = re.compile(re.escape(basename) + r'\.(\d{6,})$')
+    segments = []
+    for name in os.listdir(dirname or '.'):
+        match = pattern.match(name)
+        if match:
+            segments.append((int(match.group(1)), os.path.join(dirname, name)))
+    return sorted(segments)
+
+
+def read_segment(path: str) -> bytes:
+    """Return the committed data in a segment written by MmapOutput."""
+    with open(path, 'rb') as infile:
+        header = infile.read(SEGMENT_HEADER_SIZE)
+        if (len(header) < _segment_header.size or
+                not header.startswith(SEGMENT_MAGIC)):
+            raise ValueError('not a lolog segment: {}'.format(path))
+        (_, _, _, end, _) = _segment_header.unpack_from(header)
+        return infile.read(end - SEGMENT_HEADER_SIZE)
+
+
+TIME_FORMAT = {
+    'local': 'format_time_local',
+    'utc': 'format_time_utc',
+    'epoch_ns': 'format_time_epoch_ns',
+}
+
+
+# built-in stages that always return the record they were passed
+_FORMATTER_STAGES = (format_simple, format_json)
+_OUTPUT_STAGES = (QueueOutput, BufferedOutput, AsyncOutput, MmapOutput)
+
+
+OUTPUT: Dict[str, Callable[[], StageType]] = {
+    'stream': lambda: output_stream,
+    'queue': QueueOutput,
+    'buffer': BufferedOutput,
+    'async': AsyncOutput,
+}
+
+
 # aliases for compatibility with C interface
 make_config = Config
 make_logger = Logger
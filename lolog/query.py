@@ -0,0 +1,475 @@
+"""search lolog output files by time, level, logger name and log map
+
+lolog writes one record per line, with a sortable timestamp: first on
+the line in the simple format, and the value of "time" in JSON. So a
+file can be searched by time without reading it all: the file is
+memory-mapped and bisected to the first line at or after --since, then
+read up to --until, and only lines that pass every other filter are
+printed:
+
+    python -m lolog.query --since 2020-01-14T13:00 --until 2020-01-14T13:05 \\
+        --level WARNING --name 'myapp.*' --item request_id=a925 app.log
+
+Times are compared as strings, so any prefix of a timestamp works, in
+whatever time format the file was written with. --since is inclusive
+and --until exclusive.
+
+For files that are queried repeatedly, --index keeps a sparse index
+next to the file (FILE.idx): where each block (1 MiB by default)
+starts, its first timestamp, and which levels and loggers appear in it.
+Blocks that contain no line at the levels and loggers wanted are then
+skipped without being read. The index is extended when the file grows,
+and rebuilt if it has been replaced.
+"""
+
+from __future__ import annotations
+
+import argparse
+import fnmatch
+import json
+import mmap
+import os
+import re
+import sys
+import zlib
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from .pylolog import Level
+
+INDEX_VERSION = 1
+BLOCK_SIZE = 1 << 20
+
+# how many bytes of the start of a file identify it, for the index
+_HEAD_SIZE = 4096
+
+# lines are read in chunks of about this size
+_CHUNK_SIZE = 1 << 20
+
+_levels = '|'.join(level.name for level in Level).encode('ascii')
+# the message may contain " name=x level=y" too: the real fields are the
+# last such pair (and a log map item is much less likely to look like one)
+_simple_line = re.compile(
+    rb'(\S+) .* name=(\S*) level=(' + _levels + rb')(?= |\r?\n|$)')
+_json_str = rb'"(?:[^"\\]|\\.)*"'
+_json_line = re.compile(
+    rb'\{"time": "([^"\\]*)", "message": ' + _json_str +
+    rb', "name": (' + _json_str + rb'), "level": "(' + _levels + rb')"')
+
+
+class QueryError(ValueError):
+    pass
+
+
+def parse_line(line: bytes) -> Optional[Tuple[bytes, str, Level]]:
+    """Return the (time, name, level) of a line of lolog output.
+
+    Works for both the simple and JSON formats. Returns None for lines
+    that are not lolog records (e.g. the continuation of a message that
+    contained a newline).
+    """
+    if line.startswith(b'{'):
+        match = _json_line.match(line)
+        if match is None:
+            return None
+        (time, name, level) = match.groups()
+        if b'\\' in name:
+            text = json.loads(name)
+        else:
+            text = name[1:-1].decode('utf-8', 'replace')
+    else:
+        match = _simple_line.match(line)
+        if match is None:
+            return None
+        (time, name, level) = match.groups()
+        text = name.decode('utf-8', 'replace')
+    return (time, text, Level[level.decode('ascii')])
+
+
+class Query:
+    """What to look for in a log file.
+
+    since and until are (prefixes of) timestamps; level is the lowest
+    level wanted; names are fnmatch patterns, any of which a logger name
+    must match; and items are (key, value) pairs that must all be in the
+    log map. Non-string JSON values match their JSON form, e.g. "42" or
+    "true".
+    """
+
+    def __init__(self,
+                 since: Optional[str] = None,
+                 until: Optional[str] = None,
+                 level: Level = Level.NOTSET,
+                 names: Sequence[str] = (),
+                 items: Sequence[Tuple[str, str]] = ()):
+        self.since = since.encode('ascii') if since else None
+        self.until = until.encode('ascii') if until else None
+        self.level = level
+        self.names = list(names)
+        self.items = list(items)
+
+        # compiled once: simple lines must contain " key=value" followed
+        # by a space or the end of the line
+        self._simple_items = [
+            re.compile(b' ' + re.escape(key.encode('utf-8')) + b'=' +
+                       re.escape(value.encode('utf-8')) + rb'(?= |\r?\n|$)')
+            for (key, value) in self.items]
+        self._name_cache: Dict[str, bool] = {}
+
+    def match_name(self, name: str) -> bool:
+        if not self.names:
+            return True
+        try:
+            return self._name_cache[name]
+        except KeyError:
+            result = self._name_cache[name] = any(
+                fnmatch.fnmatchcase(name, pattern) for pattern in self.names)
+            return result
+
+    def match_items(self, line: bytes) -> bool:
+        if not self.items:
+            return True
+        if line.startswith(b'{'):
+            try:
+                data = json.loads(line)
+            except ValueError:
+                return False
+            for (key, value) in self.items:
+                if key not in data:
+                    return False
+                actual = data[key]
+                if not isinstance(actual, str):
+                    actual = json.dumps(actual)
+                if actual != value:
+                    return False
+            return True
+        return all(regex.search(line) for regex in self._simple_items)
+
+
+class Block:
+    """One block of an Index: where it starts, the time of its first
+    record, and bitmaps of the levels and logger names it contains
+    (bit n of names is Index.names[n])."""
+
+    __slots__ = ('offset', 'time', 'levels', 'names')
+
+    def __init__(self,
+                 offset: int,
+                 time: Optional[bytes] = None,
+                 levels: int = 0,
+                 names: int = 0):
+        self.offset = offset
+        self.time = time
+        self.levels = levels
+        self.names = names
+
+
+class Index:
+    """Sparse index of a log file, kept in a sidecar file.
+
+    The index covers the first "size" bytes of the file, in blocks of
+    about block_size bytes that each start at a line boundary. "head" is
+    a checksum of the start of the file, to spot a file that has been
+    replaced (e.g. rotated) rather than appended to.
+    """
+
+    def __init__(self, block_size: int = BLOCK_SIZE):
+        self.block_size = block_size
+        self.clear()
+
+    def clear(self) -> None:
+        self.size = 0
+        self.head = zlib.crc32(b'')
+        self.names: List[str] = []
+        self.blocks: List[Block] = []
+        self._name_ids: Dict[str, int] = {}
+
+    @classmethod
+    def load(cls, path: str) -> Index:
+        with open(path) as infile:
+            data = json.load(infile)
+        if data.get('version') != INDEX_VERSION:
+            raise QueryError('{}: unsupported index version'.format(path))
+        index = cls(data['block_size'])
+        index.size = data['size']
+        index.head = data['head']
+        index.names = data['names']
+        index._name_ids = {name: idx for (idx, name) in enumerate(index.names)}
+        index.blocks = [
+            Block(offset, time.encode('latin-1') if time else None,
+                  int(levels, 16), int(names, 16))
+            for (offset, time, levels, names) in data['blocks']]
+        return index
+
+    def save(self, path: str) -> None:
+        data = {
+            'version': INDEX_VERSION,
+            'block_size': self.block_size,
+            'size': self.size,
+            'head': self.head,
+            'names': self.names,
+            'blocks': [
+                [block.offset,
+                 block.time.decode('latin-1') if block.time else None,
+                 '{:x}'.format(block.levels),
+                 '{:x}'.format(block.names)]
+                for block in self.blocks],
+        }
+        # replace the old index atomically, so a concurrent query never
+        # reads half of one
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(data, outfile)
+        os.replace(tmp_path, path)
+
+    def update(self, data: Any) -> bool:
+        """Bring the index up to date with data (the file's contents).
+
+        Returns true if anything changed.
+        """
+        size = len(data)
+        if size < self.size or \
+           zlib.crc32(data[:min(self.size, _HEAD_SIZE)]) != self.head:
+            # not the file that was indexed: start over
+            self.clear()
+        elif size == self.size:
+            return False
+        # the last block may have grown, so index it again
+        start = self.blocks.pop().offset if self.blocks else 0
+        self.size = size
+        self.head = zlib.crc32(data[:min(size, _HEAD_SIZE)])
+
+        name_ids = self._name_ids
+        offset = start
+        while offset < size:
+            end = _next_line(data, min(offset + self.block_size, size), size)
+            block = Block(offset)
+            for line in _lines(data, offset, end):
+                parsed = parse_line(line)
+                if parsed is None:
+                    continue
+                (time, name, level) = parsed
+                if block.time is None:
+                    block.time = time
+                block.levels |= 1 << level
+                name_id = name_ids.get(name)
+                if name_id is None:
+                    name_id = name_ids[name] = len(self.names)
+                    self.names.append(name)
+                block.names |= 1 << name_id
+            self.blocks.append(block)
+            offset = end
+        return True
+
+    def ranges(self, query: Query) -> Iterator[Tuple[int, int]]:
+        """Yield (start, end) of the runs of blocks that may hold records
+        matching query's level and names."""
+        levels = 0
+        for level in Level:
+            if level >= query.level:
+                levels |= 1 << level
+        names = 0
+        for (name_id, name) in enumerate(self.names):
+            if query.match_name(name):
+                names |= 1 << name_id
+
+        ends = [block.offset for block in self.blocks[1:]] + [self.size]
+        run: Optional[List[int]] = None
+        for (block, end) in zip(self.blocks, ends):
+            if query.until is not None and block.time is not None \
+               and block.time >= query.until:
+                break
+            if block.levels & levels and block.names & names:
+                if run is None:
+                    run = [block.offset, end]
+                run[1] = end
+            elif run is not None:
+                yield (run[0], run[1])
+                run = None
+        if run is not None:
+            yield (run[0], run[1])
+
+
+def index_path(path: str) -> str:
+    return path + '.idx'
+
+
+def open_index(path: str, data: Any, block_size: int = BLOCK_SIZE) -> Index:
+    """Load the sidecar index for the log file at path (whose contents
+    are data), creating or updating it as needed."""
+    idx_path = index_path(path)
+    try:
+        index = Index.load(idx_path)
+    except (OSError, ValueError, KeyError, TypeError):
+        index = Index(block_size)
+    if index.block_size != block_size:
+        index = Index(block_size)
+    if index.update(data):
+        index.save(idx_path)
+    return index
+
+
+def _next_line(data: Any, pos: int, end: int) -> int:
+    # the start of the first line at or after pos
+    if pos == 0 or pos >= end or data[pos - 1] == 0x0a:
+        return min(pos, end)
+    newline = data.find(b'\n', pos, end)
+    return end if newline == -1 else newline + 1
+
+
+def _lines(data: Any, start: int, end: int) -> Iterator[bytes]:
+    # read in chunks, not line by line: slicing and splitting a chunk is
+    # much cheaper than a find() per line
+    while start < end:
+        chunk_end = _next_line(data, min(start + _CHUNK_SIZE, end), end)
+        yield from data[start:chunk_end].splitlines(keepends=True)
+        start = chunk_end
+
+
+def _line_time(data: Any, start: int, end: int) -> Tuple[Optional[bytes], int]:
+    # the time of the first record in data[start:end], and where its line
+    # starts (or (None, end) if there is none)
+    while start < end:
+        newline = data.find(b'\n', start, end)
+        line_end = end if newline == -1 else newline + 1
+        parsed = parse_line(data[start:line_end])
+        if parsed is not None:
+            return (parsed[0], start)
+        start = line_end
+    return (None, end)
+
+
+def bisect(data: Any, time: bytes, start: int = 0,
+           end: Optional[int] = None) -> int:
+    """Find where to start reading data[start:end] for records at or
+    after time: the offset of a line after every earlier record, and at
+    or before the first later one. start must be the start of a line.
+    """
+    if end is None:
+        end = len(data)
+    # every record starting before lo is earlier than time, and the first
+    # one that is not starts in [lo, hi]
+    (lo, hi) = (start, end)
+    while True:
+        mid = (lo + hi) // 2
+        pos = _next_line(data, mid, hi)
+        if pos >= hi:
+            newline = data.rfind(b'\n', lo, mid)
+            if newline == -1:
+                return lo
+            pos = newline + 1
+        (line_time, line_start) = _line_time(data, pos, hi)
+        if line_time is None:
+            hi = pos
+        elif line_time < time:
+            lo = _next_line(data, line_start + 1, hi)
+        else:
+            hi = line_start
+
+
+def search(data: Any, query: Query,
+           index: Optional[Index] = None) -> Iterator[bytes]:
+    """Yield the lines of data (a log file's contents, e.g. an mmap)
+    that match query."""
+    ranges: Iterable[Tuple[int, int]]
+    if index is not None:
+        ranges = list(index.ranges(query))
+    else:
+        ranges = [(0, len(data))]
+    since = query.since
+    until = query.until
+    level = query.level
+
+    for (start, end) in ranges:
+        if since is not None:
+            start = bisect(data, since, start, end)
+        for line in _lines(data, start, end):
+            parsed = parse_line(line)
+            if parsed is None:
+                continue
+            (line_time, name, line_level) = parsed
+            if since is not None and line_time < since:
+                continue
+            if until is not None and line_time >= until:
+                return
+            if line_level >= level and query.match_name(name) \
+               and query.match_items(line):
+                yield line
+
+
+def query_file(path: str, query: Query, use_index: bool = False,
+               block_size: int = BLOCK_SIZE) -> Iterator[bytes]:
+    """Yield the lines of the log file at path that match query."""
+    with open(path, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            index = open_index(path, data, block_size) if use_index else None
+            yield from search(data, query, index)
+
+
+def _parse_item(text: str) -> Tuple[str, str]:
+    (key, sep, value) = text.partition('=')
+    if not sep or not key:
+        raise argparse.ArgumentTypeError(
+            'expected KEY=VALUE, not {!r}'.format(text))
+    return (key, value)
+
+
+def _parse_level(text: str) -> Level:
+    try:
+        return Level[text.upper()]
+    except KeyError:
+        raise argparse.ArgumentTypeError('unknown level: {!r}'.format(text))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog='python -m lolog.query',
+        description='Print the lines of lolog output files that match.')
+    parser.add_argument('--since', metavar='TIME',
+                        help='only records at or after TIME '
+                             '(a timestamp, or a prefix of one)')
+    parser.add_argument('--until', metavar='TIME',
+                        help='only records before TIME')
+    parser.add_argument('--level', type=_parse_level, default=Level.NOTSET,
+                        help='only records at LEVEL or above')
+    parser.add_argument('--name', action='append', default=[],
+                        metavar='PATTERN',
+                        help='only records from loggers matching PATTERN '
+                             '(fnmatch syntax; may be repeated)')
+    parser.add_argument('--item', action='append', default=[],
+                        type=_parse_item, metavar='KEY=VALUE',
+                        help='only records with KEY=VALUE in their log map '
+                             '(may be repeated)')
+    parser.add_argument('--index', action='store_true',
+                        help='use (and create or update) a sparse index '
+                             'in FILE.idx')
+    parser.add_argument('--block-size', type=float, default=1, metavar='MB',
+                        help='index block size in MiB (default: 1)')
+    parser.add_argument('files', nargs='+', metavar='FILE',
+                        help='simple or JSON lolog output files')
+    args = parser.parse_args(argv)
+
+    query = Query(since=args.since, until=args.until, level=args.level,
+                  names=args.name, items=args.item)
+    block_size = max(1, int(args.block_size * BLOCK_SIZE))
+    out = sys.stdout.buffer
+    for path in args.files:
+        try:
+            out.writelines(query_file(path, query, args.index, block_size))
+        except (OSError, QueryError) as err:
+            parser.exit(1, '{}: {}\n'.format(path, err))
+    out.flush()
+
+
+if __name__ == '__main__':
+    main()
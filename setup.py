@@ -1,4 +1,4 @@
-from setuptools import setup
+from setuptools import Extension, setup
 
 dev_requires = [
     "flake8 >= 4.0.0",
@@ -15,6 +15,11 @@ setup(
     author_email="greg@gerg.ca",
     description='low-overhead structured logging library',
     packages=['lolog'],
+    # compiled versions of the pylolog hot path: lolog falls back to pure
+    # Python if this cannot be built
+    ext_modules=[
+        Extension('lolog._speedups', ['src/speedups.c'], optional=True),
+    ],
     install_requires=[],
     extras_require={
         "dev": dev_requires,
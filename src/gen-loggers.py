@@ -1,7 +1,7 @@
 #!/usr/bin/python3
 
-"""Generate a family of logger functions: _{format}_debug(),
-_{format}_info(), etc.
+"""Generate a family of logger functions: {prefix}_debug(),
+{prefix}_info(), etc., which all call {prefix}_log().
 
 The generated source file does not compile on its own! It must
 be #include'd by lolog.c at the right place.
@@ -11,23 +11,23 @@ import sys
 
 TEMPLATE = """
 static void
-{format}_{level_name}(lol_logger_t *self, char *message, ...) {{
+{prefix}_{level_name}(lol_logger_t *self, char *message, ...) {{
     va_list argp;
 
     va_start(argp, message);
-    {format}_log(self, {level_const}, message, argp);
+    {prefix}_log(self, {level_const}, message, argp);
     va_end(argp);
 }}
 """
 
 def main():
-    format = sys.argv[1]
+    prefix = sys.argv[1]
     outfile = sys.argv[2]
     with open(outfile, "w") as outfile:
         outfile.write("/* generated -- do not edit */\n")
         for level in ["debug", "info", "warning", "error", "critical"]:
             outfile.write(TEMPLATE.format(
-                format=format,
+                prefix=prefix,
                 level_name=level,
                 level_const="LOL_" + level.upper(),
             ))
@@ -1,9 +1,14 @@
+/* for clock_gettime() */
+#define _POSIX_C_SOURCE 200809L
+
 #include <fnmatch.h>
+#include <pthread.h>
 #include <stdarg.h>
 #include <stdbool.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <time.h>
 
 #include "lolog.h"
 
@@ -11,22 +16,30 @@
 
 // map lol_level_t to string version
 static char *level_label[] = {"", "D", "I", "W", "E", "C", ""};
+static char *level_name[] = {
+    "NOTSET", "DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL", "SILENT",
+};
 
 static void
 free_context(lol_context_t *context) {
     lol_context_t *next;
     for (; context != NULL; context = next) {
         next = context->next;
+        if (context->ttl > 0) {
+            pthread_mutex_destroy(&context->mutex);
+        }
+        free(context->cached);
         free(context);
     }
 }
 
 /**
  * Append new context record to the end of a context list
- * (order matters!)
+ * (order matters!), which is found by its tail pointer
  */
-static void
+static lol_context_t *
 append_context(lol_context_t **head,
+               lol_context_t **tail,
                char *key,
                char *value,
                char *(*valuefunc)()) {
@@ -34,18 +47,47 @@ append_context(lol_context_t **head,
     context->key = key;
     context->value = value;
     context->valuefunc = valuefunc;
+    context->ttl = 0;
+    context->cached = NULL;
+    context->expires = 0;
     context->next = NULL;
 
-    lol_context_t *tail;
-    for (tail = *head; tail && tail->next; tail = tail->next) {
-    }
-    if (!tail) {
+    if (!*tail) {
         *head = context;
     } else {
-        tail->next = context;
+        (*tail)->next = context;
+    }
+    *tail = context;
+    return context;
+}
+
+/**
+ * Append dynamic context whose value is reused for ttl seconds, rather
+ * than computed afresh for every line (pass INFINITY to compute it
+ * just once)
+ */
+static void
+append_cached_context(lol_context_t **head,
+                      lol_context_t **tail,
+                      char *key,
+                      char *(*valuefunc)(),
+                      double ttl) {
+    lol_context_t *context = append_context(head, tail, key, NULL, valuefunc);
+    // with no ttl, this is just dynamic context, which needs no mutex (and
+    // free_context() only destroys the mutex of contexts with a ttl)
+    if (ttl > 0) {
+        context->ttl = ttl;
+        pthread_mutex_init(&context->mutex, NULL);
     }
 }
 
+static double
+monotonic_time() {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return now.tv_sec + now.tv_nsec / 1e9;
+}
+
 
 /* private internals -- lol_config_t */
 
@@ -60,18 +102,32 @@ config_set_level(lol_config_t *self, char *pattern, lol_level_t level) {
     self->logger_configs = logger_config;
 }
 
+static void
+config_set_format(lol_config_t *self, lol_format_t format) {
+    self->format = format;
+}
+
 static void
 config_add_static_context(lol_config_t *self,
                           char *key,
                           char *value) {
-    append_context(&self->context, key, value, NULL);
+    append_context(&self->context, &self->context_tail, key, value, NULL);
 }
 
 static void
 config_add_dynamic_context(lol_config_t *self,
                            char *key,
                            char *(*valuefunc)()) {
-    append_context(&self->context, key, NULL, valuefunc);
+    append_context(&self->context, &self->context_tail, key, NULL, valuefunc);
+}
+
+static void
+config_add_cached_context(lol_config_t *self,
+                          char *key,
+                          char *(*valuefunc)(),
+                          double ttl) {
+    append_cached_context(&self->context, &self->context_tail,
+                          key, valuefunc, ttl);
 }
 
 static lol_config_t *
@@ -88,21 +144,160 @@ get_config() {
 
 /* private internals -- lol_logger_t */
 
-#define MAX_ITEMS 64
-
-// includes terminating nul character
-#define MAX_OUTPUT 4096
-
 typedef struct {
     char *key;
     char *value;
     bool alloced;
 } item_t;
 
+/**
+ * Per-thread output state: the line being formatted, and the items that
+ * go into it. Both grow as needed and are reused for every line, so
+ * neither lines nor the number of items are limited, and a thread that
+ * keeps logging does not allocate.
+ *
+ * A context valuefunc may log itself, while the outer line is still
+ * being built: that nested call gets the next output_t in the chain.
+ */
+typedef struct output {
+    char *buf;
+    size_t len;
+    size_t size;
+
+    item_t *items;
+    int num_items;
+    int max_items;
+
+    // items before this index are context, the rest are for this line
+    int num_context;
+
+    // in use by a line_log() call on this thread
+    bool busy;
+    struct output *nested;
+} output_t;
+
+static pthread_key_t output_key;
+static pthread_once_t output_once = PTHREAD_ONCE_INIT;
+
+static void
+out_of_memory() {
+    fprintf(stderr, "lolog: out of memory\n");
+    abort();
+}
+
+static void
+free_output(void *ptr) {
+    output_t *out = ptr, *nested;
+    for (; out != NULL; out = nested) {
+        nested = out->nested;
+        free(out->buf);
+        free(out->items);
+        free(out);
+    }
+}
+
+static void
+make_output_key() {
+    pthread_key_create(&output_key, free_output);
+}
+
+static output_t *
+make_output() {
+    output_t *out = calloc(1, sizeof(output_t));
+    if (out) {
+        out->size = 256;
+        out->buf = malloc(out->size);
+    }
+    if (!out || !out->buf) {
+        out_of_memory();
+    }
+    return out;
+}
+
+/**
+ * Return this thread's first output_t that is not in use (by an outer
+ * line_log() call that is running a valuefunc), and mark it busy
+ */
+static output_t *
+get_output() {
+    pthread_once(&output_once, make_output_key);
+    output_t *out = pthread_getspecific(output_key);
+    if (!out) {
+        out = make_output();
+        pthread_setspecific(output_key, out);
+    }
+    while (out->busy) {
+        if (!out->nested) {
+            out->nested = make_output();
+        }
+        out = out->nested;
+    }
+    out->busy = true;
+    return out;
+}
+
+/**
+ * Make room for at least needed more bytes in out->buf
+ */
+static void
+reserve(output_t *out, size_t needed) {
+    if (out->size - out->len >= needed) {
+        return;
+    }
+    size_t size = out->size;
+    while (size - out->len < needed) {
+        size *= 2;
+    }
+    char *buf = realloc(out->buf, size);
+    if (!buf) {
+        out_of_memory();
+    }
+    out->buf = buf;
+    out->size = size;
+}
+
+static inline void
+append_char(output_t *out, char ch) {
+    reserve(out, 1);
+    out->buf[out->len++] = ch;
+}
+
+static void
+append_data(output_t *out, const char *data, size_t len) {
+    reserve(out, len);
+    memcpy(out->buf + out->len, data, len);
+    out->len += len;
+}
+
+/**
+ * Append a nul-terminated string, copying it in one pass rather than
+ * measuring it first
+ */
+static void
+append_string(output_t *out, const char *str) {
+    if (!str) {
+        return;
+    }
+    while (true) {
+        char *dst = out->buf + out->len;
+        char *end = out->buf + out->size;
+        while (dst < end && *str) {
+            *dst++ = *str++;
+        }
+        out->len = dst - out->buf;
+        if (!*str) {
+            return;
+        }
+        reserve(out, 64);
+    }
+}
+
 static void
 configure_logger(lol_logger_t *self) {
     lol_config_t *config = get_config();
     self->config = config;
+    self->fh = config->fh;
+    self->level = config->default_level;
     lol_logger_config_t *logger_config;
     for (logger_config = config->logger_configs;
          logger_config != NULL;
@@ -116,55 +311,64 @@ configure_logger(lol_logger_t *self) {
 }
 
 static void
-add_item(item_t *items,
-         int *item_idx,
+add_item(output_t *out,
          char *key,
          char *value,
          bool alloced) {
-    items[*item_idx].key = key;
-    items[*item_idx].value = value;
-    items[*item_idx].alloced = alloced;
-    (*item_idx)++;
+    if (out->num_items == out->max_items) {
+        int max_items = out->max_items ? out->max_items * 2 : 16;
+        item_t *items = realloc(out->items, max_items * sizeof(item_t));
+        if (!items) {
+            out_of_memory();
+        }
+        out->items = items;
+        out->max_items = max_items;
+    }
+    item_t *item = &out->items[out->num_items++];
+    item->key = key;
+    item->value = value;
+    item->alloced = alloced;
 }
 
 static void
-add_context_items(item_t *items,
-                  int *item_idx,
-                  lol_context_t *context) {
+add_context_items(output_t *out, lol_context_t *context) {
     for (; context; context = context->next) {
-        if (context->valuefunc) {
-            add_item(items,
-                     item_idx,
-                     context->key,
-                     context->valuefunc(),
-                     true);
+        if (context->ttl > 0) {
+            // cached dynamic context: another thread may replace (and
+            // free) the value as soon as we unlock, so take a copy
+            double now = monotonic_time();
+            pthread_mutex_lock(&context->mutex);
+            if (!context->cached || now >= context->expires) {
+                free(context->cached);
+                context->cached = context->valuefunc();
+                context->expires = now + context->ttl;
+            }
+            char *value = context->cached;
+            if (value && !(value = strdup(value))) {
+                out_of_memory();
+            }
+            pthread_mutex_unlock(&context->mutex);
+            add_item(out, context->key, value, true);
+        } else if (context->valuefunc) {
+            add_item(out, context->key, context->valuefunc(), true);
         } else {
-            add_item(items,
-                     item_idx,
-                     context->key,
-                     context->value,
-                     false);
+            add_item(out, context->key, context->value, false);
         }
     }
 }
 
-static int
-build_items(lol_logger_t *self,
-            lol_level_t level,
-            item_t *items,
-            char *message,
-            va_list argp) {
-    // build list of items (key/value pairs), starting with context
-    int item_idx = 0;
-    add_context_items(items, &item_idx, self->config->context);
-    add_context_items(items, &item_idx, self->context);
-
-    // add level, name, message
-    add_item(items, &item_idx, "level", level_label[level], false);
-    add_item(items, &item_idx, "name", self->name, false);
-    add_item(items, &item_idx, "message", message, false);
-
-    // and finish with the items for this line
+/**
+ * Build the list of items (key/value pairs) for one line in out->items:
+ * context first, then the items for this line. Level, name and message
+ * are not items: each formatter puts them where it wants them.
+ */
+static void
+build_items(lol_logger_t *self, output_t *out, va_list argp) {
+    out->num_items = 0;
+    add_context_items(out, self->config->context);
+    add_context_items(out, self->context);
+    out->num_context = out->num_items;
+
     char *key, *value;
     while (true) {
         key = va_arg(argp, char *);
@@ -172,63 +376,270 @@ build_items(lol_logger_t *self,
             break;
         }
         value = va_arg(argp, char *);
-        add_item(items, &item_idx, key, value, false);
+        add_item(out, key, value, false);
     }
+}
 
-    return item_idx;            /* number of items */
+static void
+free_items(output_t *out) {
+    for (int item_idx = 0; item_idx < out->num_items; item_idx++) {
+        if (out->items[item_idx].alloced) {
+            free(out->items[item_idx].value);
+        }
+    }
+    out->num_items = 0;
 }
 
 static void
-simple_format(item_t *items, int num_items, char *buf, size_t max_output) {
-    // max_output - 1 to leave room for the newline
-    size_t remaining = max_output - 1;
+append_simple_item(output_t *out, char *key, char *value) {
+    append_string(out, key);
+    append_char(out, '=');
+    append_string(out, value);
+    append_char(out, ' ');
+}
 
-    // format all items into the output buffer, and then write it
-    bool truncated = false;
-    int offset = 0;
-    for (int item_idx = 0; item_idx < num_items; item_idx++) {
-        item_t item = items[item_idx];
-        size_t key_len = strlen(item.key);
-        size_t value_len = strlen(item.value);
-        int needed = key_len + 1 + value_len + 1;
-        if (!truncated && needed > remaining) {
-            truncated = true;   /* print warning? */
+/**
+ * Format a line with no attempt at escaping or anything. It's not
+ * machine-readable! This is only suitable for debugging and human
+ * consumption.
+ */
+static void
+simple_format(output_t *out,
+              lol_logger_t *self,
+              lol_level_t level,
+              char *message) {
+    item_t *items = out->items;
+    int num_context = out->num_context;
+    for (int item_idx = 0; item_idx < num_context; item_idx++) {
+        append_simple_item(out, items[item_idx].key, items[item_idx].value);
+    }
+    append_simple_item(out, "level", level_label[level]);
+    append_simple_item(out, "name", self->name);
+    append_simple_item(out, "message", message);
+    for (int item_idx = num_context; item_idx < out->num_items; item_idx++) {
+        append_simple_item(out, items[item_idx].key, items[item_idx].value);
+    }
+    out->buf[out->len - 1] = '\n';
+}
+
+/**
+ * Decode one UTF-8 character from str, setting *len to the number of
+ * bytes used; invalid bytes decode to U+FFFD, replacing the longest
+ * valid prefix of a sequence at a time (as Python's decoder does)
+ */
+static unsigned int
+decode_utf8(const unsigned char *str, int *len) {
+    unsigned int ch = str[0];
+    // the second byte has a narrower range for some first bytes, which
+    // rules out overlong forms, surrogates and values over U+10FFFF
+    unsigned char low = 0x80, high = 0xbf;
+    int extra;
+    if (ch >= 0xc2 && ch <= 0xdf) {
+        ch &= 0x1f;
+        extra = 1;
+    } else if (ch >= 0xe0 && ch <= 0xef) {
+        low = ch == 0xe0 ? 0xa0 : 0x80;
+        high = ch == 0xed ? 0x9f : 0xbf;
+        ch &= 0x0f;
+        extra = 2;
+    } else if (ch >= 0xf0 && ch <= 0xf4) {
+        low = ch == 0xf0 ? 0x90 : 0x80;
+        high = ch == 0xf4 ? 0x8f : 0xbf;
+        ch &= 0x07;
+        extra = 3;
+    } else {
+        *len = 1;
+        return 0xfffd;
+    }
+    for (int idx = 1; idx <= extra; idx++) {
+        if (str[idx] < low || str[idx] > high) {
+            *len = idx;
+            return 0xfffd;
+        }
+        ch = (ch << 6) | (str[idx] & 0x3f);
+        low = 0x80;
+        high = 0xbf;
+    }
+    *len = extra + 1;
+    return ch;
+}
+
+static void
+append_json_escape(output_t *out, unsigned int ch) {
+    static const char hex[] = "0123456789abcdef";
+    char *dst = out->buf + out->len;
+    *dst++ = '\\';
+    *dst++ = 'u';
+    *dst++ = hex[(ch >> 12) & 0xf];
+    *dst++ = hex[(ch >> 8) & 0xf];
+    *dst++ = hex[(ch >> 4) & 0xf];
+    *dst++ = hex[ch & 0xf];
+    out->len += 6;
+}
+
+/**
+ * Append str as a JSON string, escaped exactly as Python's
+ * json.encoder.encode_basestring_ascii() does, so that C and Python
+ * services write identical JSON; NULL is written as null
+ */
+static void
+append_json_string(output_t *out, const char *str) {
+    if (!str) {
+        append_data(out, "null", 4);
+        return;
+    }
+    append_char(out, '"');
+    const unsigned char *src = (const unsigned char *) str;
+    while (*src) {
+        // enough for the longest escape, a surrogate pair
+        reserve(out, 12);
+        unsigned char ch = *src;
+        if (ch >= 0x20 && ch < 0x7f && ch != '"' && ch != '\\') {
+            out->buf[out->len++] = ch;
+            src++;
+            continue;
+        }
+        char *esc = NULL;
+        switch (ch) {
+        case '"': esc = "\\\""; break;
+        case '\\': esc = "\\\\"; break;
+        case '\n': esc = "\\n"; break;
+        case '\r': esc = "\\r"; break;
+        case '\t': esc = "\\t"; break;
+        case '\b': esc = "\\b"; break;
+        case '\f': esc = "\\f"; break;
+        }
+        if (esc) {
+            out->buf[out->len++] = esc[0];
+            out->buf[out->len++] = esc[1];
+            src++;
+        } else if (ch < 0x80) {
+            append_json_escape(out, ch);
+            src++;
+        } else {
+            int len;
+            unsigned int code = decode_utf8(src, &len);
+            if (code >= 0x10000) {
+                code -= 0x10000;
+                append_json_escape(out, 0xd800 | (code >> 10));
+                append_json_escape(out, 0xdc00 | (code & 0x3ff));
+            } else {
+                append_json_escape(out, code);
+            }
+            src += len;
         }
+    }
+    append_char(out, '"');
+}
+
+static void
+append_json_item(output_t *out, char *key, char *value) {
+    append_data(out, ", ", 2);
+    append_json_string(out, key);
+    append_data(out, ": ", 2);
+    append_json_string(out, value);
+}
 
-        if (!truncated) {
-            strncpy(buf + offset,
-                    item.key,
-                    remaining);
-            buf[offset + key_len] = '=';
-            offset += key_len + 1;
-            remaining -= key_len + 1;
-
-            strncpy(buf + offset,
-                    item.value,
-                    remaining);
-            bool is_last = (item_idx == num_items - 1);
-            buf[offset + value_len] = is_last ? '\n' : ' ';
-            offset += value_len + 1;
-            remaining -= value_len + 1;
-            buf[offset] = 0;
+/**
+ * Find the value for key, which is the last item with that key (or
+ * value if there is none), as in a Python dict
+ */
+static char *
+last_value(item_t *items, int start, int end, char *key, char *value) {
+    for (int item_idx = start; item_idx < end; item_idx++) {
+        if (strcmp(items[item_idx].key, key) == 0) {
+            value = items[item_idx].value;
         }
+    }
+    return value;
+}
+
+static bool
+is_builtin_key(char *key) {
+    return (strcmp(key, "time") == 0 ||
+            strcmp(key, "message") == 0 ||
+            strcmp(key, "name") == 0 ||
+            strcmp(key, "level") == 0);
+}
+
+/**
+ * Format the current time like the Python Config.format_time_local():
+ * local time, ISO 8601 with microseconds and no zone
+ */
+static void
+format_local_time(char *buf, size_t size) {
+    struct timespec now;
+    struct tm tm;
+    clock_gettime(CLOCK_REALTIME, &now);
+    localtime_r(&now.tv_sec, &tm);
+    size_t len = strftime(buf, size, "%Y-%m-%dT%H:%M:%S", &tm);
+    snprintf(buf + len, size - len, ".%06ld", now.tv_nsec / 1000);
+}
 
-        if (item.alloced) {
-            free(item.value);
+/**
+ * Format a line as one JSON object with the same keys, in the same
+ * order, as the Python format_json(): time, message, name and level first,
+ * then every other key once, in order of first appearance, with its
+ * last value. (Lines have few keys, so looking for repeats is a simple
+ * quadratic scan.)
+ */
+static void
+json_format(output_t *out,
+            lol_logger_t *self,
+            lol_level_t level,
+            char *message) {
+    item_t *items = out->items;
+    int num_items = out->num_items;
+    char time[32];
+    format_local_time(time, sizeof(time));
+
+    append_data(out, "{\"time\": ", 9);
+    append_json_string(out, last_value(items, 0, num_items, "time", time));
+    append_data(out, ", \"message\": ", 13);
+    append_json_string(out, last_value(items, 0, num_items, "message", message));
+    append_data(out, ", \"name\": ", 10);
+    append_json_string(out, last_value(items, 0, num_items, "name", self->name));
+    append_data(out, ", \"level\": ", 11);
+    append_json_string(
+        out, last_value(items, 0, num_items, "level", level_name[level]));
+
+    for (int item_idx = 0; item_idx < num_items; item_idx++) {
+        char *key = items[item_idx].key;
+        if (is_builtin_key(key)) {
+            continue;
+        }
+        bool seen = false;
+        for (int prev_idx = 0; prev_idx < item_idx && !seen; prev_idx++) {
+            seen = strcmp(items[prev_idx].key, key) == 0;
+        }
+        if (!seen) {
+            append_json_item(
+                out,
+                key,
+                last_value(items, item_idx + 1, num_items, key,
+                           items[item_idx].value));
         }
     }
+    append_data(out, "}\n", 2);
 }
 
+typedef void (*formatter_t)(output_t *out,
+                            lol_logger_t *self,
+                            lol_level_t level,
+                            char *message);
+
+// map lol_format_t to formatter
+static formatter_t formatters[] = {simple_format, json_format};
+
 /**
- * Emit a log message with no attempt at formatting or escaping or anything.
- * It's not machine-readable! This is only suitable for debugging and
- * human consumption.
+ * Format a log line in this thread's output buffer and write it with a
+ * single fwrite(), so lines from different threads never interleave
  */
 static void
-simple_log(lol_logger_t *self,
-           lol_level_t level,
-           char *message,
-           va_list argp) {
+line_log(lol_logger_t *self,
+         lol_level_t level,
+         char *message,
+         va_list argp) {
     if (self->level == LOL_NOTSET) {
         configure_logger(self);
     }
@@ -237,30 +648,40 @@ simple_log(lol_logger_t *self,
         return;
     }
 
-    item_t items[MAX_ITEMS];
-    int num_items = build_items(self, level, items, message, argp);
-
-    char buf[MAX_OUTPUT];
-    simple_format(items, num_items, buf, MAX_OUTPUT);
+    output_t *out = get_output();
+    build_items(self, out, argp);
+    out->len = 0;
+    formatters[self->config->format](out, self, level, message);
+    free_items(out);
 
-    fputs(buf, self->fh);
+    fwrite(out->buf, 1, out->len, self->fh);
     fflush(self->fh);
+    out->busy = false;
 }
 
-#include "gen/simple-loggers.c"
+#include "gen/loggers.c"
 
 static void
 logger_add_static_context(lol_logger_t *self,
                           char *key,
                           char *value) {
-    append_context(&self->context, key, value, NULL);
+    append_context(&self->context, &self->context_tail, key, value, NULL);
 }
 
 static void
 logger_add_dynamic_context(lol_logger_t *self,
                            char *key,
                            char *(*valuefunc)()) {
-    append_context(&self->context, key, NULL, valuefunc);
+    append_context(&self->context, &self->context_tail, key, NULL, valuefunc);
+}
+
+static void
+logger_add_cached_context(lol_logger_t *self,
+                          char *key,
+                          char *(*valuefunc)(),
+                          double ttl) {
+    append_cached_context(&self->context, &self->context_tail,
+                          key, valuefunc, ttl);
 }
 
 /* public interface */
@@ -269,12 +690,16 @@ lol_config_t *
 lol_make_config(lol_level_t default_level, FILE *fh) {
     lol_config_t *config = malloc(sizeof(lol_config_t));
     config->default_level = default_level;
+    config->format = LOL_FORMAT_SIMPLE;
     config->context = NULL;
+    config->context_tail = NULL;
     config->fh = fh;
     config->logger_configs = NULL;
     config->set_level = config_set_level;
+    config->set_format = config_set_format;
     config->add_context = config_add_static_context;
     config->add_dynamic_context = config_add_dynamic_context;
+    config->add_cached_context = config_add_cached_context;
     default_config = config;
     return config;
 }
@@ -299,13 +724,15 @@ lol_make_logger(char *name) {
     logger->level = LOL_NOTSET;
     logger->fh = stdout;
     logger->context = NULL;
-    logger->debug = simple_debug;
-    logger->info = simple_info;
-    logger->warning = simple_warning;
-    logger->error = simple_error;
-    logger->critical = simple_critical;
+    logger->context_tail = NULL;
+    logger->debug = line_debug;
+    logger->info = line_info;
+    logger->warning = line_warning;
+    logger->error = line_error;
+    logger->critical = line_critical;
     logger->add_context = logger_add_static_context;
     logger->add_dynamic_context = logger_add_dynamic_context;
+    logger->add_cached_context = logger_add_cached_context;
     return logger;
 }
 
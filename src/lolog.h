@@ -1,3 +1,4 @@
+#include <pthread.h>
 #include <stdio.h>
 
 typedef enum {
@@ -10,10 +11,25 @@ typedef enum {
     LOL_SILENT,                 /* no logs ever emitted at this level */
 } lol_level_t;
 
+typedef enum {
+    LOL_FORMAT_SIMPLE,          /* key=value, for humans (the default) */
+    LOL_FORMAT_JSON,            /* one JSON object per line */
+} lol_format_t;
+
 typedef struct lol_context_t {
     char *key;
     char *value;
     char *(*valuefunc)();
+
+    // for cached dynamic context: how long (in seconds) to keep the last
+    // value returned by valuefunc, the value, and when it expires, all
+    // guarded by mutex (lines copy the value, so it can be replaced while
+    // other threads are formatting it)
+    double ttl;
+    char *cached;
+    double expires;
+    pthread_mutex_t mutex;
+
     struct lol_context_t *next;
 } lol_context_t;
 
@@ -25,17 +41,24 @@ typedef struct lol_logger_config_t {
 
 typedef struct lol_config_t {
     lol_level_t default_level;
+    lol_format_t format;
     lol_context_t *context;
+    lol_context_t *context_tail;
     FILE *fh;
     lol_logger_config_t *logger_configs;
 
     void (*set_level)(struct lol_config_t *self, char *name, lol_level_t level);
+    void (*set_format)(struct lol_config_t *self, lol_format_t format);
     void (*add_context)(struct lol_config_t *self,
                         char *key,
                         char *value);
     void (*add_dynamic_context)(struct lol_config_t *self,
                                 char *key,
                                 char *(*valuefunc)());
+    void (*add_cached_context)(struct lol_config_t *self,
+                               char *key,
+                               char *(*valuefunc)(),
+                               double ttl);
 } lol_config_t;
 
 typedef struct lol_logger_t {
@@ -44,6 +67,7 @@ typedef struct lol_logger_t {
     lol_level_t level;
     FILE *fh;
     lol_context_t *context;
+    lol_context_t *context_tail;
 
     void (*debug)(struct lol_logger_t *self, char *message, ...);
     void (*info)(struct lol_logger_t *self, char *message, ...);
@@ -57,6 +81,10 @@ typedef struct lol_logger_t {
     void (*add_dynamic_context)(struct lol_logger_t *self,
                                 char *key,
                                 char *(*valuefunc)());
+    void (*add_cached_context)(struct lol_logger_t *self,
+                               char *key,
+                               char *(*valuefunc)(),
+                               double ttl);
 
 } lol_logger_t;
 
@@ -0,0 +1,1379 @@
+/*
+ * lolog._speedups: compiled versions of the pylolog hot path
+ *
+ * Each function here does exactly what the Python function of the same
+ * name in lolog/pylolog.py does, and pylolog uses it instead when this
+ * extension has been built. The Python objects they rely on (Record,
+ * LogMapLayer, the JSON helpers, ...) are handed over by pylolog through
+ * setup(), so there is only one definition of each.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <math.h>
+#include <stddef.h>
+
+/* set by setup() */
+static PyTypeObject *Record_type = NULL;
+static PyTypeObject *LogMapLayer_type = NULL;
+static PyObject *local_log_map = NULL;
+static PyObject *format_simple_item = NULL;
+static PyObject *format_json_item = NULL;
+static PyObject *format_json_dict = NULL;
+static PyObject *json_encode = NULL;
+static PyObject *encode_basestring_ascii = NULL;
+static PyObject *json_builtin_keys = NULL;     /* as a tuple */
+
+/* '"key": ' for recently seen keys of per-message items */
+static PyObject *json_key_cache = NULL;
+#define MAX_JSON_KEY_CACHE 1024
+
+/* interned attribute names and constant strings, created at import */
+static PyObject *str_time, *str_name, *str_level, *str_message, *str_outbuf;
+static PyObject *str_layers, *str__log_map, *str__values, *str_config;
+static PyObject *str_generation, *str_log_map, *str__update_level;
+static PyObject *str_run_pipeline, *str_format_time, *str_get_layers;
+static PyObject *str_get_fragments, *str_get_keys, *str_evaluate;
+static PyObject *str_append;
+static PyObject *str_empty, *str_space, *str_equals, *str_newline;
+static PyObject *str_name_equals, *str_level_equals, *str_comma;
+static PyObject *str_json_time, *str_json_message, *str_json_name;
+static PyObject *str_json_level, *str_json_end, *str_json_colon;
+static PyObject *str_json_true, *str_json_false, *str_json_null;
+static PyObject *parts_var;     /* ContextVar holding a parts_t capsule */
+static PyObject *empty_tuple;
+
+/* check the number of arguments, and that setup() has been called */
+static int
+check_args(const char *name, Py_ssize_t nargs, Py_ssize_t expected) {
+    if (nargs != expected) {
+        PyErr_Format(PyExc_TypeError,
+                     "%s() takes %zd arguments (%zd given)",
+                     name, expected, nargs);
+        return -1;
+    }
+    if (Record_type == NULL) {
+        PyErr_SetString(PyExc_RuntimeError,
+                        "lolog._speedups: setup() has not been called");
+        return -1;
+    }
+    return 0;
+}
+
+/*
+ * The formatters collect the pieces of a line in a per-thread parts
+ * buffer, which is reused for every record, and join them with a single
+ * allocation: so formatting a line allocates the strings that are new
+ * in it (formatted values, the line itself), and nothing else.
+ *
+ * A formatter takes the buffer with parts_start(), appends to it, and
+ * gives back what it appended with parts_join() or parts_release().
+ * Evaluating a callable value can log, so formatters can nest: a nested
+ * one just works on top of the outer one's parts.
+ *
+ * The same per-thread state keeps a spare record for the log methods:
+ * see recycle_record().
+ *
+ * "Per-thread" really means per context (in the contextvars sense), so
+ * that each greenlet gets its own: a callable value can switch to another
+ * greenlet halfway through a line, and that one must not add its parts
+ * to ours. (A context copied to another thread is not shared, but one
+ * copied to another greenlet on the same thread would be: give each
+ * greenlet a new context, as greenlet does by default.)
+ */
+typedef struct {
+    PyObject **items;           /* owned references to str */
+    Py_ssize_t count;
+    Py_ssize_t size;
+
+    PyObject *record;           /* owned, or NULL */
+
+    PyThreadState *tstate;      /* the thread that made this */
+} parts_t;
+
+static void
+free_parts(PyObject *capsule) {
+    parts_t *parts = PyCapsule_GetPointer(capsule, NULL);
+    for (Py_ssize_t idx = 0; idx < parts->count; idx++) {
+        Py_DECREF(parts->items[idx]);
+    }
+    Py_XDECREF(parts->record);
+    PyMem_Free(parts->items);
+    PyMem_Free(parts);
+}
+
+/* this context's parts buffer (kept in a context variable, so it goes
+ * away with the thread or greenlet) */
+static parts_t *
+thread_parts(void) {
+    PyThreadState *tstate = PyThreadState_Get();
+    PyObject *capsule;
+    if (PyContextVar_Get(parts_var, NULL, &capsule) < 0) {
+        return NULL;
+    }
+    if (capsule != NULL) {
+        /* (the context keeps the capsule alive) */
+        parts_t *parts = PyCapsule_GetPointer(capsule, NULL);
+        Py_DECREF(capsule);
+        if (parts->tstate == tstate) {
+            return parts;
+        }
+    }
+
+    parts_t *parts = PyMem_Calloc(1, sizeof(parts_t));
+    if (parts == NULL) {
+        PyErr_NoMemory();
+        return NULL;
+    }
+    parts->tstate = tstate;
+    capsule = PyCapsule_New(parts, NULL, free_parts);
+    if (capsule == NULL) {
+        PyMem_Free(parts);
+        return NULL;
+    }
+    PyObject *token = PyContextVar_Set(parts_var, capsule);
+    Py_DECREF(capsule);
+    if (token == NULL) {
+        return NULL;
+    }
+    Py_DECREF(token);
+    return parts;
+}
+
+/* this thread's parts buffer, and where the caller's parts will start */
+static parts_t *
+parts_start(Py_ssize_t *start) {
+    parts_t *parts = thread_parts();
+    if (parts != NULL) {
+        *start = parts->count;
+    }
+    return parts;
+}
+
+/* append text, stealing the reference to it */
+static int
+parts_append_steal(parts_t *parts, PyObject *text) {
+    if (text == NULL) {
+        return -1;
+    }
+    if (!PyUnicode_Check(text)) {
+        PyErr_Format(PyExc_TypeError,
+                     "formatted log output must be str, not %.200s",
+                     Py_TYPE(text)->tp_name);
+        Py_DECREF(text);
+        return -1;
+    }
+    if (parts->count == parts->size) {
+        Py_ssize_t size = parts->size ? parts->size * 2 : 64;
+        PyObject **items = PyMem_Realloc(parts->items,
+                                         size * sizeof(PyObject *));
+        if (items == NULL) {
+            Py_DECREF(text);
+            PyErr_NoMemory();
+            return -1;
+        }
+        parts->items = items;
+        parts->size = size;
+    }
+    parts->items[parts->count++] = text;
+    return 0;
+}
+
+/* append text, like list.append(text) */
+static int
+parts_append(parts_t *parts, PyObject *text) {
+    Py_INCREF(text);
+    return parts_append_steal(parts, text);
+}
+
+/* forget the parts from start on */
+static void
+parts_release(parts_t *parts, Py_ssize_t start) {
+    while (parts->count > start) {
+        parts->count--;
+        Py_DECREF(parts->items[parts->count]);
+    }
+}
+
+/* ''.join() of the parts from start on, which are released */
+static PyObject *
+parts_join(parts_t *parts, Py_ssize_t start) {
+    Py_ssize_t length = 0;
+    Py_UCS4 maxchar = 0;
+    for (Py_ssize_t idx = start; idx < parts->count; idx++) {
+        PyObject *text = parts->items[idx];
+        length += PyUnicode_GET_LENGTH(text);
+        Py_UCS4 text_max = PyUnicode_MAX_CHAR_VALUE(text);
+        if (text_max > maxchar) {
+            maxchar = text_max;
+        }
+    }
+
+    PyObject *result = PyUnicode_New(length, maxchar);
+    Py_ssize_t pos = 0;
+    for (Py_ssize_t idx = start; result != NULL && idx < parts->count; idx++) {
+        PyObject *text = parts->items[idx];
+        Py_ssize_t text_length = PyUnicode_GET_LENGTH(text);
+        if (PyUnicode_CopyCharacters(result, pos, text, 0, text_length) < 0) {
+            Py_CLEAR(result);
+        }
+        pos += text_length;
+    }
+    parts_release(parts, start);
+    return result;
+}
+
+/* record.outbuf.append(''.join(parts[start:])), releasing the parts */
+static int
+append_joined(PyObject *record, parts_t *parts, Py_ssize_t start) {
+    PyObject *text = parts_join(parts, start);
+    if (text == NULL) {
+        return -1;
+    }
+    PyObject *outbuf = PyObject_GetAttr(record, str_outbuf);
+    int result = -1;
+    if (outbuf != NULL) {
+        if (PyList_CheckExact(outbuf)) {
+            result = PyList_Append(outbuf, text);
+        } else {
+            PyObject *ret = PyObject_CallMethodOneArg(outbuf, str_append, text);
+            result = ret == NULL ? -1 : 0;
+            Py_XDECREF(ret);
+        }
+        Py_DECREF(outbuf);
+    }
+    Py_DECREF(text);
+    return result;
+}
+
+/*
+ * Iteration over a sequence of layers, or the items of one layer, which
+ * indexes lists and tuples (the usual case) instead of creating an
+ * iterator object. Lists are indexed safely even if they change.
+ */
+typedef struct {
+    PyObject *seq;              /* borrowed: a list or tuple, or NULL */
+    PyObject *iter;             /* otherwise, an iterator */
+    Py_ssize_t pos;
+} layer_iter_t;
+
+static int
+layer_iter_init(layer_iter_t *iter, PyObject *layer) {
+    iter->pos = 0;
+    if (PyList_CheckExact(layer) || PyTuple_CheckExact(layer)) {
+        iter->seq = layer;
+        iter->iter = NULL;
+        return 0;
+    }
+    iter->seq = NULL;
+    iter->iter = PyObject_GetIter(layer);
+    return iter->iter == NULL ? -1 : 0;
+}
+
+/* the next item (a new reference), or NULL at the end or on error */
+static PyObject *
+layer_iter_next(layer_iter_t *iter) {
+    if (iter->seq == NULL) {
+        return PyIter_Next(iter->iter);
+    }
+    if (iter->pos >= PySequence_Fast_GET_SIZE(iter->seq)) {
+        return NULL;
+    }
+    PyObject *item = PySequence_Fast_GET_ITEM(iter->seq, iter->pos++);
+    Py_INCREF(item);
+    return item;
+}
+
+static void
+layer_iter_clear(layer_iter_t *iter) {
+    Py_CLEAR(iter->iter);
+}
+
+/* record.evaluate(value) if value is callable, else value (new reference) */
+static PyObject *
+evaluate(PyObject *record, PyObject *value) {
+    if (PyCallable_Check(value)) {
+        return PyObject_CallMethodOneArg(record, str_evaluate, value);
+    }
+    Py_INCREF(value);
+    return value;
+}
+
+/* Split a log map item into key and value, like `(key, value) = item`.
+ * key and value are borrowed from item, or from *tmp (which the caller
+ * must release) if item is not a tuple. */
+static int
+unpack_item(PyObject *item, PyObject **tmp, PyObject **key, PyObject **value) {
+    *tmp = NULL;
+    if (!PyTuple_Check(item)) {
+        item = *tmp = PySequence_Tuple(item);
+        if (item == NULL) {
+            return -1;
+        }
+    }
+    if (PyTuple_GET_SIZE(item) != 2) {
+        PyErr_Format(PyExc_ValueError,
+                     "log map items must be (key, value) pairs, not %R",
+                     item);
+        return -1;
+    }
+    *key = PyTuple_GET_ITEM(item, 0);
+    *value = PyTuple_GET_ITEM(item, 1);
+    return 0;
+}
+
+/* config.format_time(record.time) */
+static PyObject *
+format_time(PyObject *config, PyObject *record) {
+    PyObject *time = PyObject_GetAttr(record, str_time);
+    if (time == NULL) {
+        return NULL;
+    }
+    PyObject *result = PyObject_CallMethodOneArg(config, str_format_time, time);
+    Py_DECREF(time);
+    return result;
+}
+
+/* record.level.name */
+static PyObject *
+level_name(PyObject *record) {
+    PyObject *level = PyObject_GetAttr(record, str_level);
+    if (level == NULL) {
+        return NULL;
+    }
+    PyObject *name = PyObject_GetAttr(level, str_name);
+    Py_DECREF(level);
+    return name;
+}
+
+
+/* format_simple() ---------------------------------------------------- */
+
+/* ' {}={}'.format(key, value) */
+static int
+append_simple_item(parts_t *parts, PyObject *key, PyObject *value) {
+    if (parts_append(parts, str_space) < 0 ||
+        parts_append_steal(parts, PyObject_Format(key, NULL)) < 0 ||
+        parts_append(parts, str_equals) < 0 ||
+        parts_append_steal(parts, PyObject_Format(value, NULL)) < 0) {
+        return -1;
+    }
+    return 0;
+}
+
+static int
+append_simple_layer(parts_t *parts, PyObject *record, PyObject *layer) {
+    if (PyObject_TypeCheck(layer, LogMapLayer_type)) {
+        PyObject *fragments = PyObject_CallMethodOneArg(
+            layer, str_get_fragments, format_simple_item);
+        if (fragments == NULL) {
+            return -1;
+        }
+        PyObject *seq = PySequence_Fast(fragments, "fragments must be a list");
+        Py_DECREF(fragments);
+        if (seq == NULL) {
+            return -1;
+        }
+        Py_ssize_t size = PySequence_Fast_GET_SIZE(seq);
+        for (Py_ssize_t idx = 0; idx < size; idx++) {
+            PyObject *fragment = PySequence_Fast_GET_ITEM(seq, idx);
+            if (PyUnicode_Check(fragment)) {
+                if (parts_append(parts, fragment) < 0) {
+                    goto error;
+                }
+                continue;
+            }
+            PyObject *tmp, *key, *func;
+            if (unpack_item(fragment, &tmp, &key, &func) < 0) {
+                Py_XDECREF(tmp);
+                goto error;
+            }
+            PyObject *value = PyObject_CallMethodOneArg(record, str_evaluate, func);
+            if (value == NULL) {
+                Py_XDECREF(tmp);
+                goto error;
+            }
+            int result = append_simple_item(parts, key, value);
+            Py_DECREF(value);
+            Py_XDECREF(tmp);
+            if (result < 0) {
+                goto error;
+            }
+        }
+        Py_DECREF(seq);
+        return 0;
+    error:
+        Py_DECREF(seq);
+        return -1;
+    }
+
+    layer_iter_t iter;
+    if (layer_iter_init(&iter, layer) < 0) {
+        return -1;
+    }
+    PyObject *item;
+    while ((item = layer_iter_next(&iter)) != NULL) {
+        PyObject *tmp, *key, *value;
+        int result = unpack_item(item, &tmp, &key, &value);
+        if (result == 0) {
+            value = evaluate(record, value);
+            if (value == NULL) {
+                result = -1;
+            } else {
+                result = append_simple_item(parts, key, value);
+                Py_DECREF(value);
+            }
+        }
+        Py_XDECREF(tmp);
+        Py_DECREF(item);
+        if (result < 0) {
+            layer_iter_clear(&iter);
+            return -1;
+        }
+    }
+    layer_iter_clear(&iter);
+    return PyErr_Occurred() ? -1 : 0;
+}
+
+static int
+format_simple_parts(PyObject *config, PyObject *record, parts_t *parts) {
+    // '{} {}'.format(config.format_time(record.time), record.message)
+    PyObject *time = format_time(config, record);
+    if (time == NULL) {
+        return -1;
+    }
+    if (parts_append_steal(parts, PyObject_Format(time, NULL)) < 0) {
+        Py_DECREF(time);
+        return -1;
+    }
+    Py_DECREF(time);
+    PyObject *message = PyObject_GetAttr(record, str_message);
+    if (message == NULL ||
+        parts_append(parts, str_space) < 0 ||
+        parts_append_steal(parts, PyObject_Format(message, NULL)) < 0) {
+        Py_XDECREF(message);
+        return -1;
+    }
+    Py_DECREF(message);
+
+    // ' name={} level={}'.format(record.name, record.level.name)
+    PyObject *name = PyObject_GetAttr(record, str_name);
+    if (name == NULL ||
+        parts_append(parts, str_name_equals) < 0 ||
+        parts_append_steal(parts, PyObject_Format(name, NULL)) < 0 ||
+        parts_append(parts, str_level_equals) < 0) {
+        Py_XDECREF(name);
+        return -1;
+    }
+    Py_DECREF(name);
+    PyObject *lname = level_name(record);
+    if (lname == NULL || parts_append_steal(parts, PyObject_Format(lname, NULL)) < 0) {
+        Py_XDECREF(lname);
+        return -1;
+    }
+    Py_DECREF(lname);
+
+    PyObject *layers = PyObject_CallMethodNoArgs(record, str_get_layers);
+    if (layers == NULL) {
+        return -1;
+    }
+    layer_iter_t iter;
+    if (layer_iter_init(&iter, layers) < 0) {
+        Py_DECREF(layers);
+        return -1;
+    }
+    PyObject *layer;
+    while ((layer = layer_iter_next(&iter)) != NULL) {
+        int result = append_simple_layer(parts, record, layer);
+        Py_DECREF(layer);
+        if (result < 0) {
+            layer_iter_clear(&iter);
+            Py_DECREF(layers);
+            return -1;
+        }
+    }
+    layer_iter_clear(&iter);
+    Py_DECREF(layers);
+    if (PyErr_Occurred()) {
+        return -1;
+    }
+    return parts_append(parts, str_newline);
+}
+
+static PyObject *
+speedups_format_simple(PyObject *module, PyObject *const *args, Py_ssize_t nargs) {
+    if (check_args("format_simple", nargs, 2) < 0) {
+        return NULL;
+    }
+    PyObject *config = args[0], *record = args[1];
+    Py_ssize_t start;
+    parts_t *parts = parts_start(&start);
+    if (parts == NULL) {
+        return NULL;
+    }
+    if (format_simple_parts(config, record, parts) < 0) {
+        parts_release(parts, start);
+        return NULL;
+    }
+    if (append_joined(record, parts, start) < 0) {
+        return NULL;
+    }
+    Py_INCREF(record);
+    return record;
+}
+
+
+/* format_json() ------------------------------------------------------ */
+
+/* _json_str(value), encoding the simplest types directly */
+static PyObject *
+json_str(PyObject *value) {
+    if (PyUnicode_CheckExact(value)) {
+        return PyObject_CallOneArg(encode_basestring_ascii, value);
+    }
+    PyObject *text = NULL;
+    if (value == Py_None) {
+        text = str_json_null;
+    } else if (value == Py_True) {
+        text = str_json_true;
+    } else if (value == Py_False) {
+        text = str_json_false;
+    } else if (PyLong_CheckExact(value)) {
+        return PyLong_Type.tp_repr(value);
+    } else if (PyFloat_CheckExact(value) && isfinite(PyFloat_AS_DOUBLE(value))) {
+        return PyFloat_Type.tp_repr(value);
+    }
+    if (text != NULL) {
+        Py_INCREF(text);
+        return text;
+    }
+    return PyObject_CallOneArg(json_encode, value);
+}
+
+/* '"key": ', from json_key_cache if possible */
+static PyObject *
+json_key(PyObject *key) {
+    PyObject *text = PyDict_GetItemWithError(json_key_cache, key);
+    if (text != NULL) {
+        Py_INCREF(text);
+        return text;
+    }
+    if (PyErr_Occurred()) {
+        return NULL;
+    }
+    PyObject *encoded = PyObject_CallOneArg(encode_basestring_ascii, key);
+    if (encoded == NULL) {
+        return NULL;
+    }
+    text = PyUnicode_Concat(encoded, str_json_colon);
+    Py_DECREF(encoded);
+    if (text == NULL) {
+        return NULL;
+    }
+    // keys are usually a small fixed set, but need not be
+    if (PyDict_GET_SIZE(json_key_cache) >= MAX_JSON_KEY_CACHE) {
+        PyDict_Clear(json_key_cache);
+    }
+    if (PyDict_SetItem(json_key_cache, key, text) < 0) {
+        Py_DECREF(text);
+        return NULL;
+    }
+    return text;
+}
+
+static int
+append_json_fragments(parts_t *parts, PyObject *record, PyObject *layer) {
+    PyObject *fragments = PyObject_CallMethodOneArg(
+        layer, str_get_fragments, format_json_item);
+    if (fragments == NULL) {
+        return -1;
+    }
+    PyObject *seq = PySequence_Fast(fragments, "fragments must be a list");
+    Py_DECREF(fragments);
+    if (seq == NULL) {
+        return -1;
+    }
+    Py_ssize_t size = PySequence_Fast_GET_SIZE(seq);
+    for (Py_ssize_t idx = 0; idx < size; idx++) {
+        PyObject *fragment = PySequence_Fast_GET_ITEM(seq, idx);
+        if (PyUnicode_Check(fragment)) {
+            if (parts_append(parts, fragment) < 0) {
+                goto error;
+            }
+            continue;
+        }
+        PyObject *tmp, *key, *func;
+        if (unpack_item(fragment, &tmp, &key, &func) < 0) {
+            Py_XDECREF(tmp);
+            goto error;
+        }
+        PyObject *value = PyObject_CallMethodOneArg(record, str_evaluate, func);
+        if (value == NULL) {
+            Py_XDECREF(tmp);
+            goto error;
+        }
+        PyObject *call_args[] = {key, value};
+        PyObject *text = PyObject_Vectorcall(format_json_item, call_args, 2, NULL);
+        Py_DECREF(value);
+        Py_XDECREF(tmp);
+        if (parts_append_steal(parts, text) < 0) {
+            goto error;
+        }
+    }
+    Py_DECREF(seq);
+    return 0;
+error:
+    Py_DECREF(seq);
+    return -1;
+}
+
+/* ', "key": value' for each item of a plain layer, which is the same as
+ * encoding it as a dict when no key is repeated */
+static int
+append_json_items(parts_t *parts, PyObject *record, PyObject *layer) {
+    layer_iter_t iter;
+    if (layer_iter_init(&iter, layer) < 0) {
+        return -1;
+    }
+    PyObject *item;
+    while ((item = layer_iter_next(&iter)) != NULL) {
+        PyObject *tmp, *key, *value;
+        int result = unpack_item(item, &tmp, &key, &value);
+        if (result == 0) {
+            value = evaluate(record, value);
+            if (value == NULL ||
+                parts_append(parts, str_comma) < 0 ||
+                parts_append_steal(parts, json_key(key)) < 0 ||
+                parts_append_steal(parts, json_str(value)) < 0) {
+                result = -1;
+            }
+            Py_XDECREF(value);
+        }
+        Py_XDECREF(tmp);
+        Py_DECREF(item);
+        if (result < 0) {
+            layer_iter_clear(&iter);
+            return -1;
+        }
+    }
+    layer_iter_clear(&iter);
+    return PyErr_Occurred() ? -1 : 0;
+}
+
+/*
+ * The keys seen by format_json_layers(): a small open-addressing hash set
+ * on the C stack, which holds the usual few dozen keys without allocating
+ * anything, and a real set once there are more.
+ */
+#define MAX_STACK_KEYS 32
+#define KEY_SLOTS 64            /* a power of 2, at least 2 * MAX_STACK_KEYS */
+
+typedef struct {
+    PyObject *slots[KEY_SLOTS]; /* owned references */
+    Py_ssize_t count;
+    PyObject *set;              /* all keys, once there are too many */
+} key_set_t;
+
+/* add key to keys: 1 if it is new, 0 if it was already there */
+static int
+key_set_add(key_set_t *keys, PyObject *key) {
+    if (keys->set == NULL && keys->count < MAX_STACK_KEYS) {
+        Py_hash_t hash = PyObject_Hash(key);
+        if (hash == -1) {
+            return -1;
+        }
+        size_t idx = (size_t)hash & (KEY_SLOTS - 1);
+        while (keys->slots[idx] != NULL) {
+            int equal = PyObject_RichCompareBool(keys->slots[idx], key, Py_EQ);
+            if (equal != 0) {
+                return equal < 0 ? -1 : 0;
+            }
+            idx = (idx + 1) & (KEY_SLOTS - 1);
+        }
+        Py_INCREF(key);
+        keys->slots[idx] = key;
+        keys->count++;
+        return 1;
+    }
+    if (keys->set == NULL) {
+        keys->set = PySet_New(NULL);
+        if (keys->set == NULL) {
+            return -1;
+        }
+        for (int idx = 0; idx < KEY_SLOTS; idx++) {
+            if (keys->slots[idx] != NULL &&
+                PySet_Add(keys->set, keys->slots[idx]) < 0) {
+                return -1;
+            }
+        }
+    }
+    Py_ssize_t size = PySet_GET_SIZE(keys->set);
+    if (PySet_Add(keys->set, key) < 0) {
+        return -1;
+    }
+    return PySet_GET_SIZE(keys->set) > size;
+}
+
+static void
+key_set_clear(key_set_t *keys) {
+    for (int idx = 0; idx < KEY_SLOTS; idx++) {
+        Py_CLEAR(keys->slots[idx]);
+    }
+    Py_CLEAR(keys->set);
+}
+
+/* add the keys of one layer: 1 if all are new, 0 if not, or if a plain
+ * layer has a key that is not a str (which only a dict can encode) */
+static int
+add_layer_keys(key_set_t *keys, PyObject *layer) {
+    if (Py_IS_TYPE(layer, LogMapLayer_type)) {
+        PyObject *layer_keys = PyObject_CallMethodNoArgs(layer, str_get_keys);
+        if (layer_keys == NULL) {
+            return -1;
+        }
+        PyObject *seq = PySequence_Fast(layer_keys, "keys must be a list");
+        Py_DECREF(layer_keys);
+        if (seq == NULL) {
+            return -1;
+        }
+        int result = 1;
+        Py_ssize_t size = PySequence_Fast_GET_SIZE(seq);
+        for (Py_ssize_t idx = 0; idx < size && result == 1; idx++) {
+            result = key_set_add(keys, PySequence_Fast_GET_ITEM(seq, idx));
+        }
+        Py_DECREF(seq);
+        return result;
+    }
+
+    layer_iter_t iter;
+    if (layer_iter_init(&iter, layer) < 0) {
+        return -1;
+    }
+    int result = 1;
+    PyObject *item;
+    while (result == 1 && (item = layer_iter_next(&iter)) != NULL) {
+        PyObject *tmp, *key, *value;
+        result = unpack_item(item, &tmp, &key, &value);
+        if (result == 0) {
+            result = PyUnicode_Check(key) ? key_set_add(keys, key) : 0;
+        }
+        Py_XDECREF(tmp);
+        Py_DECREF(item);
+    }
+    layer_iter_clear(&iter);
+    return PyErr_Occurred() ? -1 : result;
+}
+
+/* _format_json_layers(): 1 if formatted, 0 if some key is repeated */
+static int
+format_json_layers(PyObject *layers, parts_t *parts, PyObject *record) {
+    key_set_t keys;
+    memset(&keys, 0, sizeof(keys));
+    int result = -1;
+
+    PyObject *seq = PySequence_Fast(layers, "layers must be a sequence");
+    if (seq == NULL) {
+        return -1;
+    }
+    Py_ssize_t num_builtin = PyTuple_GET_SIZE(json_builtin_keys);
+    for (Py_ssize_t idx = 0; idx < num_builtin; idx++) {
+        if (key_set_add(&keys, PyTuple_GET_ITEM(json_builtin_keys, idx)) < 0) {
+            goto done;
+        }
+    }
+    // check every key before formatting anything (which might call
+    // callable values)
+    Py_ssize_t num_layers = PySequence_Fast_GET_SIZE(seq);
+    for (Py_ssize_t idx = 0; idx < num_layers; idx++) {
+        result = add_layer_keys(&keys, PySequence_Fast_GET_ITEM(seq, idx));
+        if (result != 1) {
+            goto done;
+        }
+    }
+    key_set_clear(&keys);
+
+    result = -1;
+    for (Py_ssize_t idx = 0; idx < num_layers; idx++) {
+        PyObject *layer = PySequence_Fast_GET_ITEM(seq, idx);
+        if (Py_IS_TYPE(layer, LogMapLayer_type)
+            ? append_json_fragments(parts, record, layer) < 0
+            : append_json_items(parts, record, layer) < 0) {
+            goto done;
+        }
+    }
+    result = 1;
+
+done:
+    key_set_clear(&keys);
+    Py_DECREF(seq);
+    return result;
+}
+
+/* append label, then _json_str(value), stealing the reference to value */
+static int
+append_json_field(parts_t *parts, PyObject *label, PyObject *value) {
+    if (value == NULL) {
+        return -1;
+    }
+    PyObject *encoded = json_str(value);
+    Py_DECREF(value);
+    if (parts_append(parts, label) < 0) {
+        Py_XDECREF(encoded);
+        return -1;
+    }
+    return parts_append_steal(parts, encoded);
+}
+
+static PyObject *
+speedups_format_json(PyObject *module, PyObject *const *args, Py_ssize_t nargs) {
+    if (check_args("format_json", nargs, 2) < 0) {
+        return NULL;
+    }
+    PyObject *config = args[0], *record = args[1];
+    Py_ssize_t start;
+    parts_t *parts = parts_start(&start);
+    if (parts == NULL) {
+        return NULL;
+    }
+    if (append_json_field(parts, str_json_time, format_time(config, record)) < 0 ||
+        append_json_field(parts, str_json_message,
+                          PyObject_GetAttr(record, str_message)) < 0 ||
+        append_json_field(parts, str_json_name,
+                          PyObject_GetAttr(record, str_name)) < 0 ||
+        append_json_field(parts, str_json_level, level_name(record)) < 0) {
+        parts_release(parts, start);
+        return NULL;
+    }
+
+    PyObject *layers = PyObject_CallMethodNoArgs(record, str_get_layers);
+    if (layers == NULL) {
+        parts_release(parts, start);
+        return NULL;
+    }
+    int formatted = format_json_layers(layers, parts, record);
+    Py_DECREF(layers);
+    if (formatted == 1) {
+        if (parts_append(parts, str_json_end) < 0) {
+            parts_release(parts, start);
+            return NULL;
+        }
+        if (append_joined(record, parts, start) < 0) {
+            return NULL;
+        }
+        Py_INCREF(record);
+        return record;
+    }
+    parts_release(parts, start);
+    if (formatted < 0) {
+        return NULL;
+    }
+
+    // some key is repeated: let the Python version build a dict
+    PyObject *call_args[] = {config, record};
+    return PyObject_Vectorcall(format_json_dict, call_args, 2, NULL);
+}
+
+
+/* Logger._log() and the level methods ------------------------------- */
+
+static int
+set_attrs(PyObject *obj, PyObject **names, PyObject **values, int count) {
+    for (int idx = 0; idx < count; idx++) {
+        if (PyObject_SetAttr(obj, names[idx], values[idx]) < 0) {
+            return -1;
+        }
+    }
+    return 0;
+}
+
+/* if self.generation != config.generation: self._update_level()
+ * then return level < self.level (or -1 on error) */
+static int
+is_filtered(PyObject *self, PyObject *config, PyObject *level) {
+    PyObject *value = PyObject_GetAttr(self, str_generation);
+    if (value == NULL) {
+        return -1;
+    }
+    PyObject *other = PyObject_GetAttr(config, str_generation);
+    if (other == NULL) {
+        Py_DECREF(value);
+        return -1;
+    }
+    int stale = PyObject_RichCompareBool(value, other, Py_NE);
+    Py_DECREF(value);
+    Py_DECREF(other);
+    if (stale < 0) {
+        return -1;
+    }
+    if (stale) {
+        value = PyObject_CallMethodNoArgs(self, str__update_level);
+        if (value == NULL) {
+            return -1;
+        }
+        Py_DECREF(value);
+    }
+
+    value = PyObject_GetAttr(self, str_level);
+    if (value == NULL) {
+        return -1;
+    }
+    int filtered = PyObject_RichCompareBool(level, value, Py_LT);
+    Py_DECREF(value);
+    return filtered;
+}
+
+/*
+ * Keep record as this thread's spare, for the next record it logs, if
+ * nothing else has kept a reference to it or its outbuf: output stages
+ * keep joined text, not records, so usually nothing has. The outbuf list
+ * is emptied but keeps its capacity, and the record lets go of its time,
+ * message and log map, so that a spare does not keep values alive.
+ * Steals the reference to record.
+ */
+static int
+recycle_record(parts_t *parts, PyObject *record, PyObject *outbuf) {
+    if (parts->record != NULL || Py_REFCNT(record) != 1 ||
+            Py_REFCNT(outbuf) != 2 || !PyList_CheckExact(outbuf)) {
+        Py_DECREF(record);
+        return 0;
+    }
+    PyObject **items = ((PyListObject *)outbuf)->ob_item;
+    Py_ssize_t count = PyList_GET_SIZE(outbuf);
+    Py_SET_SIZE(outbuf, 0);
+    for (Py_ssize_t idx = 0; idx < count; idx++) {
+        Py_DECREF(items[idx]);
+    }
+    PyObject *names[] = {
+        str_time, str_message, str_layers, str__log_map, str__values,
+    };
+    PyObject *values[] = {Py_None, Py_None, Py_None, Py_None, Py_None};
+    if (set_attrs(record, names, values, 5) < 0) {
+        Py_DECREF(record);
+        return -1;
+    }
+
+    // releasing values can run code that logs, and leaves its own spare
+    if (parts->record != NULL) {
+        Py_DECREF(record);
+        return 0;
+    }
+    parts->record = record;
+    return 0;
+}
+
+/* the rest of Logger._log(), once the record has passed the level check */
+static int
+emit(PyObject *self, PyObject *config, PyObject *level, PyObject *message,
+     PyObject *items) {
+    PyObject *local = NULL, *layers = NULL, *value = NULL, *time = NULL;
+    PyObject *name = NULL, *outbuf = NULL, *record = NULL;
+    int result = -1;
+
+    // (config.log_map, *local layers, self.log_map, items)
+    if (PyContextVar_Get(local_log_map, NULL, &local) < 0) {
+        goto done;
+    }
+    if (local == NULL || !PyTuple_Check(local)) {
+        PyErr_SetString(PyExc_TypeError, "local log map must be a tuple");
+        goto done;
+    }
+    Py_ssize_t num_local = PyTuple_GET_SIZE(local);
+    layers = PyTuple_New(num_local + 3);
+    if (layers == NULL) {
+        goto done;
+    }
+    value = PyObject_GetAttr(config, str_log_map);
+    if (value == NULL) {
+        goto done;
+    }
+    PyTuple_SET_ITEM(layers, 0, value);
+    for (Py_ssize_t idx = 0; idx < num_local; idx++) {
+        value = PyTuple_GET_ITEM(local, idx);
+        Py_INCREF(value);
+        PyTuple_SET_ITEM(layers, idx + 1, value);
+    }
+    value = PyObject_GetAttr(self, str_log_map);
+    if (value == NULL) {
+        goto done;
+    }
+    PyTuple_SET_ITEM(layers, num_local + 1, value);
+    Py_INCREF(items);
+    PyTuple_SET_ITEM(layers, num_local + 2, items);
+
+    // Record(time=config.time(), name=self.name, level=level,
+    //        message=message, outbuf=[], layers=layers), without the
+    //        cost of running Record.__init__(), and reusing this thread's
+    //        spare record and its outbuf if it has one
+    parts_t *parts = thread_parts();
+    if (parts == NULL) {
+        goto done;
+    }
+    time = PyObject_CallMethodNoArgs(config, str_time);
+    name = time ? PyObject_GetAttr(self, str_name) : NULL;
+    if (name == NULL) {
+        goto done;
+    }
+    if (parts->record != NULL) {
+        record = parts->record;
+        parts->record = NULL;
+        outbuf = PyObject_GetAttr(record, str_outbuf);
+    } else {
+        outbuf = PyList_New(0);
+        record = outbuf ? Record_type->tp_new(Record_type, empty_tuple, NULL) : NULL;
+    }
+    if (outbuf == NULL || record == NULL) {
+        goto done;
+    }
+    PyObject *names[] = {
+        str_time, str_name, str_level, str_message, str_outbuf, str_layers,
+        str__log_map, str__values,
+    };
+    PyObject *values[] = {
+        time, name, level, message, outbuf, layers, Py_None, Py_None,
+    };
+    if (set_attrs(record, names, values, 8) < 0) {
+        goto done;
+    }
+
+    // config.run_pipeline(record)
+    value = PyObject_CallMethodOneArg(config, str_run_pipeline, record);
+    if (value == NULL) {
+        goto done;
+    }
+    Py_DECREF(value);
+    result = recycle_record(parts, record, outbuf);
+    record = NULL;
+
+done:
+    Py_XDECREF(record);
+    Py_XDECREF(outbuf);
+    Py_XDECREF(name);
+    Py_XDECREF(time);
+    Py_XDECREF(layers);
+    Py_XDECREF(local);
+    return result;
+}
+
+/* the keyword arguments of a log method, as a log map layer: a tuple of
+ * (key, value) tuples, leaving out message if it was passed by keyword */
+static PyObject *
+keyword_items(PyObject *const *values, PyObject *kwnames, Py_ssize_t skip) {
+    Py_ssize_t count = kwnames ? PyTuple_GET_SIZE(kwnames) : 0;
+    PyObject *items = PyTuple_New(count - (skip >= 0 ? 1 : 0));
+    if (items == NULL) {
+        return NULL;
+    }
+    Py_ssize_t pos = 0;
+    for (Py_ssize_t idx = 0; idx < count; idx++) {
+        if (idx == skip) {
+            continue;
+        }
+        PyObject *item = PyTuple_Pack(2, PyTuple_GET_ITEM(kwnames, idx), values[idx]);
+        if (item == NULL) {
+            Py_DECREF(items);
+            return NULL;
+        }
+        PyTuple_SET_ITEM(items, pos++, item);
+    }
+    return items;
+}
+
+/*
+ * LogMethod(level) is a compiled log method for the Logger class:
+ * Logger.info = LogMethod(Level.INFO) does the same as
+ *
+ *     def info(self, message, **kwargs):
+ *         self._log(Level.INFO, message, kwargs.items())
+ *
+ * and LogMethod(None) is Logger._log() itself. Like Python functions,
+ * these are method descriptors, so calling log.info(...) does not even
+ * create a bound method object, and instance attributes shadow them (see
+ * Config.set_rebind_methods()).
+ */
+typedef struct {
+    PyObject_HEAD
+    PyObject *level;            /* NULL for _log() */
+    vectorcallfunc vectorcall;
+} LogMethod;
+
+static PyObject *
+log_method_call(PyObject *callable, PyObject *const *args, size_t nargsf,
+                PyObject *kwnames) {
+    PyObject *level = ((LogMethod *)callable)->level;
+    Py_ssize_t nargs = PyVectorcall_NARGS(nargsf);
+    Py_ssize_t num_kwargs = kwnames ? PyTuple_GET_SIZE(kwnames) : 0;
+    PyObject *self, *message, *items = NULL;
+    Py_ssize_t message_kwarg = -1;
+
+    if (level == NULL) {
+        // _log(self, level, message, items)
+        if (num_kwargs) {
+            PyErr_SetString(PyExc_TypeError, "_log() takes no keyword arguments");
+            return NULL;
+        }
+        if (check_args("_log", nargs, 4) < 0) {
+            return NULL;
+        }
+        self = args[0];
+        level = args[1];
+        message = args[2];
+        items = args[3];
+    } else {
+        // debug(self, message, **kwargs) and friends
+        if (nargs < 1) {
+            PyErr_SetString(PyExc_TypeError, "log method called without a logger");
+            return NULL;
+        }
+        self = args[0];
+        for (Py_ssize_t idx = 0; idx < num_kwargs; idx++) {
+            if (PyUnicode_Compare(PyTuple_GET_ITEM(kwnames, idx), str_message) == 0) {
+                message_kwarg = idx;
+                break;
+            }
+        }
+        if (nargs == 2 && message_kwarg < 0) {
+            message = args[1];
+        } else if (nargs == 1 && message_kwarg >= 0) {
+            message = args[nargs + message_kwarg];
+        } else if (nargs == 2) {
+            PyErr_SetString(PyExc_TypeError,
+                            "log method got multiple values for argument "
+                            "'message'");
+            return NULL;
+        } else {
+            PyErr_SetString(PyExc_TypeError,
+                            "log methods take one positional argument, "
+                            "the message");
+            return NULL;
+        }
+    }
+
+    PyObject *config = PyObject_GetAttr(self, str_config);
+    if (config == NULL) {
+        return NULL;
+    }
+    int filtered = is_filtered(self, config, level);
+    if (filtered != 0) {
+        Py_DECREF(config);
+        if (filtered < 0) {
+            return NULL;
+        }
+        Py_RETURN_NONE;
+    }
+
+    if (items == NULL) {
+        items = keyword_items(args + nargs, kwnames, message_kwarg);
+        if (items == NULL) {
+            Py_DECREF(config);
+            return NULL;
+        }
+    } else {
+        Py_INCREF(items);
+    }
+    int result = emit(self, config, level, message, items);
+    Py_DECREF(items);
+    Py_DECREF(config);
+    if (result < 0) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+log_method_new(PyTypeObject *type, PyObject *args, PyObject *kwargs) {
+    PyObject *level;
+    if (!PyArg_ParseTuple(args, "O:LogMethod", &level)) {
+        return NULL;
+    }
+    LogMethod *self = (LogMethod *)type->tp_alloc(type, 0);
+    if (self == NULL) {
+        return NULL;
+    }
+    if (level != Py_None) {
+        Py_INCREF(level);
+        self->level = level;
+    }
+    self->vectorcall = log_method_call;
+    return (PyObject *)self;
+}
+
+static void
+log_method_dealloc(PyObject *self) {
+    Py_XDECREF(((LogMethod *)self)->level);
+    Py_TYPE(self)->tp_free(self);
+}
+
+static PyObject *
+log_method_get(PyObject *self, PyObject *obj, PyObject *type) {
+    if (obj == NULL || obj == Py_None) {
+        Py_INCREF(self);
+        return self;
+    }
+    return PyMethod_New(self, obj);
+}
+
+static PyTypeObject LogMethod_type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "lolog._speedups.LogMethod",
+    .tp_doc = "Compiled log method for pylolog.Logger.",
+    .tp_basicsize = sizeof(LogMethod),
+    .tp_flags = (Py_TPFLAGS_DEFAULT |
+                 Py_TPFLAGS_HAVE_VECTORCALL |
+                 Py_TPFLAGS_METHOD_DESCRIPTOR),
+    .tp_vectorcall_offset = offsetof(LogMethod, vectorcall),
+    .tp_new = log_method_new,
+    .tp_dealloc = log_method_dealloc,
+    .tp_call = PyVectorcall_Call,
+    .tp_descr_get = log_method_get,
+};
+
+
+/* module ------------------------------------------------------------- */
+
+static PyObject *
+speedups_setup(PyObject *module, PyObject *args, PyObject *kwargs) {
+    static char *keywords[] = {
+        "Record",
+        "LogMapLayer",
+        "local_log_map",
+        "format_simple_item",
+        "format_json_item",
+        "format_json_dict",
+        "json_encode",
+        "encode_basestring_ascii",
+        "json_builtin_keys",
+        NULL,
+    };
+    PyObject *record, *layer, *local, *simple_item, *json_item, *json_dict;
+    PyObject *encode, *encode_str, *builtin_keys;
+    if (!PyArg_ParseTupleAndKeywords(
+            args, kwargs, "$O!O!OOOOOOO:setup", keywords,
+            &PyType_Type, &record,
+            &PyType_Type, &layer,
+            &local, &simple_item, &json_item, &json_dict,
+            &encode, &encode_str, &builtin_keys)) {
+        return NULL;
+    }
+
+    Py_INCREF(record);
+    Py_XSETREF(Record_type, (PyTypeObject *)record);
+    Py_INCREF(layer);
+    Py_XSETREF(LogMapLayer_type, (PyTypeObject *)layer);
+    Py_INCREF(local);
+    Py_XSETREF(local_log_map, local);
+    Py_INCREF(simple_item);
+    Py_XSETREF(format_simple_item, simple_item);
+    Py_INCREF(json_item);
+    Py_XSETREF(format_json_item, json_item);
+    Py_INCREF(json_dict);
+    Py_XSETREF(format_json_dict, json_dict);
+    Py_INCREF(encode);
+    Py_XSETREF(json_encode, encode);
+    Py_INCREF(encode_str);
+    Py_XSETREF(encode_basestring_ascii, encode_str);
+    Py_XSETREF(json_builtin_keys, PySequence_Tuple(builtin_keys));
+    if (json_builtin_keys == NULL) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef speedups_methods[] = {
+    {"setup", (PyCFunction)(void (*)(void))speedups_setup,
+     METH_VARARGS | METH_KEYWORDS,
+     "Hand over the pylolog objects that the other functions rely on."},
+    {"format_simple", (PyCFunction)(void (*)(void))speedups_format_simple,
+     METH_FASTCALL,
+     "Compiled version of pylolog.format_simple()."},
+    {"format_json", (PyCFunction)(void (*)(void))speedups_format_json,
+     METH_FASTCALL,
+     "Compiled version of pylolog.format_json()."},
+    {NULL, NULL, 0, NULL},
+};
+
+static struct PyModuleDef speedups_module = {
+    PyModuleDef_HEAD_INIT,
+    "lolog._speedups",
+    "compiled versions of the pylolog hot path",
+    -1,
+    speedups_methods,
+};
+
+static int
+intern_strings(void) {
+    struct {
+        PyObject **var;
+        const char *text;
+    } strings[] = {
+        {&str_time, "time"},
+        {&str_name, "name"},
+        {&str_level, "level"},
+        {&str_message, "message"},
+        {&str_outbuf, "outbuf"},
+        {&str_layers, "layers"},
+        {&str__log_map, "_log_map"},
+        {&str__values, "_values"},
+        {&str_config, "config"},
+        {&str_generation, "generation"},
+        {&str_log_map, "log_map"},
+        {&str__update_level, "_update_level"},
+        {&str_run_pipeline, "run_pipeline"},
+        {&str_format_time, "format_time"},
+        {&str_get_layers, "get_layers"},
+        {&str_get_fragments, "get_fragments"},
+        {&str_get_keys, "get_keys"},
+        {&str_evaluate, "evaluate"},
+        {&str_append, "append"},
+        {&str_empty, ""},
+        {&str_space, " "},
+        {&str_equals, "="},
+        {&str_newline, "\n"},
+        {&str_name_equals, " name="},
+        {&str_level_equals, " level="},
+        {&str_comma, ", "},
+        {&str_json_time, "{\"time\": "},
+        {&str_json_message, ", \"message\": "},
+        {&str_json_name, ", \"name\": "},
+        {&str_json_level, ", \"level\": "},
+        {&str_json_end, "}\n"},
+        {&str_json_colon, ": "},
+        {&str_json_true, "true"},
+        {&str_json_false, "false"},
+        {&str_json_null, "null"},
+    };
+    for (size_t idx = 0; idx < sizeof(strings) / sizeof(strings[0]); idx++) {
+        *strings[idx].var = PyUnicode_InternFromString(strings[idx].text);
+        if (*strings[idx].var == NULL) {
+            return -1;
+        }
+    }
+    return 0;
+}
+
+PyMODINIT_FUNC
+PyInit__speedups(void) {
+    if (intern_strings() < 0) {
+        return NULL;
+    }
+    empty_tuple = PyTuple_New(0);
+    json_key_cache = PyDict_New();
+    parts_var = PyContextVar_New("lolog._speedups.parts", NULL);
+    if (empty_tuple == NULL || json_key_cache == NULL || parts_var == NULL) {
+        return NULL;
+    }
+
+    if (PyType_Ready(&LogMethod_type) < 0) {
+        return NULL;
+    }
+    PyObject *module = PyModule_Create(&speedups_module);
+    if (module == NULL) {
+        return NULL;
+    }
+    Py_INCREF(&LogMethod_type);
+    if (PyModule_AddObject(module, "LogMethod", (PyObject *)&LogMethod_type) < 0) {
+        Py_DECREF(&LogMethod_type);
+        Py_DECREF(module);
+        return NULL;
+    }
+    return module;
+}
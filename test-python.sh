@@ -7,3 +7,5 @@ set -x
 flake8 $dirs
 mypy $dirs --exclude tests/intercept-test.py
 PYTHONPATH=$dir TZ=UTC pytest --cov=lolog --cov-report=term-missing tests
+LOLOG_PURE_PYTHON=1 PYTHONPATH=$dir TZ=UTC pytest --cov=lolog --cov-append \
+    --cov-report=term-missing tests
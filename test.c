@@ -1,7 +1,9 @@
+/* for localtime_r() and clock_gettime() */
+#define _POSIX_C_SOURCE 200809L
+
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
-#define __USE_POSIX
 #include <time.h>
 #include <sys/time.h>
 
@@ -25,7 +27,128 @@ timefunc() {
     return buf;
 }
 
+static char *
+versionfunc() {
+    // stands in for context that is expensive to compute (e.g. read from
+    // a file), so is cached rather than computed for every line
+    char *buf = malloc(16);
+    strcpy(buf, "1.0.dev0");
+    return buf;
+}
+
+static lol_logger_t *nested_log;
+
+static char *
+nestedfunc() {
+    // context that logs a line of its own, while the outer line is being
+    // built
+    nested_log->info(nested_log, "inner", "depth", "2", NULL);
+    char *buf = malloc(16);
+    strcpy(buf, "value");
+    return buf;
+}
+
+/**
+ * Check that a line is intact when its context valuefuncs log too
+ */
+static int
+check_nested() {
+    char *text;
+    size_t size;
+    FILE *fh = open_memstream(&text, &size);
+    lol_config_t *config = lol_make_config(LOL_INFO, fh);
+    lol_logger_t *log = lol_make_logger("app");
+    nested_log = lol_make_logger("app.nested");
+    log->add_dynamic_context(log, "dynamic", nestedfunc);
+    log->add_cached_context(log, "cached", nestedfunc, 60.0);
+    log->info(log, "outer", "depth", "1", NULL);
+    lol_free_logger(log);
+    lol_free_logger(nested_log);
+    lol_free_config(config);
+    fclose(fh);
+
+    // the nested lines are written first, since the outer one is
+    // written once all its context is known
+    char *expect =
+        "level=I name=app.nested message=inner depth=2\n"
+        "level=I name=app.nested message=inner depth=2\n"
+        "dynamic=value cached=value level=I name=app message=outer depth=1\n";
+    int status = 0;
+    if (strcmp(text, expect) != 0) {
+        fprintf(stderr, "nested logging: unexpected output:\n%s", text);
+        status = 1;
+    }
+    free(text);
+    return status;
+}
+
+static double
+now() {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return now.tv_sec + now.tv_nsec / 1e9;
+}
+
+/**
+ * Report how many lines per second a logger formats and writes to
+ * /dev/null, in both formats, and how fast filtered calls are
+ */
+static int
+bench(int num_lines) {
+    FILE *devnull = fopen("/dev/null", "w");
+    if (!devnull) {
+        perror("/dev/null");
+        return 1;
+    }
+    lol_config_t *config = lol_make_config(LOL_INFO, devnull);
+    config->add_context(config, "host", "web-1.example.com");
+    config->add_cached_context(config, "version", versionfunc, 60.0);
+    lol_logger_t *log = lol_make_logger("myapp.api");
+    log->add_context(log, "request_id", "a925");
+
+    lol_format_t formats[] = {LOL_FORMAT_SIMPLE, LOL_FORMAT_JSON};
+    char *format_names[] = {"simple", "json"};
+    for (int format_idx = 0; format_idx < 2; format_idx++) {
+        config->set_format(config, formats[format_idx]);
+        double start = now();
+        for (int idx = 0; idx < num_lines; idx++) {
+            log->info(log,
+                      "request done",
+                      "method", "GET",
+                      "path", "/api/v1/things?id=42",
+                      "status", "200",
+                      "user_agent", "curl/7.68.0 \"quoted\"",
+                      NULL);
+        }
+        double elapsed = now() - start;
+        printf("%-8s %10.0f lines/s  %6.0f ns/line\n",
+               format_names[format_idx],
+               num_lines / elapsed,
+               elapsed / num_lines * 1e9);
+    }
+
+    double start = now();
+    for (int idx = 0; idx < num_lines; idx++) {
+        log->debug(log, "filtered", "key", "value", NULL);
+    }
+    double elapsed = now() - start;
+    printf("%-8s %10.0f calls/s  %6.0f ns/call\n",
+           "filtered",
+           num_lines / elapsed,
+           elapsed / num_lines * 1e9);
+
+    lol_free_logger(log);
+    lol_free_config(config);
+    fclose(devnull);
+    return 0;
+}
+
 int main(int argc, char* argv[]) {
+    // "./test bench [num_lines]" runs the benchmarks instead of the demo
+    if (argc > 1 && strcmp(argv[1], "bench") == 0) {
+        return bench(argc > 2 ? atoi(argv[2]) : 1000000);
+    }
+
     lol_config_t *config = lol_make_config(LOL_DEBUG, stdout);
     config->set_level(config, "myapp", LOL_INFO);
     config->set_level(config, "lib", LOL_SILENT);
@@ -33,6 +156,7 @@ int main(int argc, char* argv[]) {
     config->set_level(config, "lib", LOL_INFO);
     config->set_level(config, "lib.*", LOL_INFO);
     config->add_dynamic_context(config, "ts", timefunc);
+    config->add_cached_context(config, "version", versionfunc, 60.0);
 
     lol_logger_t *applog = lol_make_logger("myapp");
     lol_logger_t *liblog1 = lol_make_logger("lib");
@@ -61,8 +185,21 @@ int main(int argc, char* argv[]) {
                    "another annoying message from the guts of lib",
                    "detail", "blaah bla on and on",
                    NULL);
+
+    config->set_format(config, LOL_FORMAT_JSON);
+    applog->info(applog,
+                 "the same, as JSON",
+                 "arg1", "value blah blah o'ding \"dong\"",
+                 "arg2", "caf\xc3\xa9\ttab",
+                 NULL);
+    applog->warning(applog,
+                    "repeated keys keep their first place and last value",
+                    "request_id", "b3c1",
+                    NULL);
     lol_free_logger(applog);
     lol_free_logger(liblog1);
     lol_free_logger(liblog2);
     lol_free_config(config);
+
+    return check_nested();
 }
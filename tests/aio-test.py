@@ -9,6 +9,9 @@
 #
 # * for each task, iter will always increment from 1 to count, and then
 #   the thread will stop
+#
+# * piping the output into something slow (e.g. `| (sleep 5; cat)`)
+#   does not slow the tasks down
 
 import asyncio
 import random
@@ -17,10 +20,11 @@ import sys
 import lolog
 
 log = lolog.get_logger('aio-test')
+output = lolog.pylolog.AsyncOutput()
 
 
 async def main():
-    lolog.init(stream=sys.stdout)
+    lolog.get_config().configure(stream=sys.stdout, output=output)
 
     num_tasks = 10
     log.info('starting asyncio test', num_tasks=num_tasks)
@@ -33,13 +37,14 @@ async def main():
     log.debug('gathering tasks')
     await asyncio.gather(*tasks)
     log.info('all done')
+    await output.aclose()
 
 
 async def worker(worker_id, count):
-    log.add_local_context('wid1', worker_id)
-    for idx in range(1, count + 1):
-        log.info('doing some work', iter=idx, wid2=worker_id)
-        await asyncio.sleep(random.uniform(0.001, 0.050))
+    with log.bind(wid1=worker_id):
+        for idx in range(1, count + 1):
+            log.info('doing some work', iter=idx, wid2=worker_id)
+            await asyncio.sleep(random.uniform(0.001, 0.050))
 
 
 asyncio.run(main())
@@ -0,0 +1,62 @@
+#!venv/bin/python
+
+# microbenchmark: JSON formatting of typical records
+#
+# expectations:
+#
+# * format_json() is faster than the original implementation that built a
+#   dict and handed it to the general-purpose JSON encoder
+#
+# timestamp formatting is the same for both, so it is stubbed out here to
+# measure only the JSON encoding
+
+import timeit
+
+import lolog
+from lolog import pylolog
+
+NUM_CALLS = 100_000
+
+
+def format_json_generic(config, record):
+    data = {
+        'time': config.format_time(record.time),
+        'message': record.message,
+    }
+    data.update(record.get_items())
+    record.outbuf.append(pylolog._json_encoder.encode(data) + '\n')
+    return record
+
+
+def make_log_map(num_keys):
+    values = ['GET', '/api/v1/users', 200, 0.0123, True, None,
+              'f3a9c0de', 48213, 'eu-west-1', 'worker-7', 3.5, False,
+              'a somewhat longer string value', 17, 'x']
+    return [(f'key{idx}', values[idx % len(values)]) for idx in range(num_keys)]
+
+
+def bench(formatter, num_keys):
+    config = lolog.make_config()
+    config.format_time = lambda time_: '2020-02-11T08:54:12.431693'  # type: ignore
+    log_map = make_log_map(num_keys)
+
+    def run():
+        record = pylolog.Record(
+            1581411252.431693, 'myapp.api', lolog.INFO, 'request done',
+            log_map, [])
+        formatter(config, record)
+
+    elapsed = min(timeit.repeat(run, number=NUM_CALLS, repeat=5))
+    return elapsed / NUM_CALLS * 1e9
+
+
+def main():
+    for num_keys in [8, 12, 15]:
+        generic = bench(format_json_generic, num_keys)
+        fast = bench(pylolog.format_json, num_keys)
+        print(f'{num_keys:2d} keys: generic {generic:7.1f} ns, '
+              f'fast {fast:7.1f} ns, speedup {generic / fast:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
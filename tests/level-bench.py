@@ -0,0 +1,69 @@
+#!venv/bin/python
+
+# microbenchmark: cost of a filtered-out log call
+#
+# expectations:
+#
+# * filtered calls cost the same regardless of how many logger patterns
+#   are configured, since each logger caches its effective level
+#
+# * with method rebinding, filtered calls cost little more than the call
+#   itself
+#
+# * resolving a logger's level (on creation, and when levels change) costs
+#   about the same regardless of how many patterns are configured
+
+import io
+import timeit
+
+import lolog
+
+NUM_CALLS = 200_000
+
+
+def bench(num_patterns, rebind=False):
+    cfg = lolog.make_config()
+    cfg.configure(stream=io.StringIO(), level=lolog.INFO)
+    cfg.set_rebind_methods(rebind)
+    for idx in range(num_patterns):
+        cfg.set_logger_pattern_level(f'lib{idx}.*', lolog.WARNING)
+
+    log = cfg.get_logger('myapp.hot')
+    elapsed = min(timeit.repeat(
+        lambda: log.debug('filtered out', a=1),
+        number=NUM_CALLS,
+        repeat=5))
+    return elapsed / NUM_CALLS * 1e9
+
+
+def bench_resolve(num_patterns):
+    cfg = lolog.make_config()
+    cfg.configure(stream=io.StringIO(), level=lolog.INFO)
+    for idx in range(num_patterns):
+        # a mix of prefix patterns, plain names and other globs
+        cfg.set_logger_pattern_level(f'lib{idx}.*', lolog.WARNING)
+        cfg.set_logger_pattern_level(f'app.mod{idx}', lolog.ERROR)
+        cfg.set_logger_pattern_level(f'*.sub{idx}', lolog.DEBUG)
+
+    number = NUM_CALLS // 10
+    elapsed = min(timeit.repeat(
+        lambda: cfg.get_logger_level('myapp.hot.path'),
+        number=number,
+        repeat=5))
+    return elapsed / number * 1e9
+
+
+def main():
+    for rebind in [False, True]:
+        for num_patterns in [0, 200]:
+            ns = bench(num_patterns, rebind)
+            print(f'{num_patterns:4d} patterns, rebind={rebind!s:5}: '
+                  f'{ns:6.1f} ns/call')
+    for num_patterns in [0, 100, 1000]:
+        ns = bench_resolve(num_patterns)
+        print(f'{num_patterns * 3:4d} patterns, resolve level: '
+              f'{ns:8.1f} ns/call')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+#!venv/bin/python
+
+# benchmark suite: lolog vs. the standard logging module
+#
+# Runs each case twice, once with lolog and once with equivalent code
+# using the standard logging module, and prints one JSON object per line:
+#
+#   {"case": "filtered", "impl": "lolog", "calls": 100000,
+#    "ns_per_call": 412.7, "peak_bytes_per_call": 0}
+#
+# ns_per_call is wall-clock time divided by the number of log calls;
+# peak_bytes_per_call is the peak memory (according to tracemalloc)
+# allocated while emitting a single log message, or null for the
+# concurrent cases. Save the output from two releases and compare them to
+# catch regressions.
+#
+# usage: suite-bench.py [--calls N] [--text] [CASE ...]
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+
+import lolog
+import lolog.iclogging
+
+
+class NullStream:
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+# -- lolog setup ------------------------------------------------------------
+
+def lolog_logger(format='simple', level=lolog.DEBUG, num_context=0):
+    cfg = lolog.make_config()
+    cfg.configure(stream=NullStream(), format=format, level=level)  # type: ignore
+    for idx in range(num_context):
+        cfg.add_value('ctx{}'.format(idx), 'value{}'.format(idx))
+    return cfg.get_logger('bench.lolog')
+
+
+# -- stdlib setup -----------------------------------------------------------
+
+class KeyValueFormatter(logging.Formatter):
+    """stdlib equivalent of lolog's simple format"""
+
+    def __init__(self, keys):
+        super().__init__()
+        self.keys = keys
+
+    def format(self, record):
+        return '{} {} name={} level={}{}'.format(
+            self.formatTime(record),
+            record.getMessage(),
+            record.name,
+            record.levelname,
+            ''.join(' {}={}'.format(key, getattr(record, key, None))
+                    for key in self.keys))
+
+
+class JSONFormatter(KeyValueFormatter):
+    """stdlib equivalent of lolog's json format"""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'message': record.getMessage(),
+            'name': record.name,
+            'level': record.levelname,
+        }
+        for key in self.keys:
+            data[key] = getattr(record, key, None)
+        return json.dumps(data)
+
+
+class ContextFilter(logging.Filter):
+    """stdlib equivalent of lolog's global log map"""
+
+    def __init__(self, context):
+        super().__init__()
+        self.context = context
+
+    def filter(self, record):
+        for (key, value) in self.context:
+            if callable(value):
+                value = value()
+            setattr(record, key, value)
+        return True
+
+
+_stdlib_count = 0
+
+
+def stdlib_logger(format='simple', level=logging.DEBUG, context=(), keys=()):
+    global _stdlib_count
+    _stdlib_count += 1
+    log = logging.getLogger('bench.stdlib{}'.format(_stdlib_count))
+    log.propagate = False
+    log.setLevel(level)
+
+    keys = [key for (key, value) in context] + list(keys)
+    handler = logging.StreamHandler(NullStream())
+    if format == 'json':
+        handler.setFormatter(JSONFormatter(keys))
+    else:
+        handler.setFormatter(KeyValueFormatter(keys))
+    log.addHandler(handler)
+    if context:
+        log.addFilter(ContextFilter(context))
+    return log
+
+
+def make_context(num_context):
+    return [('ctx{}'.format(idx), 'value{}'.format(idx))
+            for idx in range(num_context)]
+
+
+# -- cases ------------------------------------------------------------------
+#
+# each case is a pair of functions that return a one-call "run" function
+# (or, for concurrent cases, a (run, calls_per_run) tuple)
+
+def case_filtered():
+    def lolog_run():
+        log = lolog_logger(level=lolog.INFO)
+        return lambda: log.debug('filtered out', a=1)
+
+    def stdlib_run():
+        log = stdlib_logger(level=logging.INFO)
+        return lambda: log.debug('filtered out', extra={'a': 1})
+
+    return (lolog_run, stdlib_run)
+
+
+def case_filtered_rebind():
+    def lolog_run():
+        log = lolog_logger(level=lolog.INFO)
+        log.config.set_rebind_methods(True)
+        return lambda: log.debug('filtered out', a=1)
+
+    # stdlib has no equivalent: compare to the usual guard
+    def stdlib_run():
+        log = stdlib_logger(level=logging.INFO)
+
+        def run():
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('filtered out', extra={'a': 1})
+        return run
+
+    return (lolog_run, stdlib_run)
+
+
+def case_format(format, num_context, num_keys=2):
+    keys = ['k{}'.format(idx) for idx in range(num_keys)]
+    kwargs = {key: idx for (idx, key) in enumerate(keys)}
+
+    def lolog_run():
+        log = lolog_logger(format=format, num_context=num_context)
+        return lambda: log.info('request done', **kwargs)
+
+    def stdlib_run():
+        log = stdlib_logger(
+            format=format, context=make_context(num_context), keys=keys)
+        return lambda: log.info('request done', extra=kwargs)
+
+    return (lolog_run, stdlib_run)
+
+
+def case_callable():
+    def memory():
+        return 123456
+
+    def lolog_run():
+        log = lolog_logger()
+        log.config.add_value('mem', memory)
+        return lambda: log.info('request done', a=1)
+
+    def stdlib_run():
+        log = stdlib_logger(context=[('mem', memory)], keys=['a'])
+        return lambda: log.info('request done', extra={'a': 1})
+
+    return (lolog_run, stdlib_run)
+
+
+def case_threads(num_threads, calls_per_thread=2000):
+    def run_threads(work):
+        def run():
+            threads = [threading.Thread(target=work)
+                       for idx in range(num_threads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return (run, num_threads * calls_per_thread)
+
+    def lolog_run():
+        log = lolog_logger()
+
+        def work():
+            for idx in range(calls_per_thread):
+                log.info('doing some work', iter=idx)
+        return run_threads(work)
+
+    def stdlib_run():
+        log = stdlib_logger(keys=['iter'])
+
+        def work():
+            for idx in range(calls_per_thread):
+                log.info('doing some work', extra={'iter': idx})
+        return run_threads(work)
+
+    return (lolog_run, stdlib_run)
+
+
+def case_asyncio(num_tasks=100, calls_per_task=100):
+    def run_tasks(work):
+        async def main():
+            await asyncio.gather(*[work() for idx in range(num_tasks)])
+
+        return (lambda: asyncio.run(main()), num_tasks * calls_per_task)
+
+    def lolog_run():
+        log = lolog_logger()
+
+        async def work():
+            for idx in range(calls_per_task):
+                log.info('doing some work', iter=idx)
+                await asyncio.sleep(0)
+        return run_tasks(work)
+
+    def stdlib_run():
+        log = stdlib_logger(keys=['iter'])
+
+        async def work():
+            for idx in range(calls_per_task):
+                log.info('doing some work', extra={'iter': idx})
+                await asyncio.sleep(0)
+        return run_tasks(work)
+
+    return (lolog_run, stdlib_run)
+
+
+class Intercepted:
+    """run function that keeps stdlib logging intercepted while it runs"""
+
+    def __init__(self, run, interceptor):
+        self.run = run
+        self.interceptor = interceptor
+
+    def __call__(self):
+        self.interceptor.intercept()
+        try:
+            self.run()
+        finally:
+            self.interceptor.undo()
+
+
+def case_intercept():
+    # stdlib logging calls from a library, handled by lolog or by stdlib
+    def lolog_run():
+        log = lolog_logger()
+        interceptor = lolog.iclogging.Interceptor(log.config, logging.Logger)
+        liblog = logging.getLogger('bench.intercepted')
+
+        def run():
+            for idx in range(100):
+                liblog.info('library message %s', idx)
+        return (Intercepted(run, interceptor), 100)
+
+    def stdlib_run():
+        log = stdlib_logger()
+
+        def run():
+            for idx in range(100):
+                log.info('library message %s', idx)
+        return (run, 100)
+
+    return (lolog_run, stdlib_run)
+
+
+CASES = {
+    'filtered': case_filtered,
+    'filtered-rebind': case_filtered_rebind,
+    'simple': lambda: case_format('simple', 0),
+    'json': lambda: case_format('json', 0),
+    'simple-context-10': lambda: case_format('simple', 10),
+    'json-context-10': lambda: case_format('json', 10),
+    'simple-context-50': lambda: case_format('simple', 50),
+    'json-context-50': lambda: case_format('json', 50),
+    'callable': case_callable,
+    'threads-1': lambda: case_threads(1),
+    'threads-4': lambda: case_threads(4),
+    'threads-16': lambda: case_threads(16),
+    'asyncio': case_asyncio,
+    'intercept': case_intercept,
+}
+
+
+# -- measurement ------------------------------------------------------------
+
+def measure_time(run, calls_per_run, calls):
+    runs = max(1, calls // calls_per_run)
+    run()                       # warm up
+    best = None
+    for attempt in range(3):
+        start = time.perf_counter()
+        for idx in range(runs):
+            run()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (runs * calls_per_run, best / (runs * calls_per_run) * 1e9)
+
+
+def measure_memory(run, samples=20):
+    tracemalloc.start()
+    try:
+        total = 0
+        for idx in range(samples):
+            tracemalloc.reset_peak()
+            (base, peak) = tracemalloc.get_traced_memory()
+            run()
+            (current, peak) = tracemalloc.get_traced_memory()
+            total += peak - base
+        return total / samples
+    finally:
+        tracemalloc.stop()
+
+
+def run_case(name, calls):
+    (lolog_run, stdlib_run) = CASES[name]()
+    for (impl, setup) in [('lolog', lolog_run), ('stdlib', stdlib_run)]:
+        run = setup()
+        if isinstance(run, tuple):
+            (run, calls_per_run) = run
+            peak_bytes = None
+        else:
+            calls_per_run = 1
+            peak_bytes = measure_memory(run)
+        (total_calls, ns_per_call) = measure_time(run, calls_per_run, calls)
+        yield {
+            'case': name,
+            'impl': impl,
+            'calls': total_calls,
+            'ns_per_call': round(ns_per_call, 1),
+            'peak_bytes_per_call': peak_bytes,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=20000,
+                        help='number of log calls per measurement')
+    parser.add_argument('--text', action='store_true',
+                        help='print a human-readable table instead of JSON')
+    parser.add_argument('cases', nargs='*', metavar='CASE',
+                        help='cases to run (default: all of {})'.format(
+                            ', '.join(CASES)))
+    args = parser.parse_args()
+
+    for name in args.cases:
+        if name not in CASES:
+            parser.error('unknown case: {}'.format(name))
+
+    for name in args.cases or CASES:
+        for result in run_case(name, args.calls):
+            if args.text:
+                print('{case:20s} {impl:6s} {ns_per_call:10.1f} ns/call'
+                      .format(**result))
+            else:
+                print(json.dumps(result))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
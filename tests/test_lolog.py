@@ -1,12 +1,22 @@
+import asyncio
+import atexit
+import fnmatch
 import io
 import json
+import logging
+import math
+import os
+import signal
+import threading
+import time
+import tracemalloc
 from typing import Any, List, Tuple
 
 import freezegun
 import pytest
 
 import lolog
-from lolog import pylolog
+from lolog import binlog, iclogging, multiproc, pylolog, query
 
 
 def test_init_defaults():
@@ -200,3 +210,1596 @@ def test_replace():
     lines = outfile.getvalue().splitlines()
     assert lines[0] == '2020-01-14T16:00:00.000000 HELLO test 1 name=foo level=INFO'
     assert lines[1] == '2020-01-14T16:00:00.100000 test 2 name=bar level=DEBUG'
+
+
+def test_cached_level():
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile, level=lolog.INFO)
+
+    log = cfg.get_logger('app.db')
+    log.debug('dropped 1')
+    assert log.level == lolog.INFO
+    generation = cfg.generation
+
+    # every kind of level change invalidates the cached level
+    cfg.set_default_level(lolog.DEBUG)
+    assert cfg.generation > generation
+    log.debug('kept 1')
+    assert log.level == lolog.DEBUG
+
+    cfg.set_logger_pattern_level('app.*', lolog.WARNING)
+    log.info('dropped 2')
+    assert log.get_level() == lolog.WARNING
+
+    cfg.set_logger_level('app.db', lolog.ERROR)
+    log.warning('dropped 3')
+    log.error('kept 2')
+    assert log.get_level() == lolog.ERROR
+
+    lines = outfile.getvalue().splitlines()
+    assert [line.split()[1:3] for line in lines] == [
+        ['kept', '1'],
+        ['kept', '2'],
+    ]
+
+
+def test_rebind_methods():
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile, level=lolog.INFO)
+
+    log1 = cfg.get_logger('app')
+    assert 'debug' not in vars(log1)
+
+    cfg.set_rebind_methods(True)
+    log2 = cfg.get_logger('lib')
+    for log in [log1, log2]:
+        assert log.debug is pylolog._disabled_method
+        assert log.info.__func__ is pylolog.Logger.info     # type: ignore
+
+    # level changes rebind existing loggers eagerly
+    cfg.set_logger_level('lib', lolog.ERROR)
+    assert log1.info.__func__ is pylolog.Logger.info        # type: ignore
+    assert log2.info is log2.warning is pylolog._disabled_method
+    assert log2.error.__func__ is pylolog.Logger.error      # type: ignore
+
+    log1.debug('dropped')
+    log1.info('kept 1')
+    log2.warning('dropped')
+    log2.error('kept 2')
+
+    # turning it off restores the real methods
+    cfg.set_rebind_methods(False)
+    assert 'debug' not in vars(log1)
+    assert 'warning' not in vars(log2)
+    log2.warning('dropped')
+
+    lines = outfile.getvalue().splitlines()
+    assert [line.split()[1:3] for line in lines] == [
+        ['kept', '1'],
+        ['kept', '2'],
+    ]
+
+
+class SlowStream(io.StringIO):
+    """stream whose write() blocks until the test lets it proceed"""
+
+    def __init__(self):
+        super().__init__()
+        self.ready = threading.Event()
+
+    def write(self, text):
+        self.ready.wait()
+        return super().write(text)
+
+
+def test_queue_output():
+    outfile = SlowStream()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile, output='queue')
+    output = cfg.pipeline[-1]
+    assert isinstance(output, pylolog.QueueOutput)
+
+    # logging does not block even though the stream does
+    log = cfg.get_logger('app')
+    for idx in range(5):
+        log.info('message', idx=idx)
+    assert outfile.getvalue() == ''
+
+    outfile.ready.set()
+    output.flush()
+    lines = outfile.getvalue().splitlines()
+    assert [line.split()[-1] for line in lines] == [
+        'idx=0', 'idx=1', 'idx=2', 'idx=3', 'idx=4']
+
+    # after close(), output is synchronous
+    output.close()
+    assert output.thread is None
+    log.info('message', idx=5)
+    assert outfile.getvalue().splitlines()[-1].endswith('idx=5')
+
+
+@pytest.mark.parametrize('overflow, expect', [
+    ('drop-newest', ['idx=0', 'idx=1', 'idx=2']),
+    ('drop-oldest', ['idx=0', 'idx=4', 'idx=5']),
+])
+def test_queue_output_overflow(overflow, expect):
+    outfile = SlowStream()
+    output = pylolog.QueueOutput(maxsize=2, overflow=overflow)
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile, output=output)
+
+    # the first record is taken by the writer thread, which then blocks
+    # writing it; the rest pile up in the queue
+    log = cfg.get_logger('app')
+    log.info('message', idx=0)
+    while output.queue:
+        time.sleep(0.001)
+    for idx in range(1, 6):
+        log.info('message', idx=idx)
+    assert output.dropped == 3
+
+    outfile.ready.set()
+    output.close()
+    lines = outfile.getvalue().splitlines()
+    assert [line.split()[-1] for line in lines] == expect
+
+
+def test_queue_output_bad_policy():
+    with pytest.raises(ValueError):
+        pylolog.QueueOutput(overflow='explode')
+
+
+def test_output_threads_register_atexit_once():
+    # restarting a stage's thread (e.g. in a forked child) must not add
+    # another exit handler each time
+    cfg = lolog.make_config()
+    cfg.configure(stream=io.StringIO())
+    collapse = pylolog.Collapse(window=0.01)
+    pipelines: List[Any] = [
+        [pylolog.format_simple, pylolog.QueueOutput()],
+        [pylolog.format_simple, pylolog.BufferedOutput(max_delay=0.01)],
+        [collapse, pylolog.format_simple, pylolog.output_stream],
+    ]
+    count = atexit._ncallbacks()
+    log = cfg.get_logger('app')
+    for pipeline in pipelines:
+        cfg.pipeline = pipeline
+        stage = pipeline[0] if pipeline[0] is collapse else pipeline[1]
+        for _ in range(2):
+            log.info('again')
+            log.info('again')
+            stage.close()
+            stage.closed = False
+            stage._after_fork()
+    assert atexit._ncallbacks() == count
+
+
+class CountingStream(io.StringIO):
+    """stream that counts calls to write()"""
+
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, text):
+        self.writes += 1
+        return super().write(text)
+
+
+def test_buffered_output():
+    outfile = CountingStream()
+    output = pylolog.BufferedOutput(max_size=200, max_delay=60.0)
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile, output=output)
+
+    # small records are batched until the buffer passes max_size
+    log = cfg.get_logger('app')
+    for idx in range(5):
+        log.info('a fairly chatty message', idx=idx)
+    assert outfile.writes == 1
+    assert len(outfile.getvalue().splitlines()) == 3
+
+    # errors are flushed immediately, along with everything before them
+    log.error('uh oh')
+    assert outfile.writes == 2
+    assert outfile.getvalue().splitlines()[-1].endswith('uh oh name=app level=ERROR')
+
+    log.info('buffered')
+    assert outfile.writes == 2
+    output.close()
+    assert outfile.writes == 3
+    assert output.thread is None
+
+
+def test_buffered_output_timeout():
+    outfile = CountingStream()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile, output=pylolog.BufferedOutput(max_delay=0.01))
+
+    log = cfg.get_logger('app')
+    log.info('message 1')
+    log.info('message 2')
+    assert outfile.writes == 0
+
+    deadline = time.monotonic() + 5.0
+    while outfile.writes == 0 and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert outfile.writes == 1
+    assert len(outfile.getvalue().splitlines()) == 2
+
+
+def read_pipe(rfd, received):
+    with os.fdopen(rfd, 'rb') as infile:
+        received.append(infile.read())
+
+
+def test_async_output():
+    (rfd, wfd) = os.pipe()
+    stream = os.fdopen(wfd, 'w')
+    cfg = lolog.make_config()
+    cfg.configure(stream=stream, output='async')
+    output = cfg.pipeline[-1]
+    assert isinstance(output, pylolog.AsyncOutput)
+    log = cfg.get_logger('app')
+    received: List[bytes] = []
+    reader = threading.Thread(target=read_pipe, args=(rfd, received))
+
+    async def main():
+        # more than the pipe can hold, with nobody reading: if logging
+        # blocked, this would never return
+        for idx in range(2000):
+            log.info('x' * 100, idx=idx)
+        assert output.size > 0 and output.writing
+        assert not os.get_blocking(wfd)
+
+        reader.start()
+        await output.flush()
+        assert output.size == 0 and not output.writing
+        log.info('last in loop')
+        await output.aclose()
+
+    asyncio.run(main())
+    assert os.get_blocking(wfd)
+    log.info('after loop')
+    stream.close()
+    reader.join()
+
+    lines = received[0].decode().splitlines()
+    assert output.dropped == output.errors == 0
+    assert [line.split()[-1] for line in lines[:-2]] == [
+        'idx={}'.format(idx) for idx in range(2000)]
+    assert lines[-2].split(' ', 1)[1] == 'last in loop name=app level=INFO'
+    assert lines[-1].split(' ', 1)[1] == 'after loop name=app level=INFO'
+
+
+@pytest.mark.parametrize('overflow, expect', [
+    ('drop-newest', ['r0', 'r1', 'r2']),
+    ('drop-oldest', ['r7', 'r8', 'r9']),
+])
+def test_async_output_overflow(overflow, expect):
+    (rfd, wfd) = os.pipe()
+    stream = os.fdopen(wfd, 'w')
+
+    # fill the pipe, so that nothing logged can be written
+    os.set_blocking(wfd, False)
+    filled = 0
+    try:
+        while True:
+            filled += os.write(wfd, b'.' * 4096)
+    except BlockingIOError:
+        pass
+
+    def format_message(config, record):
+        record.outbuf.append(record.message + '\n')
+        return record
+
+    output = pylolog.AsyncOutput(max_size=9, overflow=overflow)
+    cfg = lolog.make_config()
+    cfg.configure(stream=stream, format=format_message, output=output)
+    log = cfg.get_logger('app')
+    received: List[bytes] = []
+
+    async def main():
+        for idx in range(10):
+            log.info('r{}'.format(idx))
+        assert output.dropped == 7
+        threading.Thread(target=read_pipe, args=(rfd, received)).start()
+        await output.aclose()
+
+    asyncio.run(main())
+    stream.close()
+    deadline = time.monotonic() + 5.0
+    while not received and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert received[0][:filled] == b'.' * filled
+    assert received[0][filled:].decode().splitlines() == expect
+
+
+def format_json_generic(config, record):
+    # the original implementation of format_json(), relying entirely on
+    # the JSON encoder: the fast version must produce identical output
+    data = {
+        'time': config.format_time(record.time),
+        'message': record.message,
+    }
+    data.update(record.get_items())
+    return pylolog._json_encoder.encode(data) + '\n'
+
+
+def test_format_json_matches_generic():
+    config = lolog.make_config()
+    ts = 1581411252.431693
+
+    class MyStr(str):
+        pass
+
+    logmap = [
+        ('s', 'plain'),
+        ('u', '←‽→ "quoted" \\ \n\t\x00'),
+        ('i', -42),
+        ('big', 2**80),
+        ('f', 0.1),
+        ('nan', float('nan')),
+        ('inf', float('-inf')),
+        ('t', True),
+        ('n', None),
+        ('lvl', lolog.WARNING),
+        ('sub', MyStr('sub')),
+        ('d', {'x': [1, 2.5, None]}),
+        ('obj', Dummy()),
+        ('call', lambda: 'called'),
+        ('i', 'duplicate key replaces the earlier value'),
+        ('name', 'so does a builtin key'),
+    ]
+    for (key, value) in logmap:
+        rec = pylolog.Record(
+            ts, 'foo', lolog.INFO, 'hello "world"', [(key, value)], outbuf=[])
+        pylolog.format_json(config, rec)
+        assert rec.outbuf == [format_json_generic(config, rec)]
+
+    rec = pylolog.Record(
+        ts, 'foo', lolog.INFO, 'msg', logmap, outbuf=[])
+    pylolog.format_json(config, rec)
+    assert rec.outbuf == [format_json_generic(config, rec)]
+
+
+def test_format_time(monkeypatch):
+    cfg = lolog.make_config()
+    ts = 1581411252.431693
+
+    assert cfg.format_time(ts) == '2020-02-11T08:54:12.431693'
+    assert cfg.format_time(ts + 0.5) == '2020-02-11T08:54:12.931693'
+    assert cfg.format_time(ts + 1.0) == '2020-02-11T08:54:13.431693'
+
+    # changing timezone invalidates the cache
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    try:
+        assert cfg.format_time(ts + 1.0) == '2020-02-11T03:54:13.431693'
+    finally:
+        monkeypatch.setenv('TZ', 'UTC')
+        time.tzset()
+    assert cfg.format_time(ts + 1.0) == '2020-02-11T08:54:13.431693'
+
+    cfg.set_time_format('utc')
+    assert cfg.format_time(ts) == '2020-02-11T08:54:12.431693Z'
+
+    cfg.set_time_format('epoch_ns')
+    assert cfg.format_time(ts) == '1581411252431693000'
+
+    cfg.set_time_format('local')
+    assert cfg.format_time(ts) == '2020-02-11T08:54:12.431693'
+
+    with pytest.raises(ValueError):
+        cfg.set_time_format('sundial')
+
+
+@pytest.mark.parametrize('format', ['simple', 'json'])
+def test_static_fragments(format):
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile, format=format)
+    records = []
+
+    def capture(config, record):
+        records.append(record)
+        return record
+
+    cfg.insert_stage(0, capture)
+    calls = []
+
+    def dynamic():
+        calls.append(1)
+        return 'dyn{}'.format(len(calls))
+
+    cfg.add_value('pid', 1234)
+    cfg.add_value('host', 'web1')
+    cfg.add_value('seq', dynamic)
+    cfg.add_value('svc', 'api')
+    log = cfg.get_logger('app')
+    log.add_value('component', 'db')
+    cfg.add_local_value('request_id', 'r1')
+    try:
+        log.info('one', a=1)
+        log.info('two', pid=99)
+        assert len(calls) == 2
+
+        # static layers are formatted once, until the next add_value()
+        assert len(cfg.log_map.get_fragments(pylolog._format_simple_item)) == 3
+        cfg.add_value('region', 'eu')
+        log.add_value('shard', 7)
+        log.info('three', b=[1])
+    finally:
+        cfg.clear_local_log_map()
+
+    lines = outfile.getvalue().splitlines()
+    assert len(lines) == 3
+    if format == 'simple':
+        assert lines[0].endswith(
+            ' one name=app level=INFO pid=1234 host=web1 seq=dyn1 svc=api '
+            'request_id=r1 component=db a=1')
+        assert lines[2].endswith(
+            ' three name=app level=INFO pid=1234 host=web1 seq=dyn3 svc=api '
+            'region=eu request_id=r1 component=db shard=7 b=[1]')
+    else:
+        # identical to formatting the flattened log map in one go; for
+        # the repeated key in the second record, the later value wins
+        del calls[:]
+        for (line, record) in zip(lines, records):
+            assert line + '\n' == format_json_generic(cfg, record)
+        assert json.loads(lines[1])['pid'] == 99
+
+
+@pytest.mark.parametrize('format', ['simple', 'json'])
+def test_modify_log_map(format):
+    # any change to a layer, not just append(), drops its formatted form
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile, format=format)
+    log = cfg.get_logger('app')
+    layer = cfg.get_log_map()
+    layer.append(('a', 1))
+    expect = []
+
+    def check(*items):
+        log.info('msg')
+        expect.append(dict(items))
+
+    check(('a', 1))
+    layer.extend([('b', 2)])
+    check(('a', 1), ('b', 2))
+    layer[0] = ('a', 3)
+    check(('a', 3), ('b', 2))
+    layer.insert(0, ('c', 4))
+    check(('c', 4), ('a', 3), ('b', 2))
+    del layer[1]
+    check(('c', 4), ('b', 2))
+    layer += [('d', 5)]
+    check(('c', 4), ('b', 2), ('d', 5))
+    layer.pop()
+    check(('c', 4), ('b', 2))
+    layer.remove(('c', 4))
+    check(('b', 2))
+    layer *= 1
+    layer.reverse()
+    layer.sort()
+    check(('b', 2))
+    layer.clear()
+    check()
+
+    if format == 'simple':
+        items = [line.split(' level=INFO')[1]
+                 for line in outfile.getvalue().splitlines()]
+        assert items == [''.join(' {}={}'.format(*item) for item in values.items())
+                         for values in expect]
+    else:
+        records = [json.loads(line) for line in outfile.getvalue().splitlines()]
+        for record in records:
+            for key in ('time', 'message', 'name', 'level'):
+                del record[key]
+        assert records == expect
+
+
+def test_lazy_record():
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile)
+    cfg.add_value('pid', 1234)
+    log = cfg.get_logger('app')
+    log.add_value('component', 'db')
+
+    records = []
+
+    def inspect(config, record):
+        records.append(record)
+        if record.message == 'drop':
+            return None
+        if record.message == 'modify':
+            record.log_map.append(('extra', 'yes'))
+        return record
+
+    cfg.insert_stage(0, inspect)
+    log.info('drop', a=1)
+    log.info('modify', a=2)
+    log.info('replace', a=3)
+
+    # the dropped record never merged its layers
+    assert records[0]._log_map is None
+    assert records[0].log_map == [('pid', 1234), ('component', 'db'), ('a', 1)]
+
+    # adding values does not affect records already created
+    cfg.add_value('late', True)
+    assert records[2].log_map == [('pid', 1234), ('component', 'db'), ('a', 3)]
+    rec = records[2].replace(message='replaced')
+    assert rec.layers is records[2].layers
+    assert rec.message == 'replaced'
+    rec = rec.replace(log_map=[('only', 1)])
+    assert rec.layers is None
+    assert rec.get_items() == [('name', 'app'), ('level', 'INFO'), ('only', 1)]
+
+    # the tuple API that Record had as a NamedTuple
+    (time_, name, level, message, log_map, outbuf, layers) = rec
+    assert (name, level, message, log_map, layers) == (
+        'app', lolog.INFO, 'replaced', [('only', 1)], None)
+    assert rec[3] == rec[-4] == 'replaced'
+    assert rec[1:3] == ('app', lolog.INFO)
+    assert len(rec) == len(rec._fields) + 1
+    assert rec._replace(message='again').message == 'again'
+    assert rec._asdict()['log_map'] == [('only', 1)]
+
+    lines = outfile.getvalue().splitlines()
+    assert len(lines) == 2
+    assert lines[0].endswith(
+        ' modify name=app level=INFO pid=1234 component=db a=2 extra=yes')
+    assert lines[1].endswith(' replace name=app level=INFO pid=1234 component=db a=3')
+
+
+def test_cached_value(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: clock[0])
+    calls = {'per_record': 0, 'ttl': 0}
+
+    def per_record():
+        calls['per_record'] += 1
+        return calls['per_record']
+
+    def ttl():
+        calls['ttl'] += 1
+        return calls['ttl']
+
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile)
+    cfg.add_value('r', per_record)
+    cfg.add_value('t', lolog.Cached(ttl, ttl=10.0))
+    items = []
+
+    def inspect(config, record):
+        items.append(record.get_items())
+        return record
+
+    cfg.insert_stage(0, inspect)
+    cfg.insert_stage(2, pylolog.format_json)
+    log = cfg.get_logger('app')
+
+    # every stage sees the same value, from a single call
+    log.info('one')
+    assert calls == {'per_record': 1, 'ttl': 1}
+    assert items[0][-2:] == [('r', 1), ('t', 1)]
+    (simple, jsonline) = outfile.getvalue().splitlines()
+    assert simple.endswith(' one name=app level=INFO r=1 t=1')
+    assert json.loads(jsonline[jsonline.index('{'):])['r'] == 1
+
+    # the cached value is reused until it expires
+    clock[0] += 9.0
+    log.info('two')
+    assert calls == {'per_record': 2, 'ttl': 1}
+    clock[0] += 1.0
+    log.info('three')
+    assert calls == {'per_record': 3, 'ttl': 2}
+    assert [rec[-1] for rec in items] == [('t', 1), ('t', 1), ('t', 2)]
+
+    once = lolog.Cached(ttl, ttl=math.inf)
+    assert once() == once() == 3
+    once.clear()
+    assert once() == 4
+    assert lolog.Cached(ttl)() == 5
+
+
+def test_bind():
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile)
+    log = cfg.get_logger('app')
+
+    with log.bind(request_id='r1'):
+        layer = cfg.get_local_layers()[0]
+        log.info('one')
+        with cfg.bind(user='joe'):
+            cfg.add_local_value('step', 2)
+            log.info('two')
+        log.info('three')
+        # the bound layer is formatted once, and reused
+        assert cfg.get_local_layers() == (layer,)
+        assert list(layer._cache) == [pylolog._format_simple_item]
+    log.info('four')
+    assert cfg.get_local_log_map() == []
+
+    async def handle(request_id, results):
+        with log.bind(request_id=request_id):
+            await asyncio.sleep(0)
+            results.append(cfg.get_local_log_map())
+            log.info('task')
+
+    async def main():
+        results: List[Any] = []
+        with log.bind(server='s1'):
+            await asyncio.gather(handle('a', results), handle('b', results))
+        return results
+
+    assert sorted(asyncio.run(main())) == [
+        [('server', 's1'), ('request_id', 'a')],
+        [('server', 's1'), ('request_id', 'b')],
+    ]
+
+    lines = [line.split(' ', 1)[1] for line in outfile.getvalue().splitlines()]
+    assert lines[:4] == [
+        'one name=app level=INFO request_id=r1',
+        'two name=app level=INFO request_id=r1 user=joe step=2',
+        'three name=app level=INFO request_id=r1',
+        'four name=app level=INFO',
+    ]
+    assert sorted(lines[4:]) == [
+        'task name=app level=INFO server=s1 request_id=a',
+        'task name=app level=INFO server=s1 request_id=b',
+    ]
+
+
+@pytest.mark.skipif(pylolog._speedups is None, reason='lolog._speedups not built')
+def test_speedups():
+    # the compiled hot path produces exactly what the Python version does
+    ts = 1581411252.431693
+    static = pylolog.LogMapLayer([('host', 'web1'), ('n', 3)])
+    static.append(('seq', lambda: 'dyn'))
+    static.append(('obj', Dummy()))
+    layer_cases: List[Any] = [
+        (),
+        (static, (), pylolog.LogMapLayer(), {'a': 1, 'b': [1, 'x']}.items()),
+        (static, [['list', 'item'], ('f', 2.5)], {'c': lambda: None}.items()),
+        # repeated keys: JSON falls back to building a dict
+        (static, {'n': 4, 'message': 'again'}.items()),
+        ([('a', 1), ('b', 2), ('a', 3)],),
+        # values the compiled JSON formatter encodes itself, and others
+        ([('none', None), ('t', True), ('f', False), ('big', 2 ** 70),
+          ('neg', -1.5e300), ('nan', math.nan), ('inf', -math.inf),
+          ('lvl', lolog.ERROR), ('d', {'k': (1, 2)}), ('u', '\u00fc\U0001f600')],),
+        # keys that are not str; more keys than fit on the stack
+        ([(1, 'one'), ('x', 'y')],),
+        ([('k{}'.format(idx), idx) for idx in range(50)],
+         [('k{}'.format(idx), idx) for idx in range(50, 100)]),
+        ([('k{}'.format(idx), idx) for idx in range(50)], [('k7', 'again')]),
+    ]
+    config = lolog.make_config()
+    for layers in layer_cases:
+        for (compiled, python) in [
+                (pylolog.format_simple, pylolog._py_format_simple),
+                (pylolog.format_json, pylolog._py_format_json),
+        ]:
+            outputs = []
+            for formatter in (compiled, python):
+                record = pylolog.Record(
+                    ts, 'app', lolog.WARNING, 'hi "there"', layers=layers)
+                assert formatter(config, record) is record
+                outputs.append(''.join(record.outbuf))
+            assert outputs[0] == outputs[1]
+
+    with pytest.raises(ValueError):
+        pylolog.format_simple(config, pylolog.Record(
+            ts, 'app', lolog.INFO, 'bad', layers=([('a', 1, 2)],)))   # type: ignore
+
+    # log methods, and Logger._log()
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile, format='json', level=lolog.INFO)
+    cfg.time = lambda: ts
+    cfg.add_value('pid', 1234)
+    log = cfg.get_logger('app')
+    with log.bind(request_id='r1'):
+        log.info('one', a=1, b='x')
+        pylolog._py_logger_log(log, lolog.INFO, 'one', {'a': 1, 'b': 'x'}.items())
+        log.warning(message='two')
+        pylolog._py_logger_log(log, lolog.WARNING, 'two', [])
+        log._log(lolog.ERROR, 'three', [('c', None)])
+        pylolog._py_logger_log(log, lolog.ERROR, 'three', [('c', None)])
+        log.debug('filtered')
+    lines = outfile.getvalue().splitlines()
+    assert len(lines) == 6
+    assert lines[0::2] == lines[1::2]
+    with pytest.raises(TypeError):
+        log.info('too', 'many')                 # type: ignore
+    with pytest.raises(TypeError):
+        log.info('twice', message='again')      # type: ignore
+    assert len(outfile.getvalue().splitlines()) == 6
+
+
+class NullStream(io.StringIO):
+    def write(self, text):
+        return len(text)
+
+
+@pytest.mark.parametrize('format', ['simple', 'json'])
+def test_emit_allocations(format):
+    # logging a record needs a small amount of memory at once, and keeps
+    # none of it
+    cfg = lolog.make_config()
+    cfg.configure(stream=NullStream(), format=format)
+    cfg.add_value('pid', 1234)
+    log = cfg.get_logger('app')
+
+    def emit(idx):
+        log.info('hello', a=idx, b='x', c=2.5)
+
+    # memory allocated by lolog, or by the compiled log methods (which is
+    # traced to their caller)
+    lolog_only = [
+        tracemalloc.Filter(True, os.path.join(os.path.dirname(lolog.__file__), '*')),
+        tracemalloc.Filter(True, __file__, emit.__code__.co_firstlineno + 1),
+    ]
+
+    # trace the warm-up too, so that blocks it leaves in caches and
+    # freelists are traced when they are reused
+    tracemalloc.start()
+    try:
+        with log.bind(request_id='r1'):
+            for idx in range(100):
+                emit(idx)
+            before = tracemalloc.take_snapshot().filter_traces(lolog_only)
+            for idx in range(1000):
+                tracemalloc.reset_peak()
+                start = tracemalloc.get_traced_memory()[0]
+                emit(idx)
+                assert tracemalloc.get_traced_memory()[1] - start < 8192
+            after = tracemalloc.take_snapshot().filter_traces(lolog_only)
+    finally:
+        tracemalloc.stop()
+
+    # (a few blocks may move into freelists)
+    stats = after.compare_to(before, 'lineno')
+    assert sum(stat.count_diff for stat in stats) < 5
+    assert sum(stat.size_diff for stat in stats) < 512
+
+
+def test_recycled_records():
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile)
+    assert cfg.recycle_records
+
+    # a stage that may keep records turns recycling off
+    kept = []
+
+    def keep(config, record):
+        kept.append(record)
+        return record
+
+    cfg.insert_stage(0, keep)
+    assert not cfg.recycle_records
+    log = cfg.get_logger('app')
+    log.info('first', a=1)
+    log.info('second', a=2)
+    lines = outfile.getvalue().splitlines()
+    assert [(r.message, dict(r.get_items())['a'], ''.join(r.outbuf))
+            for r in kept] == [('first', 1, lines[0] + '\n'),
+                               ('second', 2, lines[1] + '\n')]
+    cfg.pipeline.remove(keep)
+    assert cfg.recycle_records
+
+    # a callable value that logs itself, to another config
+    other_file = io.StringIO()
+    other = lolog.make_config()
+    other.configure(stream=other_file)
+    other_log = other.get_logger('other')
+
+    def nested():
+        other_log.info('nested')
+        return 'n'
+
+    log.add_value('n', nested)
+    for idx in range(3):
+        log.info('outer', idx=idx)
+    lines = outfile.getvalue().splitlines()[2:]
+    assert [line.split(' ', 1)[1] for line in lines] == [
+        'outer name=app level=INFO n=n idx={}'.format(idx)
+        for idx in range(3)]
+    assert len(other_file.getvalue().splitlines()) == 3
+    assert all(' nested name=other level=INFO' in line
+               for line in other_file.getvalue().splitlines())
+
+
+@pytest.mark.parametrize('format', ['simple', 'json'])
+def test_greenlet_switch(format):
+    # a callable value switches to another greenlet halfway through a
+    # record, and that greenlet logs too: neither line takes parts of the
+    # other, and neither record is recycled while in use
+    greenlet = pytest.importorskip('greenlet')
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile, format=format)
+    log = cfg.get_logger('app')
+
+    def who():
+        current = greenlet.getcurrent()
+        if current is other:
+            main.switch()
+        elif not other.dead:
+            other.switch()
+        return current.name
+
+    def run_other():
+        log.info('other', n=2)
+
+    cfg.add_value('who', who)
+    main = greenlet.getcurrent()
+    main.name = 'main'
+    other = greenlet.greenlet(run_other)
+    other.name = 'other'
+    log.info('main', n=1)
+    other.switch()
+    assert other.dead
+
+    lines = outfile.getvalue().splitlines()
+    if format == 'json':
+        records = [json.loads(line) for line in lines]
+        assert [(rec['message'], rec['who'], rec['n']) for rec in records] == [
+            ('main', 'main', 1), ('other', 'other', 2)]
+    else:
+        assert [line.split(' ', 1)[1] for line in lines] == [
+            'main name=app level=INFO who=main n=1',
+            'other name=app level=INFO who=other n=2']
+
+
+def test_compiled_pipeline():
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile)
+    source = cfg.pipeline_source
+    assert 'stage0(config, record)\n' in source
+    assert 'config.stream.write' in source
+    assert 'is None:\n        return' not in source
+
+    def drop_secrets(config, record):
+        if 'secret' in record.message:
+            return None
+        return record
+
+    # adding a stage recompiles the pipeline
+    cfg.insert_stage(0, drop_secrets)
+    assert cfg.pipeline_source != source
+    assert 'record = stage0(config, record)' in cfg.pipeline_source
+
+    log = cfg.get_logger('app')
+    log.info('top secret')
+    log.info('public')
+    lines = outfile.getvalue().splitlines()
+    assert len(lines) == 1
+    assert lines[0].endswith(' public name=app level=INFO')
+
+    # so does modifying the list directly, or replacing it
+    del cfg.pipeline[0]
+    assert cfg.pipeline_source == source
+    log.info('no secrets')
+    assert len(outfile.getvalue().splitlines()) == 2
+    cfg.pipeline[:0] = [drop_secrets]
+    log.info('secret again')
+    cfg.pipeline.remove(drop_secrets)
+    log.info('secret again')
+    assert len(outfile.getvalue().splitlines()) == 3
+    cfg.pipeline = [pylolog.format_json, pylolog.output_stream]
+    assert isinstance(cfg.pipeline, pylolog.Pipeline)
+    log.info('json')
+    assert json.loads(outfile.getvalue().splitlines()[-1])['message'] == 'json'
+
+
+def test_stats():
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile)
+    assert cfg.stats() is None
+    source = cfg.pipeline_source
+
+    def drop_odd(config, record):
+        if dict(record.log_map)['idx'] % 2:
+            return None
+        return record
+
+    cfg.insert_stage(0, drop_odd)
+    cfg.set_stats(True, sample_every=1)
+    log = cfg.get_logger('app')
+    for idx in range(10):
+        log.info('message', idx=idx)
+
+    stats = cfg.stats()
+    assert stats is not None
+    assert stats['records'] == 10
+    assert stats['sample_every'] == 1
+    (filter, format, output) = stats['stages']
+    assert filter['stage'] == 'drop_odd'
+    assert (filter['calls'], filter['dropped']) == (10, 5)
+    assert 'bytes' not in filter
+    assert format['stage'] == 'format_simple'
+    assert (format['calls'], format['dropped']) == (5, 0)
+    assert output['stage'] == 'output_stream'
+    assert output['calls'] == 5
+    assert output['bytes'] == len(outfile.getvalue())
+    for stage in stats['stages']:
+        assert 0 < stage['time_p50'] <= stage['time_p99'] <= stage['time_max']
+        assert stage['time_total'] > 0
+
+    # recompiling the pipeline starts all the counters again
+    cfg.pipeline.remove(drop_odd)
+    stats = cfg.stats()
+    assert stats is not None
+    assert stats['records'] == 0
+    assert [stage['calls'] for stage in stats['stages']] == [0, 0]
+    for idx in range(3):
+        log.info('message', idx=idx)
+    stats = cfg.stats()
+    assert stats is not None
+    assert stats['records'] == 3
+    assert [stage['calls'] for stage in stats['stages']] == [3, 3]
+    cfg.insert_stage(0, drop_odd)
+
+    # turning stats off goes back to the plain pipeline
+    cfg.set_stats(False)
+    assert cfg.stats() is None
+    assert 'stats' not in cfg.pipeline_source
+    del cfg.pipeline[0]
+    assert cfg.pipeline_source == source
+
+
+def fork_child(func):
+    # fork a child that runs func() and exits with its return value (or 1
+    # on exception)
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            signal.alarm(10)        # don't hang the test run on deadlock
+            code = func()
+        finally:
+            os._exit(code)
+    return pid
+
+
+def wait_child(pid):
+    (_, status) = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status)
+
+
+def run_child(func):
+    return wait_child(fork_child(func))
+
+
+def test_multiproc_collector():
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile, format='json')
+    collector = multiproc.Collector(cfg)
+    collector.start()
+
+    def child():
+        log = cfg.get_logger('worker')
+        assert isinstance(cfg.pipeline[0], multiproc.ForwardStage)
+        for idx in range(3):
+            log.info('hello', pid=os.getpid, idx=idx, obj=object())
+        return 0
+
+    assert run_child(child) == 0
+    assert run_child(child) == 0
+    collector.stop()
+
+    # the parent's pipeline is untouched, and emitted every child record
+    assert not isinstance(cfg.pipeline[0], multiproc.ForwardStage)
+    records = [json.loads(line) for line in outfile.getvalue().splitlines()]
+    assert len(records) == 6
+    assert [rec['idx'] for rec in records] == [0, 1, 2, 0, 1, 2]
+    assert all(rec['name'] == 'worker' for rec in records)
+    assert all(rec['pid'] != os.getpid() for rec in records)
+    assert records[0]['obj'].startswith('<object object at')
+    assert collector.errors == 0
+
+
+def test_multiproc_collector_gone(tmp_path):
+    path = tmp_path / 'out.log'
+    with open(path, 'w') as outfile:
+        cfg = lolog.make_config()
+        cfg.configure(stream=outfile, format='simple')
+        collector = multiproc.Collector(cfg)
+        collector.start()
+        (sent_r, sent_w) = os.pipe()
+        (stopped_r, stopped_w) = os.pipe()
+
+        def child():
+            log = cfg.get_logger('worker')
+            log.info('sent')
+            os.write(sent_w, b'x')
+            os.read(stopped_r, 1)
+            log.info('local 1')
+            log.info('local 2')
+            assert not any(isinstance(stage, multiproc.ForwardStage)
+                           for stage in cfg.pipeline)
+            outfile.flush()
+            return 0
+
+        pid = fork_child(child)
+        os.read(sent_r, 1)
+        collector.stop()
+        outfile.flush()
+        os.write(stopped_w, b'x')
+        assert wait_child(pid) == 0
+
+    lines = path.read_text().splitlines()
+    assert [line.split(' name=')[0].split(' ', 1)[1] for line in lines] == [
+        'sent', 'local 1', 'local 2']
+
+
+def test_multiproc_collector_stalled():
+    # the collector is alive, but its pipeline is stuck: workers must not
+    # wait for it
+    cfg = lolog.make_config()
+    cfg.configure(stream=io.StringIO(), format='simple')
+    parent = os.getpid()
+    release = threading.Event()
+
+    def stall(config, record):
+        if os.getpid() == parent:
+            release.wait()
+        return record
+
+    cfg.insert_stage(0, stall)
+    collector = multiproc.Collector(cfg, backoff=0.2)
+    collector.start()
+
+    def child():
+        log = cfg.get_logger('worker')
+        stage = cfg.pipeline[0]
+        assert isinstance(stage, multiproc.ForwardStage)
+        slowest = 0.0
+        for idx in range(2000):
+            start = time.monotonic()
+            log.info('hello', idx=idx, pad='x' * 200)
+            slowest = max(slowest, time.monotonic() - start)
+        assert slowest < 0.1
+        assert stage.local > 0 and stage.retry_at
+
+        # after the backoff, it tries to forward again
+        (local, retry_at) = (stage.local, stage.retry_at)
+        time.sleep(0.3)
+        log.info('retry')
+        assert stage.local == local + 1
+        assert stage.retry_at > retry_at
+        return 0
+
+    try:
+        assert run_child(child) == 0
+    finally:
+        release.set()
+        collector.stop()
+
+
+def test_multiproc_held_mutex():
+    # a thread holds the config lock while another forks: the child must
+    # still be able to use the config
+    cfg = lolog.make_config()
+    cfg.configure(stream=io.StringIO())
+    locked = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with cfg.mutex:
+            locked.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    locked.wait()
+    try:
+        assert run_child(lambda: cfg.get_logger('child') and 0) == 0
+    finally:
+        release.set()
+        thread.join()
+
+
+@freezegun.freeze_time('2020-01-14 13:14:43.4')
+@pytest.mark.parametrize('format', ['simple', 'json'])
+def test_binlog_render(format, tmp_path, capsys):
+    # records rendered from a binary log match records formatted directly
+    path = tmp_path / 'test.lolog'
+    text = io.StringIO()
+    with open(path, 'wb') as outfile:
+        for stage in [None, binlog.BinaryOutput(outfile, max_strings=4)]:
+            cfg = lolog.make_config()
+            if stage is None:
+                cfg.configure(stream=text, format=format)
+            else:
+                cfg.add_stage(stage)
+            cfg.add_value('host', 'example')
+            cfg.add_value('pid', lambda: 1234)
+            log = cfg.get_logger('app')
+            log.info('hello', a=1, b=2.5, c=None, d=True, e=[1, 'x'])
+            log.warning('hello again', big=2 ** 40, huge=2 ** 70, x='x' * 300)
+            log.error('last', obj=Dummy(), text='\u00fcnic\u00f6de')
+
+    binlog.main(['--format', format, str(path)])
+    assert capsys.readouterr().out == text.getvalue()
+
+
+def test_binlog_read_records():
+    data = io.BytesIO()
+    stage = binlog.BinaryOutput(data)
+    cfg = lolog.make_config()
+    cfg.add_stage(stage)
+    cfg.add_value('pid', 7)
+    log = cfg.get_logger('app')
+    log.info('one', a=1)
+    stage.reset()                       # e.g. after rotating the file
+    log.info('two', b=2)
+    stage.reset()
+    log.info('three', c=3)
+
+    # the static layer keeps only the fragments for the current table
+    assert len(cfg.log_map._cache) == 1
+
+    def read(data):
+        return [(record.message, record.log_map[1:])
+                for record in binlog.read_records(io.BytesIO(data))]
+
+    # each string is stored once per string table
+    value = data.getvalue()
+    assert value.count(b'app') == value.count(b'pid') == 3
+    assert read(value) == [('one', [('a', 1)]),
+                           ('two', [('b', 2)]),
+                           ('three', [('c', 3)])]
+    assert all(record.log_map[0] == ('pid', 7)
+               for record in binlog.read_records(io.BytesIO(value)))
+
+    # a truncated record at the end is ignored
+    assert read(value[:-1]) == [('one', [('a', 1)]), ('two', [('b', 2)])]
+
+    with pytest.raises(binlog.FormatError) as ctx:
+        read(b'2020-01-14T13:14:43.400000 hello name=app level=INFO\n')
+    assert str(ctx.value) == 'not a lolog binary log'
+
+
+def test_binlog_write_error():
+    class FailingStream(io.BytesIO):
+        fail = False
+
+        def write(self, data):
+            if self.fail:
+                raise OSError('no space left on device')
+            return super().write(data)
+
+    data = FailingStream()
+    cfg = lolog.make_config()
+    cfg.add_stage(binlog.BinaryOutput(data))
+    log = cfg.get_logger('app')
+    log.info('one', a=1)
+
+    # the strings new in this record are defined by the next one written
+    data.fail = True
+    with pytest.raises(OSError):
+        log.info('lost', new_key='new value')
+    data.fail = False
+    log.info('two', new_key='new value')
+    records = binlog.read_records(io.BytesIO(data.getvalue()))
+    assert [(record.message, record.log_map) for record in records] == [
+        ('one', [('a', 1)]), ('two', [('new_key', 'new value')])]
+
+
+def write_query_log(path, format, start, count):
+    # count records, two per second from start, with a line that is not a
+    # record in the middle
+    cfg = lolog.make_config()
+    with open(path, 'a') as outfile:
+        cfg.configure(stream=outfile, format=format)
+        cfg.set_time_format('utc')
+        for idx in range(start, start + count):
+            cfg.time = lambda: 1600000000 + idx / 2
+            log = cfg.get_logger(['app', 'app.db', 'lib'][idx % 3])
+            level = lolog.ERROR if idx % 10 == 0 else lolog.INFO
+            text = 'two\nlines' if idx == start + count // 2 else 'x'
+            log._log(level, 'event {} name=fake level=CRITICAL'.format(idx),
+                     [('idx', idx), ('req', 'r{}'.format(idx % 4)), ('text', text)])
+
+
+@pytest.mark.parametrize('format', ['simple', 'json'])
+def test_query(format, tmp_path, capsys):
+    path = tmp_path / 'app.log'
+    write_query_log(path, format, 0, 100)
+
+    def indexes(**kwargs):
+        lines = list(query.query_file(str(path), query.Query(**kwargs)))
+        result = [int(line.split(b'event ')[1].split()[0]) for line in lines]
+        assert list(query.query_file(str(path), query.Query(**kwargs),
+                                     use_index=True, block_size=500)) == lines
+        return result
+
+    assert indexes() == list(range(100))
+    # 1600000010 is 2020-09-13T12:26:50Z
+    assert indexes(since='2020-09-13T12:26:50',
+                   until='2020-09-13T12:26:53') == list(range(20, 26))
+    assert indexes(since='2020-09-13T12:26:5',
+                   until='2020-09-13T12:27') == list(range(20, 40))
+    assert indexes(since='2020-09-13T12:28') == []
+    assert indexes(until='2020-09-13T12:26:41') == [0, 1]
+    assert indexes(level=lolog.ERROR) == list(range(0, 100, 10))
+    assert indexes(names=['app.*', 'lib']) == [
+        idx for idx in range(100) if idx % 3 != 0]
+    assert indexes(items=[('req', 'r1'), ('idx', '13')]) == [13]
+    assert indexes(items=[('req', 'r')]) == []
+
+    query.main(['--level', 'error', '--name', 'app', '--item', 'req=r2',
+                '--since', '2020-09-13T12:26:50', str(path)])
+    out = capsys.readouterr().out.splitlines()
+    assert [line.split('event ')[1].split()[0] for line in out] == ['30', '90']
+
+    with pytest.raises(SystemExit):
+        query.main(['--item', 'nokey', str(path)])
+
+
+def test_query_parse_line():
+    assert query.parse_line(
+        b'2020-01-14T13:14:43.400000 hi name=x level=ERROR there'
+        b' name=app level=INFO a=1\n') == (
+            b'2020-01-14T13:14:43.400000', 'app', lolog.INFO)
+    assert query.parse_line(b'name=x level=ERROR\n') is None
+
+
+def test_query_index(tmp_path):
+    path = tmp_path / 'app.log'
+    idx_path = query.index_path(str(path))
+    write_query_log(path, 'json', 0, 100)
+
+    errors = query.Query(level=lolog.ERROR)
+    found = list(query.query_file(str(path), errors, True, 600))
+    index = query.Index.load(idx_path)
+    assert index.size == os.path.getsize(path)
+    assert index.names == ['app', 'app.db', 'lib']
+    assert len(index.blocks) > 5
+    times = [block.time or b'' for block in index.blocks]
+    assert times == sorted(times)
+
+    # blocks with no errors are skipped
+    ranges = list(index.ranges(errors))
+    assert sum(end - start for (start, end) in ranges) < index.size / 2
+    assert len(found) == 10
+
+    # appending extends the index; replacing the file rebuilds it
+    write_query_log(path, 'json', 100, 50)
+    found = list(query.query_file(str(path), errors, True, 600))
+    assert len(found) == 15
+    index2 = query.Index.load(idx_path)
+    assert index2.size == os.path.getsize(path)
+    num_blocks = len(index.blocks)
+    assert len(index2.blocks) > num_blocks
+    assert [block.offset for block in index2.blocks[:num_blocks]] == [
+        block.offset for block in index.blocks]
+
+    os.unlink(path)
+    write_query_log(path, 'simple', 0, 30)
+    found = list(query.query_file(str(path), errors, True, 600))
+    assert len(found) == 3
+    assert query.Index.load(idx_path).size == os.path.getsize(path)
+
+
+def read_segments(path):
+    return b''.join(pylolog.read_segment(seg_path)
+                    for (seq, seg_path) in pylolog._segment_paths(str(path)))
+
+
+def test_mmap_output(tmp_path):
+    path = tmp_path / 'debug.log'
+    output = pylolog.MmapOutput(str(path), segment_size=200)
+    cfg = lolog.make_config()
+    cfg.configure(format='json', output=output)
+    log = cfg.get_logger('app')
+
+    def work(thread):
+        for idx in range(50):
+            log.info('hello', thread=thread, idx=idx)
+
+    threads = [threading.Thread(target=work, args=(idx,)) for idx in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # committed data is readable while the segment is still open, and no
+    # record is split across segments
+    segments = pylolog._segment_paths(str(path))
+    assert len(segments) > 10
+    for (seq, seg_path) in segments:
+        assert pylolog.read_segment(seg_path).endswith(b'}\n')
+    records = [json.loads(line) for line in read_segments(path).splitlines()]
+    assert sorted((rec['thread'], rec['idx']) for rec in records) == [
+        (thread, idx) for thread in range(4) for idx in range(50)]
+
+    # closing gives back the preallocated space
+    output.close()
+    (seq, last_path) = segments[-1]
+    assert os.path.getsize(last_path) < 200
+
+
+def test_mmap_output_segments(tmp_path):
+    path = tmp_path / 'debug.log'
+    output = pylolog.MmapOutput(str(path), segment_size=128, max_segments=2)
+    output.write(b'a' * 30)
+    output.write(b'b' * 30)
+    output.write(b'c' * 300)        # too big: gets a segment of its own
+    output.write(b'd' * 30)
+    assert [seq for (seq, _) in pylolog._segment_paths(str(path))] == [2, 3]
+    assert read_segments(path) == b'c' * 300 + b'd' * 30
+    output.close()
+
+    # a new writer carries on after the existing segments
+    output = pylolog.MmapOutput(str(path), segment_size=128)
+    output.write(b'e' * 30)
+    output.close()
+    assert read_segments(path) == b'c' * 300 + b'd' * 30 + b'e' * 30
+
+    with pytest.raises(ValueError):
+        pylolog.read_segment(__file__)
+
+
+def test_mmap_output_fork(tmp_path):
+    base = str(tmp_path / 'debug.log')
+    output = pylolog.MmapOutput(base, segment_size=128)
+    output.write(b'parent')
+
+    # each process writes its own series, even a child of a child
+    def grandchild():
+        output.write(b'grandchild')
+        assert output.path == '{}.{}'.format(base, os.getpid())
+        return 0
+
+    def child():
+        output.write(b'child')
+        assert output.path == '{}.{}'.format(base, os.getpid())
+        return run_child(grandchild)
+
+    assert run_child(child) == 0
+    output.close()
+    names = sorted(name.split('.') for name in os.listdir(tmp_path))
+    assert len(names) == 3
+    assert names[0] == ['debug', 'log', '000001']
+    assert all(len(name) == 4 and name[2].isdigit() and name[3] == '000001'
+               for name in names[1:])
+
+
+def test_rate_limit():
+    def emitted():
+        records = [json.loads(line) for line in outfile.getvalue().splitlines()]
+        outfile.truncate(0)
+        outfile.seek(0)
+        return [(rec['message'], rec.get('suppressed')) for rec in records]
+
+    with freezegun.freeze_time('2020-01-14 13:14:43') as frozen:
+        outfile = io.StringIO()
+        cfg = lolog.make_config()
+        cfg.configure(stream=outfile, format='json')
+        limit = pylolog.RateLimit(rate=1.0, burst=3, max_keys=2)
+        cfg.insert_stage(0, limit)
+        log = cfg.get_logger('app')
+
+        for idx in range(100):
+            log.warning('retrying', attempt=idx)
+        log.info('retrying')            # different level: separate limit
+        assert emitted() == [('retrying', None)] * 4
+        assert limit.suppressed == 97
+
+        # the bucket refills at the given rate
+        frozen.tick(1.5)
+        log.warning('retrying')
+        log.warning('retrying')
+        assert emitted() == [('retrying', 97)]
+
+        # the least recently used key is forgotten
+        log.error('other')
+        assert list(limit.keys) == [('app', 'retrying', lolog.WARNING),
+                                    ('app', 'other', lolog.ERROR)]
+
+
+def test_rate_limit_sample():
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile, format='json')
+    cfg.insert_stage(0, pylolog.RateLimit(rate=None, sample=10))
+    log = cfg.get_logger('app')
+    for idx in range(25):
+        log.info('tick', idx=idx)
+    records = [json.loads(line) for line in outfile.getvalue().splitlines()]
+    assert [(rec['idx'], rec.get('suppressed')) for rec in records] == [
+        (0, None), (10, 9), (20, 9)]
+
+    with pytest.raises(ValueError):
+        pylolog.RateLimit(sample=0)
+
+
+@pytest.mark.parametrize('match_log_map', [True, False])
+def test_collapse(match_log_map):
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile, format='json')
+    collapse = pylolog.Collapse(window=0.1, match_log_map=match_log_map)
+    cfg.insert_stage(0, collapse)
+    log = cfg.get_logger('app')
+    other = cfg.get_logger('other')
+
+    def emitted():
+        records = [json.loads(line) for line in outfile.getvalue().splitlines()]
+        outfile.truncate(0)
+        outfile.seek(0)
+        return [(rec['name'], rec['message'], rec.get('x'), rec.get('repeated'))
+                for rec in records]
+
+    # runs are per logger, and end when a different record arrives
+    for idx in range(5):
+        log.info('retrying', x=[1, 2])
+        other.info('busy')
+    log.info('retrying', x=[1, 3])
+    log.warning('retrying', x=[1, 3])
+    if match_log_map:
+        assert emitted() == [
+            ('app', 'retrying', [1, 2], None),
+            ('other', 'busy', None, None),
+            ('app', 'retrying', None, 4),
+            ('app', 'retrying', [1, 3], None),
+            ('app', 'retrying', [1, 3], None),
+        ]
+    else:
+        assert emitted() == [
+            ('app', 'retrying', [1, 2], None),
+            ('other', 'busy', None, None),
+            ('app', 'retrying', None, 5),
+            ('app', 'retrying', [1, 3], None),
+        ]
+
+    # or when the window expires
+    log.warning('retrying', x=[1, 3])
+    time.sleep(0.3)
+    assert sorted(emitted()) == [('app', 'retrying', None, 1),
+                                 ('other', 'busy', None, 4)]
+
+    log.warning('retrying', x=[1, 3])
+    collapse.close()
+    assert emitted() == [('app', 'retrying', None, 1)]
+
+
+def test_collapse_slow_output():
+    # a summary blocked in a slow output does not hold up other loggers
+    entered = threading.Event()
+    release = threading.Event()
+    lines = []
+
+    def slow_output(config, record):
+        if dict(record.log_map).get('repeated'):
+            entered.set()
+            release.wait()
+        lines.append(record.message)
+        return None
+
+    cfg = lolog.make_config()
+    collapse = pylolog.Collapse(window=0.05)
+    cfg.pipeline = [collapse, slow_output]
+    log = cfg.get_logger('app')
+    other = cfg.get_logger('other')
+    log.info('again')
+    log.info('again')
+    thread = threading.Thread(target=other.info, args=('meanwhile',))
+    try:
+        # the timer thread emits the summary, which blocks
+        assert entered.wait(5)
+        thread.start()
+        thread.join(1)
+        assert not thread.is_alive()
+    finally:
+        release.set()
+    thread.join()
+    collapse.close()
+    assert lines == ['again', 'meanwhile', 'again']
+
+
+def test_pattern_matcher():
+    # same result as trying the patterns in order
+    patterns = [
+        ('app.db', lolog.ERROR),
+        ('app.*', lolog.WARNING),
+        ('app.db.*', lolog.DEBUG),          # shadowed by app.*
+        ('lib?.core', lolog.CRITICAL),
+        ('lib*', lolog.INFO),
+        ('*.db', lolog.SILENT),
+        ('*.c.d', lolog.INFO),
+        ('.*', lolog.ERROR),
+        ('[xy].*', lolog.CRITICAL),
+        ('app.db', lolog.DEBUG),            # duplicate: never wins
+        ('*', lolog.NOTSET),
+    ]
+    names = ['app', 'app.', 'app.db', 'app.db.conn', 'appx', 'lib1.core',
+             'lib1.core.x', 'lib', 'other.db', 'db', '.hidden', 'x.y', 'x',
+             'ünï.db', 'a.b.c.d.e.f', 'a.b.c.d', 'c.d', '.c.d']
+    for count in range(len(patterns) + 1):
+        matcher = pylolog.PatternMatcher()
+        for (pattern, level) in patterns[:count]:
+            matcher.add(pattern, level)
+        for name in names:
+            expect = next((level for (pattern, level) in patterns[:count]
+                           if fnmatch.fnmatchcase(name, pattern)), None)
+            assert matcher.match(name) == expect, (count, name)
+
+    # many patterns
+    cfg = lolog.make_config()
+    cfg.configure(stream=io.StringIO(), level=lolog.INFO)
+    for idx in range(500):
+        cfg.set_logger_pattern_level('lib{}.*'.format(idx), lolog.WARNING)
+        cfg.set_logger_pattern_level('*.mod{}'.format(idx), lolog.ERROR)
+    assert cfg.get_logger_level('lib2.x.mod300') == lolog.WARNING
+    assert cfg.get_logger_level('lib300.x.mod2') == lolog.ERROR
+    assert cfg.get_logger_level('app.mod499') == lolog.ERROR
+    assert cfg.get_logger_level('app.mod500') == lolog.INFO
+
+
+def test_intercept():
+    outfile = io.StringIO()
+    cfg = lolog.make_config()
+    cfg.configure(stream=outfile, format='json', level=lolog.INFO)
+    cfg.set_logger_level('lib.quiet', lolog.WARNING)
+    interceptor = iclogging.Interceptor(cfg, logging.Logger)
+    original = logging.Logger.info
+
+    class Expensive:
+        calls = 0
+
+        def __str__(self):
+            Expensive.calls += 1
+            return 'expensive'
+
+    interceptor.intercept()
+    try:
+        log = logging.getLogger('lib')
+        quiet = logging.getLogger('lib.quiet')
+        log.debug('filtered %s', Expensive())
+        log.info('hello %s', 'world', extra={'k': 1})
+        log.info('%(a)s and %(b)s', {'a': 1, 'b': 2})
+        log.info('bad %d', 'format')
+        log.log(25, 'between info and warning')
+        log.log(logging.DEBUG, 'filtered')
+        quiet.info('filtered')
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            quiet.exception('oops')
+
+        assert Expensive.calls == 0
+        assert not log.isEnabledFor(logging.DEBUG)
+        assert log.isEnabledFor(logging.INFO)
+        assert log.getEffectiveLevel() == logging.INFO
+        assert quiet.getEffectiveLevel() == logging.WARNING
+    finally:
+        interceptor.undo()
+
+    assert logging.Logger.info is original
+    assert '_lolog_logger' not in vars(log)
+    records = [json.loads(line) for line in outfile.getvalue().splitlines()]
+    assert [(rec['name'], rec['level'], rec['message']) for rec in records] == [
+        ('lib', 'INFO', 'hello world'),
+        ('lib', 'INFO', '1 and 2'),
+        ('lib', 'INFO', 'bad %d'),
+        ('lib', 'INFO', 'between info and warning'),
+        ('lib.quiet', 'ERROR', 'oops'),
+    ]
+    assert records[0]['k'] == 1
+    assert records[2]['arg1'] == 'format'
+    assert 'ZeroDivisionError' in records[4]['exception']